@@ -0,0 +1,374 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from encoders import dumps
+from flask import current_app, g, request
+from metrics import labels
+from werkzeug.local import LocalProxy
+
+# Admission control for expensive routes. Before a limited route runs, the
+# client's token bucket for the route must hold a token (else 429), and
+# the route must have a free execution slot in this process, waiting in a
+# short bounded queue for one if not (else 503). Both answers carry
+# Retry-After, so rejected clients back off instead of piling onto the
+# workers.
+LIMIT_NAMES = ("rate", "burst", "concurrency", "queue")
+DEFAULT_LIMITS = {"rate": 5, "burst": 20, "concurrency": 2, "queue": 2}
+DECISIONS = ("admitted", "queued", "rate_limited", "queue_full", "queue_timeout")
+QUEUE_TIMEOUT_SECONDS = 1.0
+MAX_BUCKETS = 10000
+
+
+class LocalBuckets:
+    """
+    Token buckets held in this process, least recently used first, at most
+    max_buckets of them. A bucket that is dropped comes back full. A
+    backend shared by several worker processes (Redis, ...) provides the
+    same take method, so a client draws from one bucket per route across
+    all of them.
+    """
+
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        """
+        Initializes an empty set of buckets
+        """
+
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """
+        Takes a token from the bucket key, which refills at rate tokens per
+        second up to burst tokens. Returns 0 when a token was taken, or the
+        seconds until one will be available.
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+            return wait
+
+
+BACKENDS = {"local": LocalBuckets}
+
+
+class Gate:
+    """
+    At most limit concurrent executions of one route, with at most queue
+    requests waiting for a slot
+    """
+
+    def __init__(self, limit, queue):
+        """
+        Initializes an open gate
+        """
+
+        self.limit = limit
+        self.queue = queue
+        self.active = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def enter(self, timeout):
+        """
+        Takes an execution slot, waiting up to timeout seconds in the queue
+        for one. Returns the decision: admitted or queued when a slot was
+        taken, queue_full or queue_timeout when not.
+        """
+
+        with self.condition:
+            if self.active < self.limit:
+                self.active += 1
+                return "admitted"
+            if self.waiting >= self.queue:
+                return "queue_full"
+            deadline = time.monotonic() + timeout
+            self.waiting += 1
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return "queue_timeout"
+                    self.condition.wait(remaining)
+                self.active += 1
+                return "queued"
+            finally:
+                self.waiting -= 1
+
+    def leave(self):
+        """
+        Frees an execution slot and wakes one waiting request
+        """
+
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+
+class Admission:
+    """
+    Per route gates and decision counters, with token buckets kept by a
+    pluggable backend, keyed by route rule and method
+    """
+
+    def __init__(self):
+        """
+        Initializes admission control with the local backend
+        """
+
+        self.backend = LocalBuckets()
+        self.queue_timeout = QUEUE_TIMEOUT_SECONDS
+        self.gates = {}
+        self.decisions = {}
+        self.lock = threading.Lock()
+
+    def gate(self, route, method, limits):
+        """
+        Returns the gate of a route, creating it on first use
+        """
+
+        with self.lock:
+            gate = self.gates.get((route, method))
+            if gate is None:
+                gate = Gate(limits["concurrency"], limits["queue"])
+                self.gates[(route, method)] = gate
+            return gate
+
+    def count(self, route, method, decision):
+        """
+        Counts one decision for a route
+        """
+
+        with self.lock:
+            counts = self.decisions.setdefault((route, method), {})
+            counts[decision] = counts.get(decision, 0) + 1
+
+    def admit(self, route, method, client, limits):
+        """
+        Decides whether a request may run and returns (decision, gate,
+        retry_after). gate is the gate whose slot the request holds, or
+        None, and retry_after is set for rejected requests.
+        """
+
+        if limits["rate"] is not None:
+            key = "%s %s %s" % (method, route, client)
+            wait = self.backend.take(key, limits["rate"], limits["burst"])
+            if wait:
+                self.count(route, method, "rate_limited")
+                return "rate_limited", None, wait
+        if limits["concurrency"] is None:
+            self.count(route, method, "admitted")
+            return "admitted", None, None
+        gate = self.gate(route, method, limits)
+        decision = gate.enter(self.queue_timeout)
+        self.count(route, method, decision)
+        if decision in ("admitted", "queued"):
+            return decision, gate, None
+        return decision, None, self.queue_timeout
+
+    def stats(self):
+        """
+        Returns every limited route's decision counts, slots in use and
+        waiting requests
+        """
+
+        with self.lock:
+            routes = {}
+            for (route, method), counts in sorted(self.decisions.items()):
+                gate = self.gates.get((route, method))
+                routes["%s %s" % (method, route)] = dict(
+                    {decision: counts.get(decision, 0) for decision in DECISIONS},
+                    in_flight=0 if gate is None else gate.active,
+                    waiting=0 if gate is None else gate.waiting,
+                )
+            return {"routes": routes}
+
+    def render(self):
+        """
+        Returns the decision counters and gate gauges in the Prometheus text
+        exposition format
+        """
+
+        with self.lock:
+            decisions = sorted(self.decisions.items())
+            gates = sorted(self.gates.items())
+            lines = [
+                "# HELP studymatch_admission_decisions_total Admission decisions"
+                " by route and outcome",
+                "# TYPE studymatch_admission_decisions_total counter",
+            ]
+            for (route, method), counts in decisions:
+                for decision, count in sorted(counts.items()):
+                    lines.append(
+                        'studymatch_admission_decisions_total{%s,decision="%s"} %d'
+                        % (labels(route, method), decision, count)
+                    )
+            for name, text, attribute in [
+                (
+                    "studymatch_admission_in_flight",
+                    "Requests holding an execution slot",
+                    "active",
+                ),
+                (
+                    "studymatch_admission_waiting",
+                    "Requests waiting for an execution slot",
+                    "waiting",
+                ),
+            ]:
+                lines.append("# HELP %s %s" % (name, text))
+                lines.append("# TYPE %s gauge" % name)
+                for (route, method), gate in gates:
+                    lines.append(
+                        "%s{%s} %d"
+                        % (name, labels(route, method), getattr(gate, attribute))
+                    )
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        """
+        Drops every counter; gates in use are kept
+        """
+
+        with self.lock:
+            self.decisions.clear()
+
+
+# the current app's admission control; every app built by create_app has
+# its own
+admission = LocalProxy(lambda: current_app.extensions["admission"])
+
+
+def check_limits(limits, where):
+    """
+    Raises ValueError when limits names an unknown limit or holds a value
+    that is out of range
+    """
+
+    unknown = set(limits) - set(LIMIT_NAMES)
+    if unknown:
+        raise ValueError(
+            "Unknown admission limits for %s: %s" % (where, ", ".join(sorted(unknown)))
+        )
+    for name, value in limits.items():
+        smallest = 0 if name == "queue" else 1
+        if name in ("rate", "concurrency") and value is None:
+            continue
+        if value is None or value < smallest or (name == "rate" and value <= 0):
+            raise ValueError("Invalid admission %s for %s: %r" % (name, where, value))
+
+
+def admission_limit(**limits):
+    """
+    Decorator that puts a route under admission control, with limits
+    overriding DEFAULT_LIMITS: rate tokens per second and burst tokens per
+    client, and concurrency executions at once per worker with queue
+    requests waiting. A rate or concurrency of None turns that check off.
+    Put it below @api.route.
+    """
+
+    check_limits(limits, "@admission_limit")
+
+    def decorator(view):
+        view.admission_limits = limits
+        return view
+
+    return decorator
+
+
+def route_limits(app, endpoint):
+    """
+    Returns the limits of endpoint, from its @admission_limit and the
+    ADMISSION_LIMITS config, or None when it is not limited
+    """
+
+    view = app.view_functions.get(endpoint)
+    limits = getattr(view, "admission_limits", None)
+    configured = app.config["ADMISSION_LIMITS"].get(endpoint)
+    if limits is None and configured is None:
+        return None
+    merged = dict(DEFAULT_LIMITS)
+    merged.update(limits or {})
+    merged.update(configured or {})
+    return merged
+
+
+def client_key(app):
+    """
+    Identifies the client of the current request by its address, or by the
+    ADMISSION_CLIENT_HEADER header when that is set. Clients can send any
+    header they like, so only name one that a trusted proxy in front of
+    every request overwrites.
+    """
+
+    header = app.config["ADMISSION_CLIENT_HEADER"]
+    if header is not None and request.headers.get(header):
+        return request.headers[header]
+    return request.remote_addr
+
+
+def init_admission(app):
+    """
+    Installs admission control on app
+
+    Routes marked with @admission_limit, and the endpoints named in
+    ADMISSION_LIMITS, which maps an endpoint such as "api.get_groups" to
+    limits overriding its decorator's, are limited. ADMISSION_BACKEND picks
+    where token buckets live, ADMISSION_CLIENT_HEADER names the header a
+    trusted proxy identifies clients with (None keys buckets by address),
+    ADMISSION_QUEUE_TIMEOUT_SECONDS is how long a request may wait for an
+    execution slot, and ADMISSION_ENABLED turns all of it on. It is off by
+    default: behind a proxy every request comes from the proxy's address,
+    so until ADMISSION_CLIENT_HEADER is set all clients would share one
+    bucket per route.
+    """
+
+    app.config.setdefault("ADMISSION_ENABLED", False)
+    app.config.setdefault("ADMISSION_BACKEND", "local")
+    app.config.setdefault("ADMISSION_LIMITS", {})
+    app.config.setdefault("ADMISSION_CLIENT_HEADER", None)
+    app.config.setdefault("ADMISSION_QUEUE_TIMEOUT_SECONDS", QUEUE_TIMEOUT_SECONDS)
+    if app.config["ADMISSION_BACKEND"] not in BACKENDS:
+        raise ValueError(
+            "Unknown admission backend %r" % app.config["ADMISSION_BACKEND"]
+        )
+    for endpoint, limits in app.config["ADMISSION_LIMITS"].items():
+        check_limits(limits, endpoint)
+    control = Admission()
+    control.backend = BACKENDS[app.config["ADMISSION_BACKEND"]]()
+    control.queue_timeout = float(app.config["ADMISSION_QUEUE_TIMEOUT_SECONDS"])
+    app.extensions["admission"] = control
+
+    @app.before_request
+    def admit_request():
+        if not app.config["ADMISSION_ENABLED"] or request.url_rule is None:
+            return None
+        limits = route_limits(app, request.endpoint)
+        if limits is None:
+            return None
+        decision, gate, retry_after = control.admit(
+            request.url_rule.rule, request.method, client_key(app), limits
+        )
+        if decision in ("admitted", "queued"):
+            if gate is not None:
+                g.admission_gate = gate
+            return None
+        headers = {"Retry-After": str(max(1, math.ceil(retry_after)))}
+        if decision == "rate_limited":
+            return dumps({"error": "Too many requests"}), 429, headers
+        return dumps({"error": "Server is busy"}), 503, headers
+
+    @app.teardown_request
+    def release_slot(exc):
+        gate = g.pop("admission_gate", None)
+        if gate is not None:
+            gate.leave()
@@ -1,28 +1,248 @@
 import json
+import operator
 import os
 from db import db
-from flask import Flask, request
+from flask import Blueprint, Flask, Response, current_app, request
+from sqlalchemy import exists, or_, text
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from db import Group, User, Task, Post, Comment
-
-app = Flask(__name__)
+from db import AnyComment, AnyPost
+from archive import init_archive, parse_archived
+from admission import admission, admission_limit, init_admission
+from encoders import dumps, init_encoding
+from batch import COMMENT_FIELDS, COMMENT_PARSERS, TASK_FIELDS, TASK_PARSERS
+from batch import USER_FIELDS, USER_PARSERS
+from batch import LOOKUP_CHUNK_SIZE, MAX_BATCH_SIZE
+from batch import batch_result, bulk_insert, fetch_by, parse_batch, reject_duplicates
+from changes import group_changes, post_changes
+from counters import init_counters
+from documents import document, document_query, init_documents
+from fieldsets import parse_fieldset
+from matching import auto_assign, parse_attribute
+from metrics import PROMETHEUS_MIMETYPE, init_metrics, metrics, timed
+from migrations import init_migrations, migrate
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, apply_filters
+from pagination import parse_list_args, paginate
+from pagination import rebind_filters, stream_response
+from pubsub import broker, init_pubsub, iter_events
+from query_budget import init_query_budget, query_budget
+from response_cache import cached, init_response_cache, invalidate_on_commit
+from response_cache import response_cache
+from search import SEARCH_KINDS, SEARCH_PAGE_SIZE, init_search, search
+from search import index_comments, index_post, unindex_comment, unindex_post
+from storage import init_storage
+from timestamps import parse_timestamp
+from transfer import init_transfer
+
+api = Blueprint("api", __name__)
 db_filename = "StudentMatch.db"
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
-
-db.init_app(app)
-with app.app_context():
-    db.create_all()
+# what a write route answers with, chosen with ?return=
+RETURN_MODES = ("entity", "minimal", "parent")
 
 
 # generalized response formats
 def success_response(data, code=200):
-    return json.dumps(data), code
+    with timed("encode"):
+        return dumps(data), code
 
 
 def failure_response(message, code=404):
-    return json.dumps({"error": message}), code
+    with timed("encode"):
+        return dumps({"error": message}), code
+
+
+def fieldset_query(model, fieldset, serialize, options, sort_column=None):
+    """
+    Returns the (query, serialize) pair for reading model with a fieldset
+
+    Without a fieldset this is the full ORM query with options. A fieldset
+    without nested collections becomes a column only projection, which
+    skips building ORM objects altogether.
+    """
+
+    if fieldset is None:
+        return model.query.options(*options), serialize
+    if fieldset.projectable:
+        query = db.session.query(*fieldset.columns(sort_column))
+        return query, fieldset.serialize_row
+    return (
+        model.query.options(*fieldset.loader_options(selectinload)),
+        fieldset.serialize,
+    )
+
+
+def list_response(
+    model, key, serialize, *options, filters=None, sort_columns=(), scope=()
+):
+    """
+    Builds a list response for model, paged with ?limit=&after= or
+    streamed with ?stream=json|ndjson, narrowed with ?fields=&expand=,
+    filtered by the query parameters in filters and ordered with ?order=
+    over sort_columns. options are loader options applied to every page or
+    chunk so related collections load in batches. scope holds criteria
+    every row must meet, such as belonging to one group.
+    """
+
+    try:
+        limit, after, stream, ordering = parse_list_args(
+            request.args, model, sort_columns
+        )
+        fieldset = parse_fieldset(model, request.args)
+        query, serialize = fieldset_query(
+            model, fieldset, serialize, options, ordering.sort_column
+        )
+        query = apply_filters(query.filter(*scope), request.args, filters or {})
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    if stream is not None:
+        return stream_response(query, ordering, key, serialize, stream, after)
+    rows, next_cursor = paginate(query, ordering, limit, after)
+    with timed("serialize"):
+        data = [serialize(row) for row in rows]
+    return success_response({key: data, "next_cursor": next_cursor}, 200)
+
+
+def detail_response(model, model_id, name, serialize, *options, kind=None, column=None):
+    """
+    Builds the response for a single row of model, narrowed with
+    ?fields=&expand=. The row is looked up by column, a unique column
+    defaulting to id. When kind names a materialized document, the full
+    representation is served from the document store.
+    """
+
+    try:
+        fieldset = parse_fieldset(model, request.args)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    if fieldset is None and kind is not None:
+        body = document(kind, model_id)
+        if body is None:
+            return failure_response("%s not found" % name, 404)
+        return body, 200
+    query, serialize = fieldset_query(model, fieldset, serialize, options)
+    column = model.id if column is None else column
+    row = query.filter(column == model_id).first()
+    if row is None:
+        return failure_response("%s not found" % name, 404)
+    with timed("serialize"):
+        data = serialize(row)
+    return success_response(data, 200)
+
+
+def archived_view(hot, view):
+    """
+    Returns the model a read of hot posts or comments goes to: hot, or view,
+    which reads hot and archived rows alike, with ?include_archived=true.
+    Raises ValueError on a bad value.
+    """
+
+    return view if parse_archived(request.args) else hot
+
+
+def parse_return(default):
+    """
+    Returns the ?return= mode of a write route, default when absent. Raises
+    ValueError on an unknown mode.
+    """
+
+    mode = request.args.get("return", default)
+    if mode not in RETURN_MODES:
+        raise ValueError("return must be one of: %s" % ", ".join(RETURN_MODES))
+    return mode
+
+
+def write_response(mode, data, code, kind, parent_id, fieldset):
+    """
+    Builds the response of a write for its ?return= mode: the written row's
+    data (entity), no body (minimal), or the group or post it belongs to
+    narrowed with ?fields=&expand= (parent). The full parent is served from
+    the document store.
+    """
+
+    if mode == "minimal":
+        return "", 204 if code == 200 else code
+    if mode == "entity":
+        return success_response(data, code)
+    name = kind.capitalize()
+    if fieldset is None:
+        body = document(kind, parent_id)
+        if body is None:
+            return failure_response("%s not found" % name, 404)
+        return body, code
+    # only the fields asked for, loading no collection that was not
+    _, model, _ = document_query(kind)
+    query, serialize = fieldset_query(model, fieldset, None, ())
+    row = query.filter(model.id == parent_id).first()
+    if row is None:
+        return failure_response("%s not found" % name, 404)
+    with timed("serialize"):
+        data = serialize(row)
+    return success_response(data, code)
+
+
+def changes_response(model, model_id, name, feed):
+    """
+    Builds a change feed response for one row of model: what changed under
+    it after ?since=, at most ?limit= changes
+    """
+
+    since = request.args.get("since", "0")
+    limit = request.args.get("limit", str(DEFAULT_PAGE_SIZE))
+    if not since.isdigit():
+        return failure_response("since must be a cursor returned as cursor", 400)
+    if not limit.isdigit() or int(limit) < 1:
+        return failure_response("limit must be a positive integer", 400)
+    if db.session.query(model.id).filter(model.id == model_id).first() is None:
+        return failure_response("%s not found" % name, 404)
+    changes, cursor, has_more = feed(
+        model_id, int(since), min(int(limit), MAX_PAGE_SIZE)
+    )
+    return success_response(
+        {"changes": changes, "cursor": cursor, "has_more": has_more}, 200
+    )
+
+
+def event_stream(model, model_id, name, channel):
+    """
+    Subscribes to channel and streams its events as server-sent events,
+    once the row of model the channel belongs to is known to exist
+    """
+
+    if not current_app.config["PUBSUB_STREAMS_ENABLED"]:
+        return failure_response("Event streams are not available", 503)
+    if db.session.query(model.id).filter(model.id == model_id).first() is None:
+        return failure_response("%s not found" % name, 404)
+    subscription = broker.subscribe(channel)
+    if subscription is None:
+        return failure_response("Too many subscribers, try again later", 503)
+    return Response(
+        iter_events(subscription),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# list endpoint filters: query parameter -> (column, operator, parse)
+TASK_FILTERS = {
+    "group_id": (Task.group_id, operator.eq, int),
+    "due_after": (Task.due_date, operator.ge, parse_timestamp),
+    "due_before": (Task.due_date, operator.lt, parse_timestamp),
+}
+POST_FILTERS = {
+    "since": (Post.timestamp, operator.ge, parse_timestamp),
+    "until": (Post.timestamp, operator.lt, parse_timestamp),
+}
+GROUP_TASK_FILTERS = {
+    "due_after": (Task.due_date, operator.ge, parse_timestamp),
+    "due_before": (Task.due_date, operator.lt, parse_timestamp),
+}
+COMMENT_FILTERS = {
+    "post_id": (Comment.post_id, operator.eq, int),
+    "since": (Comment.timestamp, operator.ge, parse_timestamp),
+    "until": (Comment.timestamp, operator.lt, parse_timestamp),
+}
 
 
 # Routes
@@ -30,7 +250,7 @@ def failure_response(message, code=404):
 # User routes: Create user, get all users, get specific user by user id and delete specific user by user id
 
 
-@app.route("/users/", methods=["POST"])
+@api.route("/users/", methods=["POST"])
 def create_user():
     """
     Endpoint to create a user
@@ -41,56 +261,162 @@ def create_user():
         return failure_response("User name is required", 400)
     if "netid" not in body:
         return failure_response("User netid is required", 400)
-    user = User(name=body["name"], netid=body["netid"])
+    try:
+        courses = parse_attribute(body, "courses")
+        availability = parse_attribute(body, "availability")
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    # take the write lock before the netid check, so a concurrent insert of
+    # the same netid waits for this one instead of hitting the unique index
+    db.session.execute(text("BEGIN IMMEDIATE"))
+    if User.query.filter_by(netid=body["netid"]).first() is not None:
+        return failure_response("User netid already exists", 409)
+    user = User(
+        name=body["name"],
+        netid=body["netid"],
+        courses=courses,
+        availability=availability,
+    )
     db.session.add(user)
     db.session.commit()
     return success_response(user.simple_serialize(), 201)
 
 
-@app.route("/users/<int:user_id>/", methods=["PUT"])
+@api.route("/users/batch/", methods=["POST"])
+def create_users_batch():
+    """
+    Endpoint to create many users in one transaction
+    """
+
+    body = json.loads(request.data)
+    try:
+        indexes, rows, errors = parse_batch(body, USER_FIELDS, USER_PARSERS)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    db.session.execute(text("BEGIN IMMEDIATE"))
+    indexes, rows = reject_duplicates(
+        User.netid, "netid", indexes, rows, errors, "User netid already exists"
+    )
+    ids = bulk_insert(User, rows)
+    db.session.commit()
+    return success_response(batch_result(len(body), indexes, ids, errors), 201)
+
+
+@api.route("/users/<int:user_id>/", methods=["PUT", "PATCH"])
 def assign_user_to_group(user_id):
     """
-    Endpoint to assign a user to a group
+    Endpoint to assign a user to a group. PATCH also takes a null group_id
+    to remove the user from their group.
     """
 
+    try:
+        fieldset = parse_fieldset(Group, request.args)
+        mode = parse_return("parent" if request.method == "PUT" else "entity")
+    except ValueError as e:
+        return failure_response(str(e), 400)
     body = json.loads(request.data)
     if "group_id" not in body:
         return failure_response("Group id is required", 400)
-    group = Group.query.filter_by(id=body["group_id"]).first()
-    if group is None:
+    group_id = body["group_id"]
+    if group_id is None and (request.method == "PUT" or mode == "parent"):
         return failure_response("Group not found", 404)
+    if group_id is not None and not isinstance(group_id, int):
+        return failure_response("Group id must be an integer", 400)
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return failure_response("User not found", 404)
-    user.group_id = body["group_id"]
-    group.users.append(user)
+    old_group_id = user.group_id
+    if old_group_id != group_id:
+        # one UPDATE, which also checks the group exists and has room, so
+        # the group's members are never loaded
+        statement = User.__table__.update().where(User.id == user_id)
+        statement = statement.values(group_id=group_id)
+        if group_id is not None:
+            statement = statement.where(
+                exists().where(
+                    Group.id == group_id,
+                    or_(Group.capacity.is_(None), Group.member_count < Group.capacity),
+                )
+            )
+        if db.session.execute(statement).rowcount == 0:
+            if db.session.query(Group.id).filter(Group.id == group_id).first() is None:
+                return failure_response("Group not found", 404)
+            return failure_response("Group is full", 409)
+        set_committed_value(user, "group_id", group_id)
+    data = user.serialize()
+    if old_group_id != group_id:
+        invalidate_on_commit(
+            "user:%d" % user_id,
+            "group:%s" % old_group_id,
+            "group:%s" % group_id,
+            "groups",
+        )
     db.session.commit()
-    return success_response(group.serialize(), 200)
+    if old_group_id != group_id:
+        if old_group_id is not None:
+            broker.publish("group:%d" % old_group_id, "user.left", data)
+        if group_id is not None:
+            broker.publish("group:%d" % group_id, "user.joined", data)
+    return write_response(mode, data, 200, "group", group_id, fieldset)
 
 
-@app.route("/users/", methods=["GET"])
+@api.route("/users/", methods=["GET"])
+@admission_limit()
+@query_budget(1)
 def get_users():
     """
     Endpoint to get all users
     """
 
-    users = [user.serialize() for user in User.query.all()]
-    return success_response({"users": users}, 200)
+    return list_response(User, "users", User.serialize)
 
 
-@app.route("/users/<int:user_id>/", methods=["GET"])
+@api.route("/users/<int:user_id>/", methods=["GET"])
+@query_budget(2)
+@cached("user:{user_id}")
 def get_user(user_id):
     """
     Endpoint to get all user by id
     """
 
-    user = User.query.filter_by(id=user_id).first()
-    if user is None:
-        return failure_response("User not found", 404)
-    return success_response(user.serialize(), 200)
+    return detail_response(User, user_id, "User", User.serialize)
+
 
+@api.route("/users/by-netid/<netid>/", methods=["GET"])
+@query_budget(1)
+def get_user_by_netid(netid):
+    """
+    Endpoint to get a user by netid
+    """
+
+    return detail_response(User, netid, "User", User.serialize, column=User.netid)
+
+
+@api.route("/users/lookup", methods=["POST"])
+@query_budget(MAX_BATCH_SIZE // LOOKUP_CHUNK_SIZE)
+def lookup_users():
+    """
+    Endpoint to get the users with any of a list of netids
+    """
 
-@app.route("/users/<int:user_id>/", methods=["DELETE"])
+    body = json.loads(request.data or "{}")
+    netids = body.get("netids") if isinstance(body, dict) else None
+    if not isinstance(netids, list) or not all(isinstance(n, str) for n in netids):
+        return failure_response("netids must be a list of netids", 400)
+    if len(netids) > MAX_BATCH_SIZE:
+        return failure_response(
+            "At most %d netids are allowed per lookup" % MAX_BATCH_SIZE, 400
+        )
+    netids = list(dict.fromkeys(netids))
+    users = fetch_by(User, User.netid, netids)
+    with timed("serialize"):
+        data = [users[netid].serialize() for netid in netids if netid in users]
+    missing = [netid for netid in netids if netid not in users]
+    return success_response({"users": data, "missing": missing}, 200)
+
+
+@api.route("/users/<int:user_id>/", methods=["DELETE"])
+@query_budget(3)
 def delete_user(user_id):
     """
     Endpoint to get delete user by id
@@ -99,10 +425,8 @@ def delete_user(user_id):
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return failure_response("User not found", 404)
-    group = Group.query.filter_by(id=user.group_id).first()
-    if group is not None:
-        group.users.remove(user)
     db.session.delete(user)
+    invalidate_on_commit("user:%d" % user.id, "group:%s" % user.group_id, "groups")
     db.session.commit()
     return success_response(user.serialize(), 200)
 
@@ -110,7 +434,7 @@ def delete_user(user_id):
 # Group Routes: Create group, get all groups, get specific group by group id and delete specific group by group id
 
 
-@app.route("/groups/", methods=["POST"])
+@api.route("/groups/", methods=["POST"])
 def create_group():
     """
     Endpoint to get create group
@@ -119,59 +443,213 @@ def create_group():
     body = json.loads(request.data)
     if "name" not in body:
         return failure_response("Group name is required", 400)
-    group = Group(name=body["name"])
+    capacity = body.get("capacity")
+    if capacity is not None and (
+        not isinstance(capacity, int) or isinstance(capacity, bool) or capacity < 1
+    ):
+        return failure_response("Group capacity must be a positive integer", 400)
+    try:
+        courses = parse_attribute(body, "courses")
+        availability = parse_attribute(body, "availability")
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    group = Group(
+        name=body["name"],
+        courses=courses,
+        availability=availability,
+        capacity=capacity,
+    )
     db.session.add(group)
+    invalidate_on_commit("groups")
     db.session.commit()
     return success_response(group.serialize(), 201)
 
 
-@app.route("/groups/", methods=["GET"])
+@api.route("/groups/auto-assign/", methods=["POST"])
+def auto_assign_users():
+    """
+    Endpoint to assign unassigned users to groups by shared courses and
+    availability, within group capacities
+    """
+
+    body = json.loads(request.data or "{}")
+    user_ids = body.get("user_ids")
+    default_capacity = body.get("default_capacity")
+    if user_ids is not None and not (
+        isinstance(user_ids, list)
+        and all(isinstance(i, int) and not isinstance(i, bool) for i in user_ids)
+    ):
+        return failure_response("user_ids must be a list of user ids", 400)
+    if default_capacity is not None and (
+        not isinstance(default_capacity, int)
+        or isinstance(default_capacity, bool)
+        or default_capacity < 1
+    ):
+        return failure_response("default_capacity must be a positive integer", 400)
+    assignments, unmatched = auto_assign(
+        user_ids, default_capacity, bool(body.get("fallback", False))
+    )
+    group_ids = sorted(set(assignments.values()))
+    invalidate_on_commit(
+        "groups",
+        *["group:%d" % group_id for group_id in group_ids],
+        *["user:%d" % user_id for user_id in assignments]
+    )
+    db.session.commit()
+    members = {}
+    for user_id, group_id in assignments.items():
+        members.setdefault(group_id, []).append(user_id)
+    for group_id, ids in members.items():
+        broker.publish("group:%d" % group_id, "users.joined", {"ids": ids})
+    return success_response(
+        {
+            "assignments": [
+                {"user_id": user_id, "group_id": group_id}
+                for user_id, group_id in assignments.items()
+            ],
+            "unmatched": unmatched,
+        },
+        200,
+    )
+
+
+@api.route("/groups/", methods=["GET"])
+@admission_limit()
+@query_budget(4)
+@cached("groups")
 def get_groups():
     """
     Endpoint to get all groups
     """
 
-    groups = [group.serialize() for group in Group.query.all()]
-    return success_response({"groups": groups}, 200)
+    return list_response(
+        Group,
+        "groups",
+        Group.serialize,
+        selectinload(Group.users),
+        selectinload(Group.tasks),
+    )
 
 
-@app.route("/groups/<int:group_id>/", methods=["GET"])
+@api.route("/groups/<int:group_id>/", methods=["GET"])
+@query_budget(6)
+@cached("group:{group_id}")
 def get_group(group_id):
     """
     Endpoint to get all a group by id
     """
 
-    group = Group.query.filter_by(id=group_id).first()
-    if group is None:
+    return detail_response(
+        Group,
+        group_id,
+        "Group",
+        Group.serialize,
+        selectinload(Group.users),
+        selectinload(Group.tasks),
+        kind="group",
+    )
+
+
+@api.route("/groups/<int:group_id>/users/", methods=["GET"])
+@query_budget(3)
+@cached("group:{group_id}")
+def get_group_users(group_id):
+    """
+    Endpoint to get the members of a group
+    """
+
+    if db.session.query(Group.id).filter(Group.id == group_id).first() is None:
+        return failure_response("Group not found", 404)
+    return list_response(
+        User, "users", User.serialize, scope=[User.group_id == group_id]
+    )
+
+
+@api.route("/groups/<int:group_id>/tasks/", methods=["GET"])
+@query_budget(3)
+@cached("group:{group_id}")
+def get_group_tasks(group_id):
+    """
+    Endpoint to get the tasks of a group
+    """
+
+    if db.session.query(Group.id).filter(Group.id == group_id).first() is None:
         return failure_response("Group not found", 404)
-    return success_response(group.serialize(), 200)
+    return list_response(
+        Task,
+        "tasks",
+        Task.serialize,
+        filters=GROUP_TASK_FILTERS,
+        sort_columns=("due_date",),
+        scope=[Task.group_id == group_id],
+    )
+
+
+@api.route("/groups/<int:group_id>/changes/", methods=["GET"])
+@query_budget(4)
+def get_group_changes(group_id):
+    """
+    Endpoint to get the members and tasks of a group changed since a cursor
+    """
+
+    return changes_response(Group, group_id, "Group", group_changes)
+
+
+@api.route("/groups/<int:group_id>/stream/", methods=["GET"])
+@query_budget(1)
+def stream_group_events(group_id):
+    """
+    Endpoint to stream task and membership changes of a group as
+    server-sent events
+    """
+
+    return event_stream(Group, group_id, "Group", "group:%d" % group_id)
 
 
-@app.route("/groups/<int:group_id>/", methods=["DELETE"])
+@api.route("/groups/<int:group_id>/", methods=["DELETE"])
+@query_budget(7)
 def delete_group(group_id):
     """
     Endpoint to delete a group by id
     """
 
-    group = Group.query.filter_by(id=group_id).first()
+    group = (
+        Group.query.options(selectinload(Group.users), selectinload(Group.tasks))
+        .filter_by(id=group_id)
+        .first()
+    )
     if group is None:
         return failure_response("Group not found", 404)
-    for user in group.users:
-        user.group_id = None
-    db.session.delete(group)
+    tags = ["group:%d" % group.id, "groups"]
+    tags += ["user:%d" % user.id for user in group.users]
+    tags += ["task:%d" % task.id for task in group.tasks]
+    # set-based: one statement per table however many members and tasks
+    User.query.filter_by(group_id=group.id).update(
+        {"group_id": None}, synchronize_session="evaluate"
+    )
+    data = group.serialize()
+    Task.query.filter_by(group_id=group.id).delete(synchronize_session=False)
+    Group.query.filter_by(id=group.id).delete(synchronize_session=False)
+    invalidate_on_commit(*tags)
     db.session.commit()
-    return success_response(group.serialize(), 200)
+    broker.publish("group:%d" % group_id, "group.deleted", {"id": group_id})
+    return success_response(data, 200)
 
 
 # Task routes: Create task for particular group id, update task for particular task id, get all tasks, get all tasks for a particular group, get specific task by task id, and delete specific task by task id
 
 
-@app.route("/groups/<int:group_id>/tasks/", methods=["POST"])
+@api.route("/groups/<int:group_id>/tasks/", methods=["POST"])
 def create_task(group_id):
     """
     Endpoint to create a task
     """
 
+    try:
+        fieldset = parse_fieldset(Group, request.args)
+        mode = parse_return("parent")
+    except ValueError as e:
+        return failure_response(str(e), 400)
     body = json.loads(request.data)
     if "task_name" not in body:
         return failure_response("Task name is required", 400)
@@ -179,71 +657,110 @@ def create_task(group_id):
         return failure_response("Task description is required", 400)
     if "due_date" not in body:
         return failure_response("Task due date is required", 400)
-    group = Group.query.filter_by(id=group_id).first()
-    if group is None:
+    try:
+        due_date = parse_timestamp(body["due_date"])
+    except ValueError:
+        return failure_response("Task due date must be a timestamp", 400)
+    if db.session.query(Group.id).filter(Group.id == group_id).first() is None:
         return failure_response("Group not found", 404)
     task = Task(
         task_name=body["task_name"],
         description=body["description"],
-        due_date=body["due_date"],
+        due_date=due_date,
         group_id=group_id,
     )
-    group.tasks.append(task)
     db.session.add(task)
+    db.session.flush()
+    data = task.serialize()
+    invalidate_on_commit("group:%d" % group_id, "groups")
     db.session.commit()
-    return success_response(group.serialize(), 201)
+    broker.publish("group:%d" % group_id, "task.created", data)
+    return write_response(mode, data, 201, "group", group_id, fieldset)
+
 
+@api.route("/groups/<int:group_id>/tasks/batch/", methods=["POST"])
+def create_tasks_batch(group_id):
+    """
+    Endpoint to create many tasks for a group in one transaction
+    """
 
-@app.route("/tasks/<int:task_id>/", methods=["PUT"])
+    body = json.loads(request.data)
+    group = Group.query.filter_by(id=group_id).first()
+    if group is None:
+        return failure_response("Group not found", 404)
+    try:
+        indexes, rows, errors = parse_batch(
+            body, TASK_FIELDS, TASK_PARSERS, group_id=group_id
+        )
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    ids = bulk_insert(Task, rows)
+    invalidate_on_commit("group:%d" % group_id, "groups")
+    db.session.commit()
+    if ids:
+        broker.publish("group:%d" % group_id, "task.batch_created", {"ids": ids})
+    return success_response(batch_result(len(body), indexes, ids, errors), 201)
+
+
+@api.route("/tasks/<int:task_id>/", methods=["PUT", "PATCH"])
 def update_task(task_id):
     """
     Endpoint to update a task
     """
 
+    try:
+        fieldset = parse_fieldset(Group, request.args)
+        mode = parse_return("parent" if request.method == "PUT" else "entity")
+    except ValueError as e:
+        return failure_response(str(e), 400)
     body = json.loads(request.data)
-    if "task_name" not in body and "description" not in body and "due_date" not in body:
+    values = {key: body[key] for key in ("task_name", "description") if key in body}
+    if "due_date" in body:
+        try:
+            values["due_date"] = parse_timestamp(body["due_date"])
+        except ValueError:
+            return failure_response("Task due date must be a timestamp", 400)
+    if not values:
         return failure_response(
             "Atleast one amongst task name, description, or due date is required", 400
         )
-    task = Task.query.filter_by(id=task_id).first()
-    if task is None:
+    if not Task.query.filter_by(id=task_id).update(values, synchronize_session=False):
         return failure_response("Task not found", 404)
-    group = Group.query.filter_by(id=task.group_id).first()
-    group.tasks.remove(task)
-    if "task_name" in body:
-        task.task_name = body["task_name"]
-    if "description" in body:
-        task.description = body["description"]
-    if "due_date" in body:
-        task.due_date = body["due_date"]
-    group.tasks.append(task)
+    task = Task.query.filter_by(id=task_id).first()
+    data = task.serialize()
+    group_id = data["group_id"]
+    invalidate_on_commit("task:%d" % task_id, "group:%d" % group_id, "groups")
     db.session.commit()
-    return success_response(group.serialize(), 200)
+    broker.publish("group:%d" % group_id, "task.updated", data)
+    return write_response(mode, data, 200, "group", group_id, fieldset)
 
 
-@app.route("/tasks/", methods=["GET"])
+@api.route("/tasks/", methods=["GET"])
+@admission_limit()
+@query_budget(1)
 def get_all_tasks():
     """
     Endpoint to get all tasks
     """
 
-    tasks = [task.serialize() for task in Task.query.all()]
-    return success_response({"tasks": tasks}, 200)
+    return list_response(
+        Task, "tasks", Task.serialize, filters=TASK_FILTERS, sort_columns=("due_date",)
+    )
 
 
-@app.route("/tasks/<int:task_id>/", methods=["GET"])
+@api.route("/tasks/<int:task_id>/", methods=["GET"])
+@query_budget(2)
+@cached("task:{task_id}")
 def get_specific_task(task_id):
     """
     Endpoint to get all task by specific id
     """
 
-    task = Task.query.filter_by(id=task_id).first()
-    if task is None:
-        return failure_response("Task not found", 404)
-    return success_response(task.serialize(), 200)
+    return detail_response(Task, task_id, "Task", Task.serialize)
 
 
-@app.route("/tasks/<int:task_id>/", methods=["DELETE"])
+@api.route("/tasks/<int:task_id>/", methods=["DELETE"])
+@query_budget(3)
 def delete_specific_task(task_id):
     """
     Endpoint to delete all task by specific id
@@ -252,22 +769,22 @@ def delete_specific_task(task_id):
     task = Task.query.filter_by(id=task_id).first()
     if task is None:
         return failure_response("Task not found", 404)
-    group = Group.query.filter_by(id=task.group_id).first()
-    group.tasks.remove(task)
     db.session.delete(task)
+    invalidate_on_commit("task:%d" % task.id, "group:%d" % task.group_id, "groups")
     db.session.commit()
+    broker.publish("group:%d" % task.group_id, "task.deleted", {"id": task.id})
     return success_response(task.serialize(), 200)
 
 
 # Post Routes: Create post, get all posts, get specific post by post id and delete specific post by post id
 
 
-@app.route("/posts/", methods=["POST"])
+@api.route("/posts/", methods=["POST"])
 def create_post():
     """
     Endpoint to create post
     """
-    
+
     body = json.loads(request.data)
     if "post_name" not in body:
         return failure_response("Post name is required", 400)
@@ -275,123 +792,248 @@ def create_post():
         return failure_response("Post description is required", 400)
     if "timestamp" not in body:
         return failure_response("Post timestamp is required", 400)
+    try:
+        timestamp = parse_timestamp(body["timestamp"])
+    except ValueError:
+        return failure_response("Post timestamp must be a timestamp", 400)
     post = Post(
         post_name=body["post_name"],
         description=body["description"],
-        timestamp=body["timestamp"],
+        timestamp=timestamp,
     )
     db.session.add(post)
+    db.session.flush()
+    index_post(post)
+    invalidate_on_commit("posts")
     db.session.commit()
     return success_response(post.serialize(), 201)
 
 
-@app.route("/posts/", methods=["GET"])
+@api.route("/posts/", methods=["GET"])
+@admission_limit()
+@query_budget(3)
+@cached("posts")
 def get_posts():
     """
     Endpoint to get all posts
     """
-    posts = [post.serialize() for post in Post.query.all()]
-    return success_response({"posts": posts}, 200)
+    try:
+        model = archived_view(Post, AnyPost)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    return list_response(
+        model,
+        "posts",
+        model.serialize,
+        selectinload(model.comments),
+        filters=rebind_filters(POST_FILTERS, model),
+        sort_columns=("timestamp",),
+    )
 
 
-@app.route("/posts/<int:post_id>/", methods=["GET"])
+@api.route("/posts/<int:post_id>/", methods=["GET"])
+@query_budget(4)
+@cached("post:{post_id}")
 def get_post(post_id):
     """
-    Endpoint to get post 
+    Endpoint to get post
     """
 
-    post = Post.query.filter_by(id=post_id).first()
-    if post is None:
-        return failure_response("Post not found", 404)
-    return success_response(post.serialize(), 200)
+    try:
+        model = archived_view(Post, AnyPost)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    if model is AnyPost:
+        # archived posts are never changed, so they have no stored document
+        return detail_response(
+            AnyPost, post_id, "Post", AnyPost.serialize, selectinload(AnyPost.comments)
+        )
+    return detail_response(
+        Post, post_id, "Post", Post.serialize, joinedload(Post.comments), kind="post"
+    )
+
+
+@api.route("/posts/<int:post_id>/changes/", methods=["GET"])
+@query_budget(3)
+def get_post_changes(post_id):
+    """
+    Endpoint to get the comments of a post changed since a cursor
+    """
+
+    return changes_response(Post, post_id, "Post", post_changes)
 
 
-@app.route("/posts/<int:post_id>/", methods=["DELETE"])
+@api.route("/posts/<int:post_id>/stream/", methods=["GET"])
+@query_budget(1)
+def stream_post_events(post_id):
+    """
+    Endpoint to stream comment changes of a post as server-sent events
+    """
+
+    return event_stream(Post, post_id, "Post", "post:%d" % post_id)
+
+
+@api.route("/posts/<int:post_id>/", methods=["DELETE"])
+@query_budget(6)
 def delete_post(post_id):
     """
     Endpoint to delete post by id
     """
 
-    post = Post.query.filter_by(id=post_id).first()
+    post = Post.query.options(joinedload(Post.comments)).filter_by(id=post_id).first()
     if post is None:
         return failure_response("Post not found", 404)
-    db.session.delete(post)
+    data = post.serialize()
+    unindex_post(post.id)
+    Comment.query.filter_by(post_id=post.id).delete(synchronize_session=False)
+    Post.query.filter_by(id=post.id).delete(synchronize_session=False)
+    invalidate_on_commit("post:%d" % post_id, "posts")
     db.session.commit()
-    return success_response(post.serialize(), 200)
+    broker.publish("post:%d" % post_id, "post.deleted", {"id": post_id})
+    return success_response(data, 200)
 
 
 # Comments routes: Create comment for particular post id, update comment for particular comment id, get all tasks, get specific comment by comment id, and delete specific comment by comment id
 
 
-@app.route("/posts/<int:post_id>/comments/", methods=["POST"])
+@api.route("/posts/<int:post_id>/comments/", methods=["POST"])
 def create_comment(post_id):
     """
     Endpoint to create comment
     """
 
+    try:
+        fieldset = parse_fieldset(Post, request.args)
+        mode = parse_return("parent")
+    except ValueError as e:
+        return failure_response(str(e), 400)
     body = json.loads(request.data)
     if "description" not in body:
         return failure_response("Comment description is required", 400)
     if "timestamp" not in body:
         return failure_response("Comment timestamp is required", 400)
-    post = Post.query.filter_by(id=post_id).first()
-    if post is None:
+    try:
+        timestamp = parse_timestamp(body["timestamp"])
+    except ValueError:
+        return failure_response("Comment timestamp must be a timestamp", 400)
+    if db.session.query(Post.id).filter(Post.id == post_id).first() is None:
         return failure_response("Post not found", 404)
     comment = Comment(
-        description=body["description"], timestamp=body["timestamp"], post_id=post_id
+        description=body["description"], timestamp=timestamp, post_id=post_id
     )
-    post.comments.append(comment)
     db.session.add(comment)
+    db.session.flush()
+    index_comments([comment.id])
+    data = comment.serialize_with_post()
+    invalidate_on_commit("post:%d" % post_id, "posts")
     db.session.commit()
-    return success_response(post.serialize(), 201)
+    broker.publish("post:%d" % post_id, "comment.created", data)
+    return write_response(mode, data, 201, "post", post_id, fieldset)
+
 
+@api.route("/posts/<int:post_id>/comments/batch/", methods=["POST"])
+def create_comments_batch(post_id):
+    """
+    Endpoint to create many comments for a post in one transaction
+    """
 
-@app.route("/comments/<int:comment_id>/", methods=["PUT"])
+    body = json.loads(request.data)
+    post = Post.query.filter_by(id=post_id).first()
+    if post is None:
+        return failure_response("Post not found", 404)
+    try:
+        indexes, rows, errors = parse_batch(
+            body, COMMENT_FIELDS, COMMENT_PARSERS, post_id=post_id
+        )
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    ids = bulk_insert(Comment, rows)
+    if ids:
+        index_comments(ids)
+    invalidate_on_commit("post:%d" % post_id, "posts")
+    db.session.commit()
+    if ids:
+        broker.publish("post:%d" % post_id, "comment.batch_created", {"ids": ids})
+    return success_response(batch_result(len(body), indexes, ids, errors), 201)
+
+
+@api.route("/comments/<int:comment_id>/", methods=["PUT", "PATCH"])
 def update_comment(comment_id):
     """
-    Endpoint to update comment
+    Endpoint to update comment. PUT replaces both the description and the
+    timestamp, PATCH any of them.
     """
 
+    try:
+        fieldset = parse_fieldset(Post, request.args)
+        mode = parse_return("parent" if request.method == "PUT" else "entity")
+    except ValueError as e:
+        return failure_response(str(e), 400)
     body = json.loads(request.data)
-    if "description" not in body:
+    if request.method == "PUT" and "description" not in body:
         return failure_response("Comment description is required", 400)
-    if "timestamp" not in body:
+    if request.method == "PUT" and "timestamp" not in body:
         return failure_response("Comment timestamp is required", 400)
-    comment = Comment.query.filter_by(id=comment_id).first()
-    if comment is None:
+    values = {key: body[key] for key in ("description",) if key in body}
+    if "timestamp" in body:
+        try:
+            values["timestamp"] = parse_timestamp(body["timestamp"])
+        except ValueError:
+            return failure_response("Comment timestamp must be a timestamp", 400)
+    if not values:
+        return failure_response(
+            "At least one of comment description or timestamp is required", 400
+        )
+    query = Comment.query.filter_by(id=comment_id)
+    if not query.update(values, synchronize_session=False):
         return failure_response("Comment not found", 404)
-    post = Post.query.filter_by(id=comment.post_id).first()
-    post.comments.remove(comment)
-    comment.description = body["description"]
-    comment.timestamp = body["timestamp"]
-    post.comments.append(comment)
+    if "description" in values:
+        index_comments([comment_id])
+    data = query.first().serialize_with_post()
+    post_id = data["post_id"]
+    invalidate_on_commit("post:%d" % post_id, "posts")
     db.session.commit()
-    return success_response(post.serialize(), 200)
+    broker.publish("post:%d" % post_id, "comment.updated", data)
+    return write_response(mode, data, 200, "post", post_id, fieldset)
 
 
-@app.route("/comments/", methods=["GET"])
+@api.route("/comments/", methods=["GET"])
+@admission_limit()
+@query_budget(1)
 def get_all_comments():
     """
     Endpoint to get all comments
     """
 
-    comments = [comment.serialize_with_post() for comment in Comment.query.all()]
-    return success_response({"comments": comments}, 200)
+    try:
+        model = archived_view(Comment, AnyComment)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    return list_response(
+        model,
+        "comments",
+        model.serialize_with_post,
+        filters=rebind_filters(COMMENT_FILTERS, model),
+        sort_columns=("timestamp",),
+    )
 
 
-@app.route("/comments/<int:comment_id>/", methods=["GET"])
+@api.route("/comments/<int:comment_id>/", methods=["GET"])
+@query_budget(1)
 def get_specific_comment(comment_id):
     """
     Endpoint to get all comment by id
     """
 
-    comment = Comment.query.filter_by(id=comment_id).first()
-    if comment is None:
-        return failure_response("Comment not found", 404)
-    return success_response(comment.serialize_with_post(), 200)
+    try:
+        model = archived_view(Comment, AnyComment)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    return detail_response(model, comment_id, "Comment", model.serialize_with_post)
 
 
-@app.route("/comments/<int:comment_id>/", methods=["DELETE"])
+@api.route("/comments/<int:comment_id>/", methods=["DELETE"])
+@query_budget(4)
 def delete_specific_comment(comment_id):
     """
     Endpoint to delete comment by id
@@ -400,12 +1042,136 @@ def delete_specific_comment(comment_id):
     comment = Comment.query.filter_by(id=comment_id).first()
     if comment is None:
         return failure_response("Comment not found", 404)
-    post = Post.query.filter_by(id=comment.post_id).first()
-    post.comments.remove(comment)
     db.session.delete(comment)
+    unindex_comment(comment.id)
+    invalidate_on_commit("post:%d" % comment.post_id, "posts")
     db.session.commit()
+    broker.publish("post:%d" % comment.post_id, "comment.deleted", {"id": comment.id})
     return success_response(comment.serialize_with_post(), 200)
 
 
+# Search routes: Full-text search over posts and comments
+
+
+@api.route("/search", methods=["GET"])
+@admission_limit()
+@query_budget(1)
+def search_posts_and_comments():
+    """
+    Endpoint to search posts and comments, ranked by relevance
+    """
+
+    q = request.args.get("q", "")
+    kind = request.args.get("type")
+    limit = request.args.get("limit", str(SEARCH_PAGE_SIZE))
+    after = request.args.get("after", "0")
+    if not q.strip():
+        return failure_response("Search query is required", 400)
+    if kind is not None and kind not in SEARCH_KINDS:
+        return failure_response("type must be post or comment", 400)
+    if not limit.isdigit() or int(limit) < 1:
+        return failure_response("limit must be a positive integer", 400)
+    if not after.isdigit():
+        return failure_response("after must be a cursor returned as next_cursor", 400)
+    try:
+        archived = parse_archived(request.args)
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    limit = min(int(limit), MAX_PAGE_SIZE)
+    results = search(q, kind, limit + 1, int(after), archived)
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = int(after) + limit
+    return success_response({"results": results, "next_cursor": next_cursor}, 200)
+
+
+# Cache routes: Get response cache, event stream and admission counters
+
+
+@api.route("/cache/stats/", methods=["GET"])
+def get_cache_stats():
+    """
+    Endpoint to get response cache hit, miss and eviction counters
+    """
+
+    return success_response(response_cache.stats(), 200)
+
+
+@api.route("/events/stats/", methods=["GET"])
+def get_event_stats():
+    """
+    Endpoint to get event stream subscriber and delivery counters
+    """
+
+    return success_response(broker.stats(), 200)
+
+
+@api.route("/admission/stats/", methods=["GET"])
+def get_admission_stats():
+    """
+    Endpoint to get admission decisions, busy slots and waiting requests of
+    the limited routes
+    """
+
+    return success_response(admission.stats(), 200)
+
+
+# Metrics routes: Get request metrics
+
+
+@api.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Endpoint to get per route request metrics and admission decisions in
+    Prometheus text format
+    """
+
+    return Response(
+        metrics.render() + admission.render(), content_type=PROMETHEUS_MIMETYPE
+    )
+
+
+def create_app(config=None):
+    """
+    Builds the app from config and STUDYMATCH_ environment variables
+
+    Building the app opens no database connection and runs no DDL, so it is
+    cheap and safe to do before forking workers: each process connects on
+    its first query. The schema is created and migrated by flask migrate,
+    or at startup when AUTO_MIGRATE is set.
+
+    Every app gets its own JSON encoder, admission control, response cache
+    and pub/sub broker in app.extensions, so several apps can live in one
+    process. Request metrics are counted per process.
+    """
+
+    app = Flask(__name__)
+    app.config["DB_PATH"] = db_filename
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["AUTO_MIGRATE"] = False
+    app.config.update(config or {})
+
+    init_storage(app, db)
+    init_encoding(app)
+    init_query_budget(app)
+    init_metrics(app)
+    init_admission(app)
+    init_response_cache(app)
+    init_migrations(app, db)
+    init_counters(app)
+    init_documents(app)
+    init_search(app)
+    init_pubsub(app)
+    init_transfer(app)
+    init_archive(app)
+    app.register_blueprint(api)
+    if app.config["AUTO_MIGRATE"]:
+        with app.app_context():
+            db.create_all()
+            migrate(db.engine)
+    return app
+
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000, debug=True)
+    create_app({"AUTO_MIGRATE": True}).run(host="0.0.0.0", port=8000, debug=True)
@@ -0,0 +1,259 @@
+from datetime import datetime, timedelta
+
+import click
+from db import ArchivedComment, ArchivedPost, Comment, Post, db
+from response_cache import log_invalidation
+from sqlalchemy import or_, select
+from timestamps import format_timestamp, parse_timestamp
+
+# Old posts move, with their comments, from posts and comments into
+# posts_archive and comments_archive, so the hot tables every list, detail
+# and search read touches stay small. Each batch is one transaction that
+# copies the rows and then deletes them, comments first, so the counter,
+# change tracking and document triggers clean up after the post exactly as
+# a DELETE /posts/<id>/ does. Archived rows keep their ids and their search
+# index entries, and are read back with ?include_archived=true. The moved
+# posts' cache tags are logged for every server's response cache.
+ARCHIVE_AFTER_DAYS = 365
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_VALUES = ("true", "false")
+
+# The schema migration 8 creates, written out so later model changes never
+# change what it does
+CREATE_ARCHIVE = [
+    "CREATE TABLE IF NOT EXISTS posts_archive (id INTEGER NOT NULL, post_name"
+    " VARCHAR NOT NULL, description VARCHAR NOT NULL, timestamp DATETIME NOT"
+    " NULL, comment_count INTEGER DEFAULT '0' NOT NULL, PRIMARY KEY (id))",
+    "CREATE INDEX IF NOT EXISTS ix_posts_archive_timestamp ON posts_archive"
+    " (timestamp)",
+    "CREATE TABLE IF NOT EXISTS comments_archive (id INTEGER NOT NULL,"
+    " description VARCHAR NOT NULL, timestamp DATETIME NOT NULL, post_id"
+    " INTEGER NOT NULL, PRIMARY KEY (id), FOREIGN KEY(post_id) REFERENCES"
+    " posts_archive (id))",
+    "CREATE INDEX IF NOT EXISTS ix_comments_archive_timestamp ON"
+    " comments_archive (timestamp)",
+    "CREATE INDEX IF NOT EXISTS ix_comments_archive_post_id ON comments_archive"
+    " (post_id)",
+]
+# table -> (its columns, its CREATE TABLE with an AUTOINCREMENT id, named %s)
+AUTOINCREMENT_TABLES = {
+    "posts": (
+        "id, post_name, description, timestamp, comment_count",
+        "CREATE TABLE %s (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,"
+        " post_name VARCHAR NOT NULL, description VARCHAR NOT NULL, timestamp"
+        " DATETIME NOT NULL, comment_count INTEGER DEFAULT '0' NOT NULL)",
+    ),
+    "comments": (
+        "id, description, timestamp, post_id, version",
+        "CREATE TABLE %s (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,"
+        " description VARCHAR NOT NULL, timestamp DATETIME NOT NULL, post_id"
+        " INTEGER NOT NULL, version INTEGER DEFAULT '0' NOT NULL,"
+        " FOREIGN KEY(post_id) REFERENCES posts (id))",
+    ),
+}
+
+
+def add_autoincrement(conn, table):
+    """
+    Rebuilds table, one of AUTOINCREMENT_TABLES, with an AUTOINCREMENT id,
+    so SQLite never hands out the id of a row that was deleted or archived
+    again, and restores its indexes and triggers. Copies the whole table
+    once; tables created with AUTOINCREMENT are left alone.
+    """
+
+    sql = conn.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (table,),
+    ).scalar()
+    if "AUTOINCREMENT" in sql.upper():
+        return
+    dependents = conn.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type IN ('index', 'trigger')"
+        " AND tbl_name = ? AND sql IS NOT NULL",
+        (table,),
+    ).fetchall()
+    rebuilt = table + "_rebuild"
+    columns, create = AUTOINCREMENT_TABLES[table]
+    # left behind by a rebuild that was interrupted before migrations ran
+    # in a transaction of their own
+    conn.exec_driver_sql("DROP TABLE IF EXISTS %s" % rebuilt)
+    conn.exec_driver_sql(create % rebuilt)
+    conn.exec_driver_sql(
+        "INSERT INTO %s (%s) SELECT %s FROM %s" % (rebuilt, columns, columns, table)
+    )
+    conn.exec_driver_sql("DROP TABLE %s" % table)
+    # the triggers of other tables name this table, which does not exist
+    # until the rename, so the rename must not check them
+    conn.exec_driver_sql("PRAGMA legacy_alter_table = ON")
+    conn.exec_driver_sql("ALTER TABLE %s RENAME TO %s" % (rebuilt, table))
+    conn.exec_driver_sql("PRAGMA legacy_alter_table = OFF")
+    for (statement,) in dependents:
+        conn.exec_driver_sql(statement)
+
+
+def reserve_archived_ids(conn):
+    """
+    Moves the id sequences of posts and comments past every archived id,
+    for archive rows that were loaded rather than archived here
+    """
+
+    for table, archive in [
+        ("posts", "posts_archive"),
+        ("comments", "comments_archive"),
+    ]:
+        top = conn.exec_driver_sql("SELECT MAX(id) FROM %s" % archive).scalar()
+        if top is None:
+            continue
+        seq = conn.exec_driver_sql(
+            "SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)
+        ).fetchone()
+        if seq is None:
+            conn.exec_driver_sql(
+                "INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, top)
+            )
+        elif seq[0] < top:
+            conn.exec_driver_sql(
+                "UPDATE sqlite_sequence SET seq = ? WHERE name = ?", (top, table)
+            )
+
+
+def add_archive(conn):
+    """
+    Creates the archive tables and gives posts and comments ids that are
+    never reused, so archived and hot ids never collide
+    """
+
+    for statement in CREATE_ARCHIVE:
+        conn.exec_driver_sql(statement)
+    add_autoincrement(conn, "posts")
+    add_autoincrement(conn, "comments")
+    reserve_archived_ids(conn)
+
+
+def archivable_posts(conn, cutoff, after, limit):
+    """
+    Returns the (id, timestamp) of at most limit posts past after, in
+    timestamp order, that are older than cutoff and whose comments are all
+    older than cutoff too
+    """
+
+    recent = (
+        select(Comment.id)
+        .where(Comment.post_id == Post.id, Comment.timestamp >= cutoff)
+        .exists()
+    )
+    query = select(Post.id, Post.timestamp).where(Post.timestamp < cutoff, ~recent)
+    if after is not None:
+        timestamp, last_id = after
+        # a range on the timestamp index, with the id as tiebreak
+        query = query.where(
+            Post.timestamp >= timestamp,
+            or_(Post.timestamp > timestamp, Post.id > last_id),
+        )
+    query = query.order_by(Post.timestamp, Post.id).limit(limit)
+    return conn.execute(query).fetchall()
+
+
+def archive_batch(conn, post_ids):
+    """
+    Moves posts and their comments into the archive tables, logs their
+    cache tags, and returns the number of comments moved
+    """
+
+    archived_posts = ArchivedPost.__table__.insert().from_select(
+        ["id", "post_name", "description", "timestamp", "comment_count"],
+        select(
+            Post.id,
+            Post.post_name,
+            Post.description,
+            Post.timestamp,
+            Post.comment_count,
+        ).where(Post.id.in_(post_ids)),
+    )
+    archived_comments = ArchivedComment.__table__.insert().from_select(
+        ["id", "description", "timestamp", "post_id"],
+        select(
+            Comment.id, Comment.description, Comment.timestamp, Comment.post_id
+        ).where(Comment.post_id.in_(post_ids)),
+    )
+    conn.execute(archived_posts)
+    comments = conn.execute(archived_comments).rowcount
+    conn.execute(Comment.__table__.delete().where(Comment.post_id.in_(post_ids)))
+    conn.execute(Post.__table__.delete().where(Post.id.in_(post_ids)))
+    log_invalidation(conn, ["posts"] + ["post:%d" % post_id for post_id in post_ids])
+    return comments
+
+
+def archive_posts(engine, cutoff, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Archives every post older than cutoff whose comments are all older
+    than cutoff too, batch_size posts per transaction, and yields the
+    (posts, comments) moved by each batch
+    """
+
+    after = None
+    while True:
+        with engine.begin() as conn:
+            # take the write lock up front, so the batch chosen is the
+            # batch moved
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            rows = archivable_posts(conn, cutoff, after, batch_size)
+            if not rows:
+                return
+            comments = archive_batch(conn, [row.id for row in rows])
+        yield len(rows), comments
+        after = rows[-1].timestamp, rows[-1].id
+
+
+def parse_archived(args):
+    """
+    Parses the include_archived query parameter into a bool. Raises
+    ValueError on anything but true or false.
+    """
+
+    value = args.get("include_archived", "false")
+    if value not in ARCHIVE_VALUES:
+        raise ValueError("include_archived must be one of: true, false")
+    return value == "true"
+
+
+def init_archive(app):
+    """
+    Reads ARCHIVE_AFTER_DAYS, the default age of posts flask archive moves,
+    and registers the flask archive command
+    """
+
+    app.config.setdefault("ARCHIVE_AFTER_DAYS", ARCHIVE_AFTER_DAYS)
+
+    @app.cli.command("archive")
+    @click.option(
+        "--before",
+        help="Archive posts older than this timestamp instead of"
+        " ARCHIVE_AFTER_DAYS days.",
+    )
+    @click.option("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    def archive_command(before, batch_size):
+        """
+        Moves old posts and their comments into the archive tables. A post
+        is archived once it and every comment on it are older than the
+        cutoff. Servers with the response cache on stop serving moved posts
+        from it within RESPONSE_CACHE_SYNC_SECONDS.
+        """
+
+        if before is None:
+            days = int(app.config["ARCHIVE_AFTER_DAYS"])
+            cutoff = datetime.utcnow() - timedelta(days=days)
+        else:
+            try:
+                cutoff = parse_timestamp(before)
+            except ValueError as e:
+                raise click.BadParameter(str(e), param_hint="--before")
+        if batch_size < 1:
+            raise click.BadParameter("must be at least 1", param_hint="--batch-size")
+        click.echo("Archiving posts older than %s" % format_timestamp(cutoff))
+        posts = comments = 0
+        for moved_posts, moved_comments in archive_posts(db.engine, cutoff, batch_size):
+            posts += moved_posts
+            comments += moved_comments
+            click.echo("  %d posts, %d comments" % (posts, comments), err=True)
+        click.echo("Archived %d posts and %d comments" % (posts, comments))
@@ -0,0 +1,154 @@
+from db import db
+from sqlalchemy import func, select
+from timestamps import parse_timestamp
+
+MAX_BATCH_SIZE = 5000
+LOOKUP_CHUNK_SIZE = 500
+
+# required body key -> error message, per batch endpoint
+USER_FIELDS = {"name": "User name is required", "netid": "User netid is required"}
+TASK_FIELDS = {
+    "task_name": "Task name is required",
+    "description": "Task description is required",
+    "due_date": "Task due date is required",
+}
+COMMENT_FIELDS = {
+    "description": "Comment description is required",
+    "timestamp": "Comment timestamp is required",
+}
+
+
+def parse_text(value):
+    """
+    Returns value when it is a string. Raises ValueError otherwise.
+    """
+
+    if not isinstance(value, str):
+        raise ValueError("Expected a string")
+    return value
+
+
+# body key -> (parse, error message), checking types and converting values
+# stored in another type
+USER_PARSERS = {
+    "name": (parse_text, "User name must be a string"),
+    "netid": (parse_text, "User netid must be a string"),
+}
+TASK_PARSERS = {
+    "task_name": (parse_text, "Task name must be a string"),
+    "description": (parse_text, "Task description must be a string"),
+    "due_date": (parse_timestamp, "Task due date must be a timestamp"),
+}
+COMMENT_PARSERS = {
+    "description": (parse_text, "Comment description must be a string"),
+    "timestamp": (parse_timestamp, "Comment timestamp must be a timestamp"),
+}
+
+
+def parse_batch(body, required, parsers, **defaults):
+    """
+    Validates every item of a batch body against required and converts
+    values with parsers
+
+    Returns (indexes, rows, errors): the input index and column values of
+    every valid item, and an {"index", "error"} entry for every invalid
+    one. defaults are added to every row. Raises ValueError when the body
+    itself is not a usable batch.
+    """
+
+    if not isinstance(body, list):
+        raise ValueError("A list of items is required")
+    if len(body) > MAX_BATCH_SIZE:
+        raise ValueError("At most %d items are allowed per batch" % MAX_BATCH_SIZE)
+    indexes, rows, errors = [], [], []
+    for index, item in enumerate(body):
+        if not isinstance(item, dict):
+            errors.append({"index": index, "error": "Item must be an object"})
+            continue
+        missing = [message for key, message in required.items() if key not in item]
+        if missing:
+            errors.append({"index": index, "error": missing[0]})
+            continue
+        row = {key: item[key] for key in required}
+        try:
+            for key, (parse, message) in parsers.items():
+                row[key] = parse(row[key])
+        except ValueError:
+            errors.append({"index": index, "error": message})
+            continue
+        row.update(defaults)
+        indexes.append(index)
+        rows.append(row)
+    return indexes, rows, errors
+
+
+def reject_duplicates(column, key, indexes, rows, errors, message):
+    """
+    Drops rows whose value for key repeats an earlier row or already exists
+    in column, adding an error for each, and returns the remaining
+    (indexes, rows)
+
+    Existing values are looked up in chunks of the unique index on column.
+    """
+
+    values = [row[key] for row in rows]
+    existing = set()
+    for start in range(0, len(values), LOOKUP_CHUNK_SIZE):
+        chunk = values[start : start + LOOKUP_CHUNK_SIZE]
+        existing.update(
+            value for (value,) in db.session.query(column).filter(column.in_(chunk))
+        )
+    kept_indexes, kept_rows = [], []
+    for index, row in zip(indexes, rows):
+        if row[key] in existing:
+            errors.append({"index": index, "error": message})
+            continue
+        existing.add(row[key])
+        kept_indexes.append(index)
+        kept_rows.append(row)
+    errors.sort(key=lambda error: error["index"])
+    return kept_indexes, kept_rows
+
+
+def fetch_by(model, column, values):
+    """
+    Loads the rows of model whose unique column holds one of values and
+    returns them as {value: row}
+
+    Rows are looked up in chunks of the unique index on column.
+    """
+
+    found = {}
+    for start in range(0, len(values), LOOKUP_CHUNK_SIZE):
+        chunk = values[start : start + LOOKUP_CHUNK_SIZE]
+        for row in model.query.filter(column.in_(chunk)):
+            found[getattr(row, column.key)] = row
+    return found
+
+
+def bulk_insert(model, rows):
+    """
+    Inserts rows into model's table with a single executemany INSERT and
+    returns the new ids in order
+
+    The INSERT takes SQLite's write lock, which is held until commit, so no
+    other writer can interleave and the new rows hold the highest ids.
+    """
+
+    if not rows:
+        return []
+    db.session.execute(model.__table__.insert(), rows)
+    last_id = db.session.execute(select(func.max(model.id))).scalar()
+    return list(range(last_id - len(rows) + 1, last_id + 1))
+
+
+def batch_result(size, indexes, ids, errors):
+    """
+    Compact batch response: one id per input item, None where the item
+    failed, plus the per-item errors
+    """
+
+    result = [None] * size
+    for index, new_id in zip(indexes, ids):
+        result[index] = new_id
+    return {"ids": result, "errors": errors}
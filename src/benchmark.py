@@ -0,0 +1,893 @@
+"""
+Load and benchmark suite for the StudyMatch API
+
+Seeds a synthetic dataset into a scratch SQLite file, drives every route
+through the Flask test client from several threads and writes per route
+throughput, latency percentiles, SQL statements per request and peak RSS as
+JSON. Given a baseline from an earlier run, it exits with status 1 when a
+route got slower than the allowed threshold.
+
+    python benchmark.py --scale small --out bench.json
+    python benchmark.py --scale small --baseline bench.json --threshold 1.25
+    python benchmark.py --scale campus --matching
+    python benchmark.py --scale tiny --startup --workers 4
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from migrations import STORED_TIMESTAMP_FORMAT
+from search import INDEX_COMMENTS, INDEX_POSTS
+
+# dataset sizes per scale: users, groups, tasks, posts, comments
+SCALES = {
+    "tiny": (500, 50, 2000, 200, 5000),
+    "small": (5000, 500, 20000, 5000, 100000),
+    "campus": (50000, 5000, 200000, 50000, 1000000),
+}
+SCALE_KEYS = ("users", "groups", "tasks", "posts", "comments")
+EPOCH = datetime(2024, 1, 1)
+SLOTS = ["%s-%s" % (day, part) for day in "mtwrfsu" for part in ("am", "pm", "ev")]
+SEED_CHUNK_SIZE = 10000
+# run in a fresh interpreter per cold start: times the import and create_app,
+# counts statements create_app issues and serves one request
+STARTUP_PROBE = """
+import json, resource, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = []
+event.listen(Engine, "before_cursor_execute", lambda *args: statements.append(1))
+app = create_app()
+created = time.perf_counter()
+startup_statements = len(statements)
+status = app.test_client().get("/groups/1/").status_code
+served = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "first_request_ms": (served - created) * 1000,
+    "startup_statements": startup_statements,
+    "status": status,
+    "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+}))
+"""
+
+
+def chunked(rows, size=SEED_CHUNK_SIZE):
+    """
+    Yields lists of at most size rows from an iterable
+    """
+
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def stamp(rng, days):
+    """
+    A random stored timestamp within days of EPOCH
+    """
+
+    moment = EPOCH + timedelta(seconds=rng.randrange(days * 86400))
+    return moment.strftime(STORED_TIMESTAMP_FORMAT)
+
+
+def seed(path, counts, spare, rng):
+    """
+    Bulk loads the synthetic dataset straight through sqlite3 in one
+    transaction, then backfills the search index
+
+    Ids are assigned in order, so the first counts rows of every table are
+    the dataset and the spare rows after them are reserved for the delete
+    scenarios: empty groups, unassigned users, tasks of group 1, posts
+    without comments and comments of post 1.
+    """
+
+    users, groups, tasks, posts, comments = counts
+    catalog = ["C%d" % i for i in range(max(20, groups // 2))]
+    capacity = -(-users * 3 // (groups * 2))
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO groups (id, name, courses, availability, capacity)"
+        " VALUES (?, ?, ?, ?, ?)",
+        (
+            (
+                i,
+                "Study group %d" % i,
+                ",".join(sorted(rng.sample(catalog, 2))),
+                ",".join(sorted(rng.sample(SLOTS, 3))),
+                capacity,
+            )
+            for i in range(1, groups + spare + 1)
+        ),
+    )
+    for chunk in chunked(
+        (
+            i,
+            "Student %d" % i,
+            "s%d" % i,
+            (i % groups) + 1 if i <= users and i % 10 else None,
+            ",".join(sorted(rng.sample(catalog, 4))),
+            ",".join(sorted(rng.sample(SLOTS, 5))),
+        )
+        for i in range(1, users + spare + 1)
+    ):
+        conn.executemany(
+            "INSERT INTO users (id, name, netid, group_id, courses, availability)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            chunk,
+        )
+    for chunk in chunked(
+        (
+            i,
+            "Task %d" % i,
+            "Read chapter %d and do the problem set" % (i % 40),
+            stamp(rng, 120),
+            (i % groups) + 1 if i <= tasks else 1,
+        )
+        for i in range(1, tasks + spare + 1)
+    ):
+        conn.executemany(
+            "INSERT INTO tasks (id, task_name, description, due_date, group_id)"
+            " VALUES (?, ?, ?, ?, ?)",
+            chunk,
+        )
+    subjects = ["calculus", "physics", "algorithms", "chemistry", "economics"]
+    conn.executemany(
+        "INSERT INTO posts (id, post_name, description, timestamp)"
+        " VALUES (?, ?, ?, ?)",
+        (
+            (
+                i,
+                "Looking for %s partners" % subjects[i % len(subjects)],
+                "Anyone studying %s this week?" % subjects[(i * 7) % len(subjects)],
+                stamp(rng, 120),
+            )
+            for i in range(1, posts + spare + 1)
+        ),
+    )
+    for chunk in chunked(
+        (
+            i,
+            "Count me in for %s" % subjects[i % len(subjects)],
+            stamp(rng, 120),
+            (i % posts) + 1 if i <= comments else 1,
+        )
+        for i in range(1, comments + spare + 1)
+    ):
+        conn.executemany(
+            "INSERT INTO comments (id, description, timestamp, post_id)"
+            " VALUES (?, ?, ?, ?)",
+            chunk,
+        )
+    conn.execute(INDEX_POSTS)
+    conn.execute(INDEX_COMMENTS)
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def scenarios(counts, spare):
+    """
+    Returns (name, method, url, body) request factories for every route.
+    url and body are called with a random generator for each request.
+    """
+
+    users, groups, tasks, posts, comments = counts
+    netids = itertools.count()
+    spares = {
+        name: itertools.count(first)
+        for name, first in [
+            ("group", groups + 1),
+            ("user", users + 1),
+            ("task", tasks + 1),
+            ("post", posts + 1),
+            ("comment", comments + 1),
+        ]
+    }
+    lock = threading.Lock()
+
+    def spare_id(name):
+        with lock:
+            return next(spares[name])
+
+    def new_netid():
+        with lock:
+            return "bench%d-%d" % (os.getpid(), next(netids))
+
+    task_body = lambda rng: {
+        "task_name": "Bench task",
+        "description": "Generated by the benchmark",
+        "due_date": "2024-02-%02dT12:00:00Z" % rng.randint(1, 28),
+    }
+    comment_body = lambda rng: {
+        "description": "Generated by the benchmark",
+        "timestamp": "2024-03-01T12:00:00Z",
+    }
+    no_body = lambda rng: None
+    return [
+        (
+            "POST /users/",
+            "POST",
+            lambda rng: "/users/",
+            lambda rng: {"name": "Bench", "netid": new_netid()},
+        ),
+        (
+            "POST /users/batch/",
+            "POST",
+            lambda rng: "/users/batch/",
+            lambda rng: [{"name": "Bench", "netid": new_netid()} for _ in range(50)],
+        ),
+        (
+            "PUT /users/<id>/",
+            "PUT",
+            lambda rng: "/users/%d/" % rng.randint(1, users),
+            lambda rng: {"group_id": rng.randint(1, groups)},
+        ),
+        (
+            "PATCH /users/<id>/",
+            "PATCH",
+            lambda rng: "/users/%d/" % rng.randint(1, users),
+            lambda rng: {"group_id": rng.randint(1, groups)},
+        ),
+        ("GET /users/", "GET", lambda rng: "/users/?limit=100", no_body),
+        (
+            "GET /users/<id>/",
+            "GET",
+            lambda rng: "/users/%d/" % rng.randint(1, users),
+            no_body,
+        ),
+        (
+            "GET /users/by-netid/<netid>/",
+            "GET",
+            lambda rng: "/users/by-netid/s%d/" % rng.randint(1, users),
+            no_body,
+        ),
+        (
+            "POST /users/lookup",
+            "POST",
+            lambda rng: "/users/lookup",
+            lambda rng: {"netids": ["s%d" % rng.randint(1, users) for _ in range(100)]},
+        ),
+        (
+            "DELETE /users/<id>/",
+            "DELETE",
+            lambda rng: "/users/%d/" % spare_id("user"),
+            no_body,
+        ),
+        (
+            "POST /groups/",
+            "POST",
+            lambda rng: "/groups/",
+            lambda rng: {"name": "Bench group"},
+        ),
+        ("GET /groups/", "GET", lambda rng: "/groups/?limit=100", no_body),
+        (
+            "GET /groups/?view=summary",
+            "GET",
+            lambda rng: "/groups/?view=summary&limit=100",
+            no_body,
+        ),
+        (
+            "GET /groups/<id>/",
+            "GET",
+            lambda rng: "/groups/%d/" % rng.randint(1, groups),
+            no_body,
+        ),
+        (
+            "GET /groups/<id>/users/",
+            "GET",
+            lambda rng: "/groups/%d/users/?limit=100" % rng.randint(1, groups),
+            no_body,
+        ),
+        (
+            "GET /groups/<id>/tasks/",
+            "GET",
+            lambda rng: "/groups/%d/tasks/?limit=100&order=due_date"
+            % rng.randint(1, groups),
+            no_body,
+        ),
+        (
+            "GET /groups/<id>/changes/",
+            "GET",
+            lambda rng: "/groups/%d/changes/?since=0&limit=100"
+            % rng.randint(1, groups),
+            no_body,
+        ),
+        (
+            "DELETE /groups/<id>/",
+            "DELETE",
+            lambda rng: "/groups/%d/" % spare_id("group"),
+            no_body,
+        ),
+        (
+            "POST /groups/<id>/tasks/",
+            "POST",
+            lambda rng: "/groups/%d/tasks/" % rng.randint(1, groups),
+            task_body,
+        ),
+        (
+            "POST /groups/<id>/tasks/?return=minimal",
+            "POST",
+            lambda rng: "/groups/%d/tasks/?return=minimal" % rng.randint(1, groups),
+            task_body,
+        ),
+        (
+            "POST /groups/<id>/tasks/batch/",
+            "POST",
+            lambda rng: "/groups/%d/tasks/batch/" % rng.randint(1, groups),
+            lambda rng: [task_body(rng) for _ in range(50)],
+        ),
+        (
+            "PUT /tasks/<id>/",
+            "PUT",
+            lambda rng: "/tasks/%d/" % rng.randint(1, tasks),
+            lambda rng: {"task_name": "Renamed task"},
+        ),
+        (
+            "PATCH /tasks/<id>/",
+            "PATCH",
+            lambda rng: "/tasks/%d/" % rng.randint(1, tasks),
+            lambda rng: {"task_name": "Renamed task"},
+        ),
+        ("GET /tasks/", "GET", lambda rng: "/tasks/?limit=100", no_body),
+        (
+            "GET /tasks/?due range",
+            "GET",
+            lambda rng: "/tasks/?group_id=%d&due_after=2024-02-01&due_before=2024-02-08"
+            "&order=due_date" % rng.randint(1, groups),
+            no_body,
+        ),
+        (
+            "GET /tasks/<id>/",
+            "GET",
+            lambda rng: "/tasks/%d/" % rng.randint(1, tasks),
+            no_body,
+        ),
+        (
+            "DELETE /tasks/<id>/",
+            "DELETE",
+            lambda rng: "/tasks/%d/" % spare_id("task"),
+            no_body,
+        ),
+        (
+            "POST /posts/",
+            "POST",
+            lambda rng: "/posts/",
+            lambda rng: {
+                "post_name": "Bench post",
+                "description": "Generated",
+                "timestamp": "2024-03-01T12:00:00Z",
+            },
+        ),
+        ("GET /posts/", "GET", lambda rng: "/posts/?limit=100", no_body),
+        (
+            "GET /posts/?view=summary",
+            "GET",
+            lambda rng: "/posts/?view=summary&limit=100",
+            no_body,
+        ),
+        (
+            "GET /posts/?include_archived=true",
+            "GET",
+            lambda rng: "/posts/?include_archived=true&limit=100",
+            no_body,
+        ),
+        (
+            "GET /posts/<id>/",
+            "GET",
+            lambda rng: "/posts/%d/" % rng.randint(1, posts),
+            no_body,
+        ),
+        (
+            "GET /posts/<id>/changes/",
+            "GET",
+            lambda rng: "/posts/%d/changes/?since=0&limit=100" % rng.randint(1, posts),
+            no_body,
+        ),
+        (
+            "DELETE /posts/<id>/",
+            "DELETE",
+            lambda rng: "/posts/%d/" % spare_id("post"),
+            no_body,
+        ),
+        (
+            "POST /posts/<id>/comments/",
+            "POST",
+            lambda rng: "/posts/%d/comments/" % rng.randint(1, posts),
+            comment_body,
+        ),
+        (
+            "POST /posts/<id>/comments/?return=parent&fields=",
+            "POST",
+            lambda rng: "/posts/%d/comments/?return=parent&fields=id,comment_count"
+            % rng.randint(1, posts),
+            comment_body,
+        ),
+        (
+            "POST /posts/<id>/comments/batch/",
+            "POST",
+            lambda rng: "/posts/%d/comments/batch/" % rng.randint(1, posts),
+            lambda rng: [comment_body(rng) for _ in range(50)],
+        ),
+        (
+            "PUT /comments/<id>/",
+            "PUT",
+            lambda rng: "/comments/%d/" % rng.randint(1, comments),
+            comment_body,
+        ),
+        (
+            "PATCH /comments/<id>/",
+            "PATCH",
+            lambda rng: "/comments/%d/" % rng.randint(1, comments),
+            comment_body,
+        ),
+        ("GET /comments/", "GET", lambda rng: "/comments/?limit=100", no_body),
+        (
+            "GET /comments/?include_archived=true",
+            "GET",
+            lambda rng: "/comments/?include_archived=true&limit=100",
+            no_body,
+        ),
+        (
+            "GET /comments/<id>/",
+            "GET",
+            lambda rng: "/comments/%d/" % rng.randint(1, comments),
+            no_body,
+        ),
+        (
+            "DELETE /comments/<id>/",
+            "DELETE",
+            lambda rng: "/comments/%d/" % spare_id("comment"),
+            no_body,
+        ),
+        (
+            "GET /search",
+            "GET",
+            lambda rng: "/search?q=%s" % rng.choice(["calculus", "phys", "chem"]),
+            no_body,
+        ),
+        ("GET /metrics", "GET", lambda rng: "/metrics", no_body),
+    ]
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1)
+    return sorted_values[max(index, 0)]
+
+
+def peak_rss_kb():
+    """
+    Peak resident set size of this process so far, in KB
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_route(app, scenario, requests, concurrency, seed_value, counter):
+    """
+    Sends requests requests for one scenario from concurrency threads and
+    returns its measurements
+    """
+
+    name, method, url, body = scenario
+    per_thread = [requests // concurrency] * concurrency
+    for i in range(requests % concurrency):
+        per_thread[i] += 1
+
+    def worker(index):
+        rng = random.Random("%s-%s-%d" % (seed_value, name, index))
+        client = app.test_client()
+        samples = []
+        for _ in range(per_thread[index]):
+            data = body(rng)
+            counter.count = 0
+            start = time.perf_counter()
+            response = client.open(
+                url(rng),
+                method=method,
+                data=None if data is None else json.dumps(data),
+            )
+            response.get_data()
+            elapsed = time.perf_counter() - start
+            samples.append((elapsed, counter.count, response.status_code))
+        return samples
+
+    rss_before = peak_rss_kb()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = [s for result in pool.map(worker, range(concurrency)) for s in result]
+    wall = time.perf_counter() - start
+    latencies = sorted(elapsed * 1000 for elapsed, _, _ in samples)
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for _, _, status in samples if status >= 400),
+        "throughput_rps": round(len(samples) / wall, 2) if wall else None,
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+        "queries_per_request": round(
+            sum(count for _, count, _ in samples) / len(samples), 2
+        ),
+        "peak_rss_kb": peak_rss_kb(),
+        "rss_growth_kb": peak_rss_kb() - rss_before,
+    }
+
+
+def run_matching(app, path, counter):
+    """
+    Unassigns every user, then times one POST /groups/auto-assign/ placing
+    the whole cohort, and returns its measurements
+    """
+
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("UPDATE users SET group_id = NULL")
+    cohort = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    conn.close()
+    rss_before = peak_rss_kb()
+    counter.count = 0
+    start = time.perf_counter()
+    response = app.test_client().post("/groups/auto-assign/", data="{}")
+    elapsed = time.perf_counter() - start
+    body = json.loads(response.get_data())
+    milliseconds = round(elapsed * 1000, 3)
+    return {
+        "requests": 1,
+        "errors": int(response.status_code >= 400),
+        "throughput_rps": round(1 / elapsed, 2),
+        "mean_ms": milliseconds,
+        "p50_ms": milliseconds,
+        "p95_ms": milliseconds,
+        "p99_ms": milliseconds,
+        "queries_per_request": counter.count,
+        "peak_rss_kb": peak_rss_kb(),
+        "rss_growth_kb": peak_rss_kb() - rss_before,
+        "cohort": cohort,
+        "assigned": len(body.get("assignments", ())),
+        "unmatched": len(body.get("unmatched", ())),
+    }
+
+
+def child_pids(parent):
+    """
+    Pids of parent's child processes, from /proc
+    """
+
+    pids = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % name) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent:
+            pids.append(int(name))
+    return pids
+
+
+def process_memory_kb(pid):
+    """
+    Resident and private (not shared with other processes) memory of a
+    process, in KB, from /proc
+    """
+
+    values = {}
+    with open("/proc/%d/smaps_rollup" % pid) as f:
+        for line in f:
+            name, _, rest = line.partition(":")
+            if rest.strip().endswith("kB"):
+                values[name] = int(rest.split()[0])
+    return {
+        "rss_kb": values["Rss"],
+        "private_kb": values["Private_Clean"] + values["Private_Dirty"],
+    }
+
+
+def get(url, timeout=5):
+    """
+    Fetches url and returns its status code
+    """
+
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        response.read()
+        return response.status
+
+
+def run_server(workers, threads):
+    """
+    Starts serve.py, times how long it takes to answer its first request,
+    and measures each worker's memory once every worker has served requests
+    """
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    url = "http://127.0.0.1:%d/groups/1/" % port
+    command = [sys.executable, os.path.join(here, "serve.py"), "--host", "127.0.0.1"]
+    command += ["--port", str(port), "--workers", str(workers)]
+    command += ["--threads", str(threads)]
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        command, cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while True:
+            try:
+                get(url)
+                break
+            except OSError:
+                if server.poll() is not None or time.perf_counter() - start > 30:
+                    raise RuntimeError("serve.py did not start")
+                time.sleep(0.01)
+        ready = time.perf_counter() - start
+        with ThreadPoolExecutor(workers * threads) as pool:
+            list(pool.map(get, [url] * workers * threads * 10))
+        memory = []
+        if os.path.exists("/proc/%d/smaps_rollup" % server.pid):
+            memory = [process_memory_kb(pid) for pid in child_pids(server.pid)]
+            supervisor = process_memory_kb(server.pid)
+        else:
+            supervisor = None
+    finally:
+        server.terminate()
+        server.wait(60)
+    return {
+        "workers": workers,
+        "threads": threads,
+        "ready_ms": round(ready * 1000, 2),
+        "supervisor": supervisor,
+        "worker_memory": memory,
+    }
+
+
+def run_startup(runs, workers, threads):
+    """
+    Times runs cold starts, each in a fresh interpreter, and takes the
+    median of each measurement, then boots the production server
+    """
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    probes = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_PROBE],
+            cwd=here,
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+        probe = json.loads(output.decode("utf-8").splitlines()[-1])
+        probe["process_ms"] = (time.perf_counter() - start) * 1000
+        probes.append(probe)
+    result = {
+        name: round(statistics.median(probe[name] for probe in probes), 2)
+        for name in probes[0]
+    }
+    result["runs"] = runs
+    result["server"] = run_server(workers, threads)
+    return result
+
+
+def compare(results, baseline, threshold, floor_ms):
+    """
+    Returns a message for every route whose p95 latency exceeds its
+    baseline by more than threshold times (and by more than floor_ms)
+    """
+
+    regressions = []
+    for name, current in results["routes"].items():
+        previous = baseline["routes"].get(name)
+        if previous is None:
+            continue
+        limit = max(previous["p95_ms"] * threshold, previous["p95_ms"] + floor_ms)
+        if current["p95_ms"] > limit:
+            regressions.append(
+                "%s: p95 %.3f ms, baseline %.3f ms"
+                % (name, current["p95_ms"], previous["p95_ms"])
+            )
+    return regressions
+
+
+def parse_args(argv):
+    """
+    Parses the command line
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    for name in SCALE_KEYS:
+        parser.add_argument("--%s" % name, type=int, help="override the scale")
+    parser.add_argument("--requests", type=int, default=200, help="per route")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--routes", help="only run routes containing this text")
+    parser.add_argument(
+        "--matching",
+        action="store_true",
+        help="time auto-assigning every user instead of running the routes",
+    )
+    parser.add_argument(
+        "--startup",
+        action="store_true",
+        help="measure cold starts and serve.py instead of running the routes",
+    )
+    parser.add_argument("--startup-runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=2, help="for --startup")
+    parser.add_argument("--threads", type=int, default=8, help="for --startup")
+    parser.add_argument("--profile", default="production", help="storage profile")
+    parser.add_argument("--no-cache", action="store_true", help="disable caching")
+    parser.add_argument(
+        "--admission",
+        action="store_true",
+        help="turn admission control on; every request comes from one client",
+    )
+    parser.add_argument("--db", help="scratch database path (default: temp file)")
+    parser.add_argument("--seed", default="studymatch")
+    parser.add_argument("--out", help="write results JSON here")
+    parser.add_argument("--baseline", help="results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    parser.add_argument("--floor-ms", type=float, default=1.0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Seeds the dataset, runs every scenario and reports the results
+    """
+
+    args = parse_args(argv)
+    counts = list(SCALES[args.scale])
+    for i, name in enumerate(SCALE_KEYS):
+        if getattr(args, name) is not None:
+            counts[i] = getattr(args, name)
+    counts = tuple(counts)
+    spare = args.requests
+    path = args.db or os.path.join(tempfile.mkdtemp(), "bench.db")
+    if os.path.exists(path):
+        os.remove(path)
+    os.environ["STUDYMATCH_DB_PATH"] = os.path.abspath(path)
+    os.environ["STUDYMATCH_STORAGE_PROFILE"] = args.profile
+    os.environ["STUDYMATCH_RESPONSE_CACHE_ENABLED"] = json.dumps(not args.no_cache)
+    os.environ["STUDYMATCH_ADMISSION_ENABLED"] = json.dumps(args.admission)
+
+    from app import create_app
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    counter = threading.local()
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def count(conn, cursor, statement, parameters, context, executemany):
+        counter.count = getattr(counter, "count", 0) + 1
+
+    app = create_app({"AUTO_MIGRATE": True})
+    start = time.perf_counter()
+    seed(path, counts, spare, random.Random(args.seed))
+    seed_seconds = time.perf_counter() - start
+    print("seeded %s in %.1fs" % (dict(zip(SCALE_KEYS, counts)), seed_seconds))
+
+    results = {
+        "meta": {
+            "scale": args.scale,
+            "counts": dict(zip(SCALE_KEYS, counts)),
+            "seed_seconds": round(seed_seconds, 2),
+            "requests_per_route": args.requests,
+            "concurrency": args.concurrency,
+            "profile": args.profile,
+            "cache": not args.no_cache,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "started": datetime.utcnow().isoformat() + "Z",
+        },
+        "routes": {},
+    }
+    if args.matching:
+        stats = run_matching(app, path, counter)
+        results["routes"]["POST /groups/auto-assign/"] = stats
+        print(
+            "auto-assigned %d of %d users in %.2fs, %d unmatched"
+            % (
+                stats["assigned"],
+                stats["cohort"],
+                stats["p50_ms"] / 1000,
+                stats["unmatched"],
+            )
+        )
+    if args.startup:
+        startup = run_startup(args.startup_runs, args.workers, args.threads)
+        results["startup"] = startup
+        print(
+            "cold start %.0f ms: import %.0f, create_app %.1f (%d statements),"
+            " first request %.1f ms, %d KB peak RSS"
+            % (
+                startup["process_ms"],
+                startup["import_ms"],
+                startup["create_app_ms"],
+                startup["startup_statements"],
+                startup["first_request_ms"],
+                startup["rss_kb"],
+            )
+        )
+        server = startup["server"]
+        print(
+            "serve.py with %d workers x %d threads answered in %.0f ms"
+            % (server["workers"], server["threads"], server["ready_ms"])
+        )
+        for number, memory in enumerate(server["worker_memory"], start=1):
+            print(
+                "  worker %d: %d KB RSS, %d KB private"
+                % (number, memory["rss_kb"], memory["private_kb"])
+            )
+    skip = args.matching or args.startup
+    for scenario in [] if skip else scenarios(counts, spare):
+        if args.routes and args.routes not in scenario[0]:
+            continue
+        stats = run_route(
+            app, scenario, args.requests, args.concurrency, args.seed, counter
+        )
+        results["routes"][scenario[0]] = stats
+        print(
+            "%-36s %8.1f rps  p50 %8.2f  p95 %8.2f  p99 %8.2f ms  %5.1f q/req  %s err"
+            % (
+                scenario[0],
+                stats["throughput_rps"],
+                stats["p50_ms"],
+                stats["p95_ms"],
+                stats["p99_ms"],
+                stats["queries_per_request"],
+                stats["errors"],
+            )
+        )
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.floor_ms)
+        if regressions:
+            print("Regressions over %.2fx baseline:" % args.threshold)
+            for message in regressions:
+                print("  " + message)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+from db import Comment, Task, Tombstone, User
+
+# Every insert or update of a tracked table stamps the row with the next
+# value of one global counter, and every delete (or a user leaving a group)
+# writes a tombstone stamped the same way. Triggers do it so ORM writes,
+# bulk statements and executemany batches are all tracked. SQLite runs one
+# writer at a time, so versions are committed in increasing order and a
+# client that has seen version N has seen everything up to N.
+TRACKED_TABLES = ("users", "tasks", "comments")
+NEXT_VERSION = "UPDATE row_version SET value = value + 1;"
+STAMP_ROW = (
+    "CREATE TRIGGER IF NOT EXISTS %(table)s_version_%(event)s"
+    " AFTER %(event)s ON %(table)s %(when)s BEGIN " + NEXT_VERSION + " UPDATE"
+    " %(table)s SET version = (SELECT value FROM row_version) WHERE id = NEW.id;"
+    " END"
+)
+TOMBSTONE = (
+    "CREATE TRIGGER IF NOT EXISTS %(name)s AFTER %(event)s ON %(table)s"
+    " WHEN OLD.%(parent)s_id IS NOT NULL %(when)s BEGIN " + NEXT_VERSION + " INSERT"
+    " INTO tombstones (kind, ref_id, parent_kind, parent_id, version) SELECT"
+    " '%(kind)s', OLD.id, '%(parent)s', OLD.%(parent)s_id, value FROM row_version;"
+    " END"
+)
+FORGET_PARENT = (
+    "CREATE TRIGGER IF NOT EXISTS %(parent)ss_forget_tombstones AFTER DELETE ON"
+    " %(parent)ss BEGIN DELETE FROM tombstones WHERE parent_kind = '%(parent)s'"
+    " AND parent_id = OLD.id; END"
+)
+
+
+def add_change_tracking(conn):
+    """
+    Adds version columns, the version counter and the change tracking
+    triggers, and gives every existing row a version
+    """
+
+    conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS row_version (value INTEGER NOT NULL)"
+    )
+    conn.exec_driver_sql(
+        "INSERT INTO row_version (value)"
+        " SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM row_version)"
+    )
+    for table in TRACKED_TABLES:
+        columns = conn.exec_driver_sql("PRAGMA table_info(%s)" % table).fetchall()
+        if "version" not in [column[1] for column in columns]:
+            conn.exec_driver_sql(
+                "ALTER TABLE %s ADD COLUMN version INTEGER NOT NULL DEFAULT 0" % table
+            )
+        conn.exec_driver_sql(
+            "UPDATE %s SET version = (SELECT value FROM row_version) + id"
+            " WHERE version = 0" % table
+        )
+        conn.exec_driver_sql(
+            "UPDATE row_version SET value = value"
+            " + COALESCE((SELECT MAX(id) FROM %s), 0)" % table
+        )
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_users_group_id_version"
+        " ON users (group_id, version)"
+    )
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_tasks_group_id_version"
+        " ON tasks (group_id, version)"
+    )
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_comments_post_id_version"
+        " ON comments (post_id, version)"
+    )
+    for table in TRACKED_TABLES:
+        conn.exec_driver_sql(
+            STAMP_ROW % {"table": table, "event": "insert", "when": ""}
+        )
+        conn.exec_driver_sql(
+            STAMP_ROW
+            % {
+                "table": table,
+                "event": "update",
+                "when": "WHEN NEW.version = OLD.version",
+            }
+        )
+    for name, event, table, kind, parent, when in [
+        ("users_tombstone", "DELETE", "users", "user", "group", ""),
+        (
+            "users_leave_group",
+            "UPDATE OF group_id",
+            "users",
+            "user",
+            "group",
+            "AND OLD.group_id IS NOT NEW.group_id",
+        ),
+        ("tasks_tombstone", "DELETE", "tasks", "task", "group", ""),
+        ("comments_tombstone", "DELETE", "comments", "comment", "post", ""),
+    ]:
+        conn.exec_driver_sql(
+            TOMBSTONE
+            % {
+                "name": name,
+                "event": event,
+                "table": table,
+                "kind": kind,
+                "parent": parent,
+                "when": when,
+            }
+        )
+    for parent in ("group", "post"):
+        conn.exec_driver_sql(FORGET_PARENT % {"parent": parent})
+
+
+def change_page(sources, parent_kind, parent_id, since, limit):
+    """
+    Returns the changes under one parent after version since, oldest
+    first, as (changes, cursor, has_more)
+
+    sources is a list of (type, model, parent column, serialize). Each is
+    read with one range scan over its (parent, version) index, as are the
+    tombstones, and the results are merged by version.
+    """
+
+    changes = []
+    for kind, model, column, serialize in sources:
+        rows = (
+            model.query.filter(column == parent_id, model.version > since)
+            .order_by(model.version)
+            .limit(limit + 1)
+        )
+        changes += [
+            {
+                "type": kind,
+                "id": row.id,
+                "version": row.version,
+                "deleted": False,
+                "data": serialize(row),
+            }
+            for row in rows
+        ]
+    tombstones = (
+        Tombstone.query.filter(
+            Tombstone.parent_kind == parent_kind,
+            Tombstone.parent_id == parent_id,
+            Tombstone.version > since,
+        )
+        .order_by(Tombstone.version)
+        .limit(limit + 1)
+    )
+    changes += [
+        {
+            "type": tombstone.kind,
+            "id": tombstone.ref_id,
+            "version": tombstone.version,
+            "deleted": True,
+            "data": None,
+        }
+        for tombstone in tombstones
+    ]
+    changes.sort(key=lambda change: change["version"])
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    cursor = changes[-1]["version"] if changes else since
+    return changes, cursor, has_more
+
+
+def group_changes(group_id, since, limit):
+    """
+    Returns the members and tasks of a group changed after since
+    """
+
+    return change_page(
+        [
+            ("user", User, User.group_id, User.serialize),
+            ("task", Task, Task.group_id, Task.serialize),
+        ],
+        "group",
+        group_id,
+        since,
+        limit,
+    )
+
+
+def post_changes(post_id, since, limit):
+    """
+    Returns the comments of a post changed after since
+    """
+
+    return change_page(
+        [("comment", Comment, Comment.post_id, Comment.serialize)],
+        "post",
+        post_id,
+        since,
+        limit,
+    )
@@ -0,0 +1,103 @@
+import click
+from db import db
+from response_cache import EVERY_TAG, log_invalidation
+
+# Denormalized child counts, kept in step by triggers so every write path
+# (ORM, bulk statements, executemany batches) updates them in the same
+# transaction as the child row. counter -> (parent table, child table,
+# foreign key)
+COUNTERS = {
+    "member_count": ("groups", "users", "group_id"),
+    "task_count": ("groups", "tasks", "group_id"),
+    "comment_count": ("posts", "comments", "post_id"),
+}
+ADJUST = (
+    "CREATE TRIGGER IF NOT EXISTS %(child)s_%(counter)s_%(name)s AFTER %(event)s"
+    " ON %(child)s %(when)s BEGIN %(body)s END"
+)
+STEP = "UPDATE %(parent)s SET %(counter)s = %(counter)s %(sign)s 1 WHERE id = %(row)s;"
+RECOUNT = (
+    "UPDATE %(parent)s SET %(counter)s = (SELECT COUNT(*) FROM %(child)s"
+    " WHERE %(child)s.%(key)s = %(parent)s.id)"
+)
+
+
+def count_changed(conn, parent, counter, child, key):
+    """
+    Returns how many rows of parent have a counter that disagrees with
+    their children
+    """
+
+    return conn.exec_driver_sql(
+        "SELECT COUNT(*) FROM %s WHERE %s != (SELECT COUNT(*) FROM %s WHERE %s.%s"
+        " = %s.id)" % (parent, counter, child, child, key, parent)
+    ).scalar()
+
+
+def recount(conn):
+    """
+    Recomputes every counter with one UPDATE per counter and returns the
+    number of wrong counters found per counter name
+    """
+
+    fixed = {}
+    for counter, (parent, child, key) in COUNTERS.items():
+        fixed[counter] = count_changed(conn, parent, counter, child, key)
+        if fixed[counter]:
+            conn.exec_driver_sql(
+                RECOUNT
+                % {"parent": parent, "counter": counter, "child": child, "key": key}
+            )
+    return fixed
+
+
+def add_counters(conn):
+    """
+    Adds the counter columns, fills them in and creates the triggers that
+    maintain them
+    """
+
+    for counter, (parent, child, key) in COUNTERS.items():
+        columns = conn.exec_driver_sql("PRAGMA table_info(%s)" % parent).fetchall()
+        if counter not in [column[1] for column in columns]:
+            conn.exec_driver_sql(
+                "ALTER TABLE %s ADD COLUMN %s INTEGER NOT NULL DEFAULT 0"
+                % (parent, counter)
+            )
+        values = {"parent": parent, "counter": counter, "child": child}
+        increment = STEP % dict(values, sign="+", row="NEW.%s" % key)
+        decrement = STEP % dict(values, sign="-", row="OLD.%s" % key)
+        for name, event, when, body in [
+            ("insert", "INSERT", "WHEN NEW.%s IS NOT NULL" % key, increment),
+            ("delete", "DELETE", "WHEN OLD.%s IS NOT NULL" % key, decrement),
+            (
+                "update",
+                "UPDATE OF %s" % key,
+                "WHEN OLD.%s IS NOT NEW.%s" % (key, key),
+                decrement + " " + increment,
+            ),
+        ]:
+            conn.exec_driver_sql(
+                ADJUST % dict(values, name=name, event=event, when=when, body=body)
+            )
+    recount(conn)
+
+
+def init_counters(app):
+    """
+    Registers the flask repair-counters command
+    """
+
+    @app.cli.command("repair-counters")
+    def repair_counters_command():
+        """
+        Recomputes the member, task and comment counters from the tables,
+        and has every server drop its cached responses if any was wrong
+        """
+
+        with db.engine.begin() as conn:
+            fixed = recount(conn)
+            if any(fixed.values()):
+                log_invalidation(conn, [EVERY_TAG])
+        for counter, count in fixed.items():
+            click.echo("%s: %d rows repaired" % (counter, count))
@@ -1,6 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
+from storage import RoutingSession
+from timestamps import format_timestamp
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 
 class Group(db.Model):
@@ -11,14 +13,36 @@ class Group(db.Model):
     __tablename__ = "groups"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String, nullable=False)
-    users = db.relationship("User")
-    tasks = db.relationship("Task", cascade="delete")
+    # maintained by triggers, see counters.py
+    member_count = db.Column(db.Integer, nullable=False, server_default="0")
+    task_count = db.Column(db.Integer, nullable=False, server_default="0")
+    # matching attributes: comma separated names, and the member limit
+    courses = db.Column(db.String, nullable=True)
+    availability = db.Column(db.String, nullable=True)
+    capacity = db.Column(db.Integer, nullable=True)
+    users = db.relationship("User", order_by="User.id")
+    tasks = db.relationship("Task", cascade="delete", order_by="Task.id")
+
+    # serialized field name -> column, nested collections, and the fields of
+    # ?view=summary, for fieldsets
+    serialize_fields = {
+        "id": "id",
+        "name": "name",
+        "member_count": "member_count",
+        "task_count": "task_count",
+        "capacity": "capacity",
+    }
+    serialize_collections = ("users", "tasks")
+    summary_fields = ("id", "name", "member_count", "task_count")
 
     def __init__(self, **kwargs):
         """
         Initializes group object/entry
         """
         self.name = kwargs.get("name")
+        self.courses = kwargs.get("courses")
+        self.availability = kwargs.get("availability")
+        self.capacity = kwargs.get("capacity")
 
     def serialize(self):
         """
@@ -46,10 +70,27 @@ class User(db.Model):
     """
 
     __tablename__ = "users"
+    __table_args__ = (db.Index("ix_users_group_id_version", "group_id", "version"),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String, nullable=False)
-    netid = db.Column(db.String, nullable=False)
-    group_id = db.Column(db.Integer, db.ForeignKey("groups.id"), nullable=True)
+    netid = db.Column(db.String, nullable=False, unique=True, index=True)
+    group_id = db.Column(
+        db.Integer, db.ForeignKey("groups.id"), nullable=True, index=True
+    )
+    # set by the change tracking triggers on every insert and update
+    version = db.Column(db.Integer, nullable=False, server_default="0")
+    # matching attributes: comma separated names
+    courses = db.Column(db.String, nullable=True)
+    availability = db.Column(db.String, nullable=True)
+
+    serialize_fields = {
+        "id": "id",
+        "name": "name",
+        "netid": "netid",
+        "group_id": "group_id",
+    }
+    serialize_collections = ()
+    summary_fields = ()
 
     def __init__(self, **kwargs):
         """
@@ -58,6 +99,8 @@ class User(db.Model):
 
         self.name = kwargs.get("name")
         self.netid = kwargs.get("netid")
+        self.courses = kwargs.get("courses")
+        self.availability = kwargs.get("availability")
 
     def serialize(self):
         """
@@ -89,11 +132,28 @@ class Task(db.Model):
     """
 
     __tablename__ = "tasks"
+    __table_args__ = (
+        db.Index("ix_tasks_group_id_due_date", "group_id", "due_date"),
+        db.Index("ix_tasks_group_id_version", "group_id", "version"),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     task_name = db.Column(db.String, nullable=False)
     description = db.Column(db.String, nullable=False)
-    due_date = db.Column(db.String, nullable=False)
-    group_id = db.Column(db.Integer, db.ForeignKey("groups.id"), nullable=False)
+    due_date = db.Column(db.DateTime, nullable=False, index=True)
+    group_id = db.Column(
+        db.Integer, db.ForeignKey("groups.id"), nullable=False, index=True
+    )
+    version = db.Column(db.Integer, nullable=False, server_default="0")
+
+    serialize_fields = {
+        "id": "id",
+        "task_name": "task_name",
+        "task_description": "description",
+        "due_date": "due_date",
+        "group_id": "group_id",
+    }
+    serialize_collections = ()
+    summary_fields = ()
 
     def __init__(self, **kwargs):
         """
@@ -103,6 +163,7 @@ class Task(db.Model):
         self.task_name = kwargs.get("task_name")
         self.description = kwargs.get("description")
         self.due_date = kwargs.get("due_date")
+        self.group_id = kwargs.get("group_id")
 
     def serialize(self):
         """
@@ -113,7 +174,7 @@ class Task(db.Model):
             "id": self.id,
             "task_name": self.task_name,
             "task_description": self.description,
-            "due_date": self.due_date,
+            "due_date": format_timestamp(self.due_date),
             "group_id": self.group_id,
         }
 
@@ -124,11 +185,24 @@ class Post(db.Model):
     """
 
     __tablename__ = "posts"
+    # ids are never reused, so an archived post's id stays its own
+    __table_args__ = {"sqlite_autoincrement": True}
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     post_name = db.Column(db.String, nullable=False)
     description = db.Column(db.String, nullable=False)
-    timestamp = db.Column(db.String, nullable=False)
-    comments = db.relationship("Comment", cascade="delete")
+    timestamp = db.Column(db.DateTime, nullable=False, index=True)
+    comment_count = db.Column(db.Integer, nullable=False, server_default="0")
+    comments = db.relationship("Comment", cascade="delete", order_by="Comment.id")
+
+    serialize_fields = {
+        "id": "id",
+        "post_name": "post_name",
+        "post_description": "description",
+        "timestamp": "timestamp",
+        "comment_count": "comment_count",
+    }
+    serialize_collections = ("comments",)
+    summary_fields = ("id", "post_name", "timestamp", "comment_count")
 
     def __init__(self, **kwargs):
         """
@@ -148,7 +222,7 @@ class Post(db.Model):
             "id": self.id,
             "post_name": self.post_name,
             "post_description": self.description,
-            "timestamp": self.timestamp,
+            "timestamp": format_timestamp(self.timestamp),
             "comments": [comment.serialize() for comment in self.comments],
         }
 
@@ -159,10 +233,26 @@ class Comment(db.Model):
     """
 
     __tablename__ = "comments"
+    __table_args__ = (
+        db.Index("ix_comments_post_id_version", "post_id", "version"),
+        {"sqlite_autoincrement": True},
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     description = db.Column(db.String, nullable=False)
-    timestamp = db.Column(db.String, nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey("posts.id"), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False, index=True)
+    post_id = db.Column(
+        db.Integer, db.ForeignKey("posts.id"), nullable=False, index=True
+    )
+    version = db.Column(db.Integer, nullable=False, server_default="0")
+
+    serialize_fields = {
+        "id": "id",
+        "comment_description": "description",
+        "timestamp": "timestamp",
+        "post_id": "post_id",
+    }
+    serialize_collections = ()
+    summary_fields = ()
 
     def __init__(self, **kwargs):
         """
@@ -171,6 +261,7 @@ class Comment(db.Model):
 
         self.description = kwargs.get("description")
         self.timestamp = kwargs.get("timestamp")
+        self.post_id = kwargs.get("post_id")
 
     def serialize(self):
         """
@@ -180,7 +271,7 @@ class Comment(db.Model):
         return {
             "id": self.id,
             "comment_description": self.description,
-            "timestamp": self.timestamp,
+            "timestamp": format_timestamp(self.timestamp),
         }
 
     def serialize_with_post(self):
@@ -191,6 +282,113 @@ class Comment(db.Model):
         return {
             "id": self.id,
             "comment_description": self.description,
-            "timestamp": self.timestamp,
+            "timestamp": format_timestamp(self.timestamp),
             "post_id": self.post_id,
         }
+
+
+class ArchivedPost(db.Model):
+    """
+    Archived Post Model: a post moved out of posts by flask archive, with
+    its original id
+    """
+
+    __tablename__ = "posts_archive"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    post_name = db.Column(db.String, nullable=False)
+    description = db.Column(db.String, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False, index=True)
+    # copied from the post, since archived comments never change
+    comment_count = db.Column(db.Integer, nullable=False, server_default="0")
+
+
+class ArchivedComment(db.Model):
+    """
+    Archived Comment Model: a comment of an archived post, with its original
+    id
+    """
+
+    __tablename__ = "comments_archive"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False, index=True)
+    post_id = db.Column(
+        db.Integer, db.ForeignKey("posts_archive.id"), nullable=False, index=True
+    )
+
+
+# Hot and archived rows read as one table, for ?include_archived=true
+any_comments = db.union_all(
+    db.select(Comment.id, Comment.description, Comment.timestamp, Comment.post_id),
+    db.select(
+        ArchivedComment.id,
+        ArchivedComment.description,
+        ArchivedComment.timestamp,
+        ArchivedComment.post_id,
+    ),
+).subquery("any_comments")
+any_posts = db.union_all(
+    db.select(
+        Post.id, Post.post_name, Post.description, Post.timestamp, Post.comment_count
+    ),
+    db.select(
+        ArchivedPost.id,
+        ArchivedPost.post_name,
+        ArchivedPost.description,
+        ArchivedPost.timestamp,
+        ArchivedPost.comment_count,
+    ),
+).subquery("any_posts")
+
+
+class AnyComment(db.Model):
+    """
+    Any Comment Model: a hot or archived comment, read only
+    """
+
+    __table__ = any_comments
+    __mapper_args__ = {"primary_key": [any_comments.c.id]}
+
+    serialize_fields = Comment.serialize_fields
+    serialize_collections = Comment.serialize_collections
+    summary_fields = Comment.summary_fields
+    serialize = Comment.serialize
+    serialize_with_post = Comment.serialize_with_post
+
+
+class AnyPost(db.Model):
+    """
+    Any Post Model: a hot or archived post with its comments, read only
+    """
+
+    __table__ = any_posts
+    __mapper_args__ = {"primary_key": [any_posts.c.id]}
+    comments = db.relationship(
+        AnyComment,
+        primaryjoin=any_posts.c.id == db.foreign(any_comments.c.post_id),
+        order_by=any_comments.c.id,
+        viewonly=True,
+    )
+
+    serialize_fields = Post.serialize_fields
+    serialize_collections = Post.serialize_collections
+    summary_fields = Post.summary_fields
+    serialize = Post.serialize
+
+
+class Tombstone(db.Model):
+    """
+    Tombstone Model: a user, task or comment that left a group or post,
+    written by the change tracking triggers
+    """
+
+    __tablename__ = "tombstones"
+    __table_args__ = (
+        db.Index("ix_tombstones_parent", "parent_kind", "parent_id", "version"),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String, nullable=False)
+    ref_id = db.Column(db.Integer, nullable=False)
+    parent_kind = db.Column(db.String, nullable=False)
+    parent_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False)
@@ -0,0 +1,197 @@
+import json
+
+import click
+from db import Group, Post, db
+from encoders import dumps
+from response_cache import EVERY_TAG, log_invalidation
+from sqlalchemy import text
+from sqlalchemy.orm import joinedload, selectinload
+
+# Pre-encoded group and post detail documents. Triggers bump a document's
+# generation and clear its body in the same transaction as any change to
+# the rows it is built from, and drop it when its group or post is
+# deleted. The next read rebuilds the body and stores it only if the
+# generation it saw is still current, so a rebuild racing a write can never
+# store a stale body.
+CREATE_DOCUMENT_STORE = (
+    "CREATE TABLE IF NOT EXISTS documents (kind TEXT NOT NULL, ref_id INTEGER NOT"
+    " NULL, generation INTEGER NOT NULL, body BLOB, PRIMARY KEY (kind, ref_id))"
+)
+INVALIDATE = (
+    "INSERT INTO documents (kind, ref_id, generation) SELECT '%(kind)s', %(row)s, 1"
+    " WHERE %(row)s IS NOT NULL ON CONFLICT (kind, ref_id) DO UPDATE SET"
+    " body = NULL, generation = generation + 1;"
+)
+TRIGGER = (
+    "CREATE TRIGGER IF NOT EXISTS %(table)s_documents_%(name)s AFTER %(event)s ON"
+    " %(table)s BEGIN %(body)s END"
+)
+# table -> (document kind, column referencing it, columns serialized)
+DOCUMENT_SOURCES = {
+    "groups": ("group", "id", ("name",)),
+    "users": ("group", "group_id", ("name", "netid", "group_id")),
+    "tasks": (
+        "group",
+        "group_id",
+        ("task_name", "description", "due_date", "group_id"),
+    ),
+    "posts": ("post", "id", ("post_name", "description", "timestamp")),
+    "comments": ("post", "post_id", ("description", "timestamp", "post_id")),
+}
+READ = "SELECT generation, body FROM documents WHERE kind = :kind AND ref_id = :id"
+STORE = (
+    "INSERT INTO documents (kind, ref_id, generation, body) SELECT :kind, :id,"
+    " :generation, :body WHERE EXISTS (SELECT 1 FROM %s WHERE id = :id)"
+    " ON CONFLICT (kind, ref_id) DO UPDATE SET body = excluded.body"
+    " WHERE documents.generation = excluded.generation AND documents.body IS NULL"
+)
+
+
+def document_query(kind):
+    """
+    Returns the query that loads a document's source rows, and its table
+    """
+
+    if kind == "group":
+        options = [selectinload(Group.users), selectinload(Group.tasks)]
+        return Group.query.options(*options), Group, "groups"
+    return Post.query.options(joinedload(Post.comments)), Post, "posts"
+
+
+def create_document_store(conn):
+    """
+    Creates the document table and the triggers that invalidate it
+    """
+
+    conn.exec_driver_sql(CREATE_DOCUMENT_STORE)
+    for table, (kind, column, columns) in DOCUMENT_SOURCES.items():
+        old = INVALIDATE % {"kind": kind, "row": "OLD.%s" % column}
+        new = INVALIDATE % {"kind": kind, "row": "NEW.%s" % column}
+        if column == "id":
+            delete = (
+                "DELETE FROM documents WHERE kind = '%s' AND ref_id = OLD.id;" % kind
+            )
+            events = [("update", "UPDATE OF %s" % ", ".join(columns), new)]
+            events.append(("delete", "DELETE", delete))
+        else:
+            events = [
+                ("insert", "INSERT", new),
+                ("update", "UPDATE OF %s" % ", ".join(columns), old + " " + new),
+                ("delete", "DELETE", old),
+            ]
+        for name, event, body in events:
+            conn.exec_driver_sql(
+                TRIGGER % {"table": table, "name": name, "event": event, "body": body}
+            )
+
+
+def render(kind, ref_id):
+    """
+    Builds the encoded detail document from the ORM, or returns None when
+    the group or post does not exist
+    """
+
+    query, model, _ = document_query(kind)
+    row = query.filter(model.id == ref_id).first()
+    return None if row is None else dumps(row.serialize())
+
+
+def document(kind, ref_id):
+    """
+    Returns the encoded detail document of a group or post, rebuilding and
+    storing it when it was invalidated, or None when there is no such row
+    """
+
+    stored = db.session.execute(text(READ), {"kind": kind, "id": ref_id}).first()
+    if stored is not None and stored.body is not None:
+        return stored.body
+    body = render(kind, ref_id)
+    if body is None:
+        return None
+    statement = text(STORE % document_query(kind)[2])
+    params = {
+        "kind": kind,
+        "id": ref_id,
+        "generation": 0 if stored is None else stored.generation,
+        "body": body,
+    }
+    if db.session.get_bind() is db.engine:
+        # the session already holds a primary connection, and taking a
+        # second one from the same pool can wait forever under load
+        db.session.execute(statement, params)
+        db.session.commit()
+        return body
+    # through the primary engine, since reads may be bound to a read-only
+    # connection
+    with db.engine.begin() as conn:
+        conn.execute(statement, params)
+    return body
+
+
+def check_documents():
+    """
+    Compares every stored document with a fresh rendering and returns the
+    (kind, ref_id) of the ones that differ. Documents are compared as JSON
+    values, so switching encoders does not count as a difference.
+    """
+
+    stale = []
+    rows = db.session.execute(
+        text("SELECT kind, ref_id, body FROM documents WHERE body IS NOT NULL")
+    )
+    for kind, ref_id, body in rows.fetchall():
+        fresh = render(kind, ref_id)
+        if fresh is None or json.loads(fresh) != json.loads(body):
+            stale.append((kind, ref_id))
+    return stale
+
+
+def rebuild_documents():
+    """
+    Invalidates every stored document and every server's cached responses,
+    then renders and stores the document of every group and post through
+    the same generation checked path reads use, and returns how many were
+    stored
+    """
+
+    db.session.execute(
+        text("UPDATE documents SET body = NULL, generation = generation + 1")
+    )
+    log_invalidation(db.session.connection(), [EVERY_TAG])
+    db.session.commit()
+    count = 0
+    for kind in ("group", "post"):
+        _, model, _ = document_query(kind)
+        ids = [row.id for row in db.session.query(model.id).order_by(model.id)]
+        for ref_id in ids:
+            if document(kind, ref_id) is not None:
+                count += 1
+            db.session.expunge_all()
+    return count
+
+
+def init_documents(app):
+    """
+    Registers the flask documents-check and documents-rebuild commands
+    """
+
+    @app.cli.command("documents-check")
+    def documents_check_command():
+        """
+        Checks that stored group and post documents match the tables
+        """
+
+        stale = check_documents()
+        for kind, ref_id in stale:
+            click.echo("stale %s %d" % (kind, ref_id))
+        if stale:
+            raise click.ClickException("%d stale documents" % len(stale))
+        click.echo("All stored documents are current")
+
+    @app.cli.command("documents-rebuild")
+    def documents_rebuild_command():
+        """
+        Renders and stores the document of every group and post
+        """
+
+        click.echo("Stored %d documents" % rebuild_documents())
@@ -0,0 +1,115 @@
+import json
+
+from flask import current_app, has_app_context
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Encoder:
+    """
+    A JSON backend: a dumps function returning bytes, and the separators it
+    writes, so documents assembled from chunks match what dumps would write
+    for the whole document
+    """
+
+    def __init__(self, name, dumps, item_separator, key_separator):
+        """
+        Initializes an encoder
+        """
+
+        self.name = name
+        self.dumps = dumps
+        self.item_separator = item_separator
+        self.key_separator = key_separator
+
+
+def stdlib_dumps(data):
+    """
+    Encodes data exactly like json.dumps with its default settings
+    """
+
+    return json.dumps(data).encode("utf-8")
+
+
+STDLIB = Encoder("stdlib", stdlib_dumps, b", ", b": ")
+ENCODERS = {"stdlib": STDLIB}
+if orjson is not None:
+    # same JSON values as stdlib, written without insignificant whitespace
+    # and with non-ASCII characters as UTF-8 instead of \u escapes
+    ENCODERS["orjson"] = Encoder("orjson", orjson.dumps, b",", b":")
+
+
+def init_encoding(app):
+    """
+    Selects the JSON backend from app's JSON_ENCODER config: one of
+    ENCODERS, or "auto" for the fastest one installed
+
+    The default is "stdlib", whose output is byte for byte what json.dumps
+    writes. orjson writes the same values more compactly, so opt into it
+    only where clients do not compare bytes. Stored documents keep the
+    encoding they were written with, so run flask documents-rebuild after
+    changing it.
+    """
+
+    app.config.setdefault("JSON_ENCODER", "stdlib")
+    name = app.config["JSON_ENCODER"]
+    if name == "auto":
+        name = "orjson" if "orjson" in ENCODERS else "stdlib"
+    if name not in ENCODERS:
+        raise ValueError("JSON encoder %r is not available" % name)
+    app.extensions["json_encoder"] = ENCODERS[name]
+
+
+def current_encoder():
+    """
+    Returns the JSON backend of the current app, or STDLIB outside an app
+    context
+    """
+
+    if has_app_context():
+        return current_app.extensions["json_encoder"]
+    return STDLIB
+
+
+def dumps(data):
+    """
+    Encodes data to JSON bytes with the current app's backend
+    """
+
+    return current_encoder().dumps(data)
+
+
+def iter_list_document(key, chunks, serialize, trailer):
+    """
+    Encodes {key: [...], **trailer} incrementally, yielding one byte chunk
+    per chunk of rows, so the full document is never held in memory
+    """
+
+    encoder = current_encoder()
+    encode = encoder.dumps
+    sep, colon = encoder.item_separator, encoder.key_separator
+    yield b"{" + encode(key) + colon + b"["
+    first = True
+    for rows in chunks:
+        if not rows:
+            continue
+        chunk = sep.join(encode(serialize(row)) for row in rows)
+        yield chunk if first else sep + chunk
+        first = False
+    yield b"]"
+    for name, value in trailer.items():
+        yield sep + encode(name) + colon + encode(value)
+    yield b"}"
+
+
+def iter_ndjson(chunks, serialize):
+    """
+    Encodes rows as newline delimited JSON, one byte chunk per chunk of rows
+    """
+
+    encode = current_encoder().dumps
+    for rows in chunks:
+        yield b"".join(encode(serialize(row)) + b"\n" for row in rows)
@@ -0,0 +1,113 @@
+from timestamps import format_timestamp
+
+
+def split_param(value):
+    """
+    Splits a comma separated query parameter into a list of names
+    """
+
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
+class Fieldset:
+    """
+    A requested subset of a model's serialized fields and nested collections
+    """
+
+    def __init__(self, model, fields, expand):
+        """
+        Initializes a fieldset for model
+        """
+
+        self.model = model
+        self.fields = fields
+        self.expand = expand
+
+    @property
+    def projectable(self):
+        """
+        True when no nested collection is needed, so the fieldset can be read
+        with a column only query instead of loading ORM objects
+        """
+
+        return not self.expand
+
+    def columns(self, sort_column=None):
+        """
+        Labelled columns for a projection query. id, and sort_column when
+        given, are always selected since keyset pagination needs them for
+        the cursor.
+        """
+
+        columns = [self.model.id.label("id")]
+        for field in self.fields:
+            if field != "id":
+                column = getattr(self.model, self.model.serialize_fields[field])
+                columns.append(column.label(field))
+        if sort_column is not None:
+            columns.append(sort_column.label(sort_column.key))
+        return columns
+
+    def loader_options(self, loader):
+        """
+        Loader options that batch-load only the expanded collections
+        """
+
+        return [loader(getattr(self.model, name)) for name in self.expand]
+
+    def serialize_row(self, row):
+        """
+        Serializes a row returned by a projection query
+        """
+
+        values = row._mapping
+        return {field: format_timestamp(values[field]) for field in self.fields}
+
+    def serialize(self, obj):
+        """
+        Serializes a model object
+        """
+
+        data = {
+            field: format_timestamp(getattr(obj, self.model.serialize_fields[field]))
+            for field in self.fields
+        }
+        for name in self.expand:
+            data[name] = [item.serialize() for item in getattr(obj, name)]
+        return data
+
+
+def parse_fieldset(model, args):
+    """
+    Parses the view, fields and expand query parameters for model
+
+    view=summary selects the model's summary_fields. fields lists exactly
+    the fields to return and may name nested collections too; without it
+    every scalar field is returned. expand adds nested collections. Returns
+    None when none is given so callers keep the full serialize() shape.
+    Raises ValueError on unknown names.
+    """
+
+    view = args.get("view", "full")
+    views = ["full"] + (["summary"] if model.summary_fields else [])
+    if view not in views:
+        raise ValueError("view must be one of: %s" % ", ".join(views))
+    if view == "summary" and "fields" not in args:
+        expand = split_param(args.get("expand", ""))
+        return parse_fieldset(
+            model, {"fields": ",".join(list(model.summary_fields) + expand)}
+        )
+    if "fields" not in args and "expand" not in args:
+        return None
+    names = split_param(args.get("expand", ""))
+    if "fields" in args:
+        names += split_param(args["fields"])
+    else:
+        names += list(model.serialize_fields)
+    known = list(model.serialize_fields) + list(model.serialize_collections)
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        raise ValueError("Unknown fields: %s" % ", ".join(unknown))
+    fields = [name for name in model.serialize_fields if name in names]
+    expand = [name for name in model.serialize_collections if name in names]
+    return Fieldset(model, fields, expand)
@@ -0,0 +1,208 @@
+import heapq
+
+from batch import LOOKUP_CHUNK_SIZE
+from db import Group, User, db
+from sqlalchemy import bindparam, exists, func, or_, text
+
+# score of a candidate group: shared courses dominate, shared availability
+# slots break ties between groups of the same courses
+COURSE_WEIGHT = 10
+SLOT_WEIGHT = 1
+UNLIMITED = float("inf")
+
+
+def parse_attribute(body, key):
+    """
+    Validates an optional list of names in a request body and returns it in
+    its stored form, a comma separated string, or None when absent. Raises
+    ValueError with a client facing message.
+    """
+
+    if body.get(key) is None:
+        return None
+    values = body[key]
+    if not isinstance(values, list) or not all(
+        isinstance(value, str) and value.strip() and "," not in value
+        for value in values
+    ):
+        raise ValueError("%s must be a list of names without commas" % key)
+    return ",".join(sorted(set(value.strip() for value in values)))
+
+
+def split_attribute(text):
+    """
+    Returns the set of names in a stored attribute
+    """
+
+    return frozenset(text.split(",")) if text else frozenset()
+
+
+def add_matching_attributes(conn):
+    """
+    Adds the courses and availability of users and groups, and group
+    capacities
+    """
+
+    for table, columns in [
+        ("users", ["courses TEXT", "availability TEXT"]),
+        ("groups", ["courses TEXT", "availability TEXT", "capacity INTEGER"]),
+    ]:
+        existing = conn.exec_driver_sql("PRAGMA table_info(%s)" % table).fetchall()
+        for column in columns:
+            if column.split()[0] not in [row[1] for row in existing]:
+                conn.exec_driver_sql("ALTER TABLE %s ADD COLUMN %s" % (table, column))
+
+
+def match(users, groups, fallback=False):
+    """
+    Assigns users to groups and returns ({user id: group id}, unmatched
+    user ids)
+
+    users is a list of (id, courses, slots) and groups a list of (id, free
+    places or None for unlimited, courses, slots). Candidates come from an
+    inverted index of course -> groups, so each user is only scored against
+    groups that share a course. Users with the fewest candidates are placed
+    first, and ties go to the group with the most free places, which
+    spreads students out. With fallback, users sharing no course with an
+    open group go to the open group with the most free places.
+    """
+
+    free, group_courses, group_slots, by_course = {}, {}, {}, {}
+    for group_id, places, courses, slots in groups:
+        if places is not None and places <= 0:
+            continue
+        free[group_id] = UNLIMITED if places is None else places
+        group_courses[group_id] = courses
+        group_slots[group_id] = slots
+        for course in courses:
+            by_course.setdefault(course, []).append(group_id)
+
+    def candidate_count(user):
+        return sum(len(by_course.get(course, ())) for course in user[1])
+
+    assignments, unmatched = {}, []
+    for user_id, courses, slots in sorted(users, key=candidate_count):
+        best, best_key = None, None
+        seen = set()
+        for course in courses:
+            for group_id in by_course.get(course, ()):
+                if group_id in seen or group_id not in free:
+                    continue
+                seen.add(group_id)
+                score = COURSE_WEIGHT * len(courses & group_courses[group_id])
+                score += SLOT_WEIGHT * len(slots & group_slots[group_id])
+                key = (score, free[group_id], -group_id)
+                if best_key is None or key > best_key:
+                    best, best_key = group_id, key
+        if best is None:
+            unmatched.append(user_id)
+            continue
+        assignments[user_id] = best
+        free[best] -= 1
+        if free[best] <= 0:
+            del free[best]
+    if fallback and unmatched and free:
+        heap = [(-places, group_id) for group_id, places in free.items()]
+        heapq.heapify(heap)
+        still_unmatched = []
+        for user_id in unmatched:
+            if not heap:
+                still_unmatched.append(user_id)
+                continue
+            places, group_id = heapq.heappop(heap)
+            assignments[user_id] = group_id
+            if places + 1 < 0:
+                heapq.heappush(heap, (places + 1, group_id))
+        unmatched = still_unmatched
+    return assignments, unmatched
+
+
+def auto_assign(user_ids=None, default_capacity=None, fallback=False):
+    """
+    Matches unassigned users, or the unassigned ones among user_ids, to
+    groups with free places and saves every assignment with one batched
+    UPDATE in the current transaction, which must not have written yet
+
+    Groups without a capacity take default_capacity, or are unlimited when
+    that is None too. Returns ({user id: group id}, unmatched user ids),
+    where the assignments are the rows actually updated.
+    """
+
+    # take SQLite's write lock before reading, so no other writer can fill
+    # a group or place a user between the reads and the UPDATE
+    db.session.execute(text("BEGIN IMMEDIATE"))
+    query = db.session.query(User.id, User.courses, User.availability).filter(
+        User.group_id.is_(None)
+    )
+    if user_ids is not None:
+        query = query.filter(User.id.in_(user_ids))
+    users = [
+        (row.id, split_attribute(row.courses), split_attribute(row.availability))
+        for row in query
+    ]
+    groups = []
+    rows = db.session.query(
+        Group.id,
+        Group.capacity,
+        Group.member_count,
+        Group.courses,
+        Group.availability,
+    )
+    for row in rows:
+        capacity = default_capacity if row.capacity is None else row.capacity
+        groups.append(
+            (
+                row.id,
+                None if capacity is None else capacity - row.member_count,
+                split_attribute(row.courses),
+                split_attribute(row.availability),
+            )
+        )
+    assignments, unmatched = match(users, groups, fallback)
+    if not assignments:
+        return assignments, unmatched
+    # the same guards as a single assignment: the user is still unassigned
+    # and the group still has room, as counted by the member_count trigger
+    capacity = func.coalesce(Group.capacity, default_capacity)
+    statement = (
+        User.__table__.update()
+        .where(User.id == bindparam("user_id"))
+        .where(User.group_id.is_(None))
+        .where(
+            exists().where(
+                Group.id == bindparam("new_group_id"),
+                or_(capacity.is_(None), Group.member_count < capacity),
+            )
+        )
+        .values(group_id=bindparam("new_group_id"))
+    )
+    updated = db.session.execute(
+        statement,
+        [
+            {"user_id": user_id, "new_group_id": group_id}
+            for user_id, group_id in assignments.items()
+        ],
+    ).rowcount
+    if updated != len(assignments):
+        assignments, skipped = saved_assignments(assignments)
+        unmatched += skipped
+    return assignments, unmatched
+
+
+def saved_assignments(assignments):
+    """
+    Splits assignments into the ones the database holds and the user ids of
+    the others, reading the users back in chunks
+    """
+
+    user_ids = list(assignments)
+    saved = {}
+    for start in range(0, len(user_ids), LOOKUP_CHUNK_SIZE):
+        chunk = user_ids[start : start + LOOKUP_CHUNK_SIZE]
+        rows = db.session.query(User.id, User.group_id).filter(User.id.in_(chunk))
+        saved.update(
+            (row.id, row.group_id)
+            for row in rows
+            if row.group_id == assignments[row.id]
+        )
+    return saved, [user_id for user_id in user_ids if user_id not in saved]
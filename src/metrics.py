@@ -0,0 +1,300 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from query_budget import count_query
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+PROMETHEUS_MIMETYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """
+    Cumulative bucket counts, sum and count of observed values
+    """
+
+    def __init__(self, buckets):
+        """
+        Initializes an empty histogram
+        """
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Adds one value
+        """
+
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """
+        Yields the Prometheus lines for this histogram
+        """
+
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            yield '%s_bucket{%s,le="%s"} %d' % (name, labels, bound, total)
+        yield "%s_sum{%s} %s" % (name, labels, repr(float(self.sum)))
+        yield "%s_count{%s} %d" % (name, labels, self.count)
+
+
+class RouteMetrics:
+    """
+    Counters and histograms for one route and method
+    """
+
+    def __init__(self):
+        """
+        Initializes empty route metrics
+        """
+
+        self.statuses = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.response_size = Histogram(SIZE_BUCKETS)
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.encode_seconds = 0.0
+
+
+class Metrics:
+    """
+    In-process request metrics, keyed by route rule and method. Every
+    worker process keeps its own, so scrape each worker.
+    """
+
+    def __init__(self):
+        """
+        Initializes empty metrics
+        """
+
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    def record(self, route, method, status, elapsed, size, timings):
+        """
+        Records one finished request. size is None for streamed responses.
+        """
+
+        with self.lock:
+            metrics = self.routes.get((route, method))
+            if metrics is None:
+                metrics = self.routes[(route, method)] = RouteMetrics()
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            metrics.latency.observe(elapsed)
+            if size is not None:
+                metrics.response_size.observe(size)
+            metrics.sql_statements += timings.get("sql_statements", 0)
+            metrics.sql_seconds += timings.get("sql", 0.0)
+            metrics.serialize_seconds += timings.get("serialize", 0.0)
+            metrics.encode_seconds += timings.get("encode", 0.0)
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format
+        """
+
+        with self.lock:
+            routes = sorted(self.routes.items())
+            lines = [
+                "# HELP studymatch_http_requests_total Requests by route and status",
+                "# TYPE studymatch_http_requests_total counter",
+            ]
+            for (route, method), metrics in routes:
+                for status, count in sorted(metrics.statuses.items()):
+                    lines.append(
+                        'studymatch_http_requests_total{%s,status="%d"} %d'
+                        % (labels(route, method), status, count)
+                    )
+            for name, kind, text, histogram in [
+                (
+                    "studymatch_http_request_duration_seconds",
+                    "histogram",
+                    "Time to build the response",
+                    lambda m: m.latency,
+                ),
+                (
+                    "studymatch_http_response_size_bytes",
+                    "histogram",
+                    "Response body size, streamed responses excluded",
+                    lambda m: m.response_size,
+                ),
+            ]:
+                lines.append("# HELP %s %s" % (name, text))
+                lines.append("# TYPE %s %s" % (name, kind))
+                for (route, method), metrics in routes:
+                    lines.extend(
+                        histogram(metrics).samples(name, labels(route, method))
+                    )
+            for name, text, attribute in [
+                (
+                    "studymatch_sql_statements_total",
+                    "SQL statements executed",
+                    "sql_statements",
+                ),
+                (
+                    "studymatch_sql_duration_seconds_total",
+                    "Time spent executing SQL",
+                    "sql_seconds",
+                ),
+                (
+                    "studymatch_serialize_duration_seconds_total",
+                    "Time spent turning rows into dicts",
+                    "serialize_seconds",
+                ),
+                (
+                    "studymatch_encode_duration_seconds_total",
+                    "Time spent encoding JSON",
+                    "encode_seconds",
+                ),
+            ]:
+                lines.append("# HELP %s %s" % (name, text))
+                lines.append("# TYPE %s counter" % name)
+                for (route, method), metrics in routes:
+                    lines.append(
+                        "%s{%s} %s"
+                        % (name, labels(route, method), getattr(metrics, attribute))
+                    )
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        """
+        Drops every recorded metric
+        """
+
+        with self.lock:
+            self.routes.clear()
+
+
+metrics = Metrics()
+
+
+def labels(route, method):
+    """
+    Formats the route and method labels of a sample
+    """
+
+    route = route.replace("\\", "\\\\").replace('"', '\\"')
+    return 'route="%s",method="%s"' % (route, method)
+
+
+@contextmanager
+def timed(name):
+    """
+    Adds the time spent in the block to the current request's name timing
+    """
+
+    if not has_request_context():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = g.setdefault("timings", {})
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    """
+    Engine listener that notes when a statement starts, on the statement's
+    own execution context, so a statement that fails leaves nothing behind
+    on the pooled connection
+    """
+
+    context.statement_start = time.perf_counter()
+
+
+def finish_statement(conn, cursor, statement, parameters, context, executemany):
+    """
+    Engine listener that adds a finished statement's time to the current
+    request, and keeps the statement itself when slow requests are traced
+    """
+
+    elapsed = time.perf_counter() - context.statement_start
+    if not has_request_context():
+        return
+    timings = g.setdefault("timings", {})
+    timings["sql"] = timings.get("sql", 0.0) + elapsed
+    trace = g.get("sql_trace")
+    if trace is not None:
+        trace.append((elapsed, statement))
+
+
+def init_metrics(app):
+    """
+    Installs request metrics on app
+
+    Every request records its latency, status, response size, and the time
+    spent in SQL, in serialize() (inside timed("serialize")) and in JSON
+    encoding (inside timed("encode")). Streamed responses are timed until
+    their headers are ready. When METRICS_SLOW_REQUEST_SECONDS is set,
+    requests slower than it are logged with their METRICS_TRACE_STATEMENTS
+    slowest statements. METRICS_ENABLED turns all of it off.
+    """
+
+    app.config.setdefault("METRICS_ENABLED", True)
+    app.config.setdefault("METRICS_SLOW_REQUEST_SECONDS", None)
+    app.config.setdefault("METRICS_TRACE_STATEMENTS", 5)
+    for name, listener in [
+        ("before_cursor_execute", count_query),
+        ("before_cursor_execute", start_statement),
+        ("after_cursor_execute", finish_statement),
+    ]:
+        if not event.contains(Engine, name, listener):
+            event.listen(Engine, name, listener)
+
+    @app.before_request
+    def start_request_timer():
+        if not app.config["METRICS_ENABLED"]:
+            return
+        g.request_start = time.perf_counter()
+        if app.config["METRICS_SLOW_REQUEST_SECONDS"] is not None:
+            g.sql_trace = []
+
+    @app.after_request
+    def record_request_metrics(response):
+        start = g.get("request_start")
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        timings = g.get("timings", {})
+        timings["sql_statements"] = g.get("query_count", 0)
+        size = None if response.is_streamed else response.content_length
+        metrics.record(
+            route, request.method, response.status_code, elapsed, size, timings
+        )
+        threshold = app.config["METRICS_SLOW_REQUEST_SECONDS"]
+        if threshold is not None and elapsed >= threshold:
+            slowest = sorted(g.get("sql_trace", []), reverse=True)
+            app.logger.warning(
+                "Slow request %s %s: %.1f ms, %d statements in %.1f ms,"
+                " serialize %.1f ms, encode %.1f ms%s",
+                request.method,
+                request.full_path,
+                elapsed * 1000,
+                timings["sql_statements"],
+                timings.get("sql", 0.0) * 1000,
+                timings.get("serialize", 0.0) * 1000,
+                timings.get("encode", 0.0) * 1000,
+                "".join(
+                    "\n  %.1f ms %s" % (seconds * 1000, statement)
+                    for seconds, statement in slowest[
+                        : app.config["METRICS_TRACE_STATEMENTS"]
+                    ]
+                ),
+            )
+        return response
@@ -0,0 +1,258 @@
+import click
+from archive import add_archive
+from changes import add_change_tracking
+from counters import add_counters
+from documents import create_document_store
+from matching import add_matching_attributes
+from response_cache import create_invalidation_log, trim_invalidation_log
+from search import create_search_index
+from timestamps import parse_timestamp
+
+# how SQLAlchemy stores DateTime columns in SQLite; it sorts chronologically
+STORED_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# Schema migrations, applied in order. The database's PRAGMA user_version
+# holds the number of migrations already applied. Every migration must be
+# safe to run on a database that db.create_all() has just created.
+
+
+def add_lookup_indexes(conn):
+    """
+    Indexes the foreign keys and netid, which db.create_all() never adds to
+    an existing database
+    """
+
+    duplicates = conn.exec_driver_sql(
+        "SELECT netid FROM users GROUP BY netid HAVING COUNT(*) > 1"
+    ).fetchall()
+    if duplicates:
+        raise click.ClickException(
+            "Duplicate netids must be resolved before migrating: %s"
+            % ", ".join(row[0] for row in duplicates)
+        )
+    conn.exec_driver_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_netid ON users (netid)"
+    )
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_users_group_id ON users (group_id)"
+    )
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_tasks_group_id ON tasks (group_id)"
+    )
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_comments_post_id ON comments (post_id)"
+    )
+
+
+def convert_timestamps(conn):
+    """
+    Rewrites the free-form due_date and timestamp strings in SQLAlchemy's
+    DateTime storage format and indexes them for range queries
+
+    SQLite keeps the declared VARCHAR type of the existing columns, which
+    is harmless since DateTime values are stored as text either way.
+    """
+
+    for table, column in [
+        ("tasks", "due_date"),
+        ("posts", "timestamp"),
+        ("comments", "timestamp"),
+    ]:
+        rows = conn.exec_driver_sql("SELECT id, %s FROM %s" % (column, table))
+        updates, invalid = [], []
+        for row_id, value in rows.fetchall():
+            try:
+                stored = parse_timestamp(value).strftime(STORED_TIMESTAMP_FORMAT)
+            except ValueError:
+                invalid.append("%s %d: %r" % (table, row_id, value))
+                continue
+            if stored != value:
+                updates.append((stored, row_id))
+        if invalid:
+            raise click.ClickException(
+                "Unparseable timestamps must be fixed before migrating: %s"
+                % ", ".join(invalid)
+            )
+        if updates:
+            conn.exec_driver_sql(
+                "UPDATE %s SET %s = ? WHERE id = ?" % (table, column), updates
+            )
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_tasks_due_date ON tasks (due_date)"
+    )
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_tasks_group_id_due_date"
+        " ON tasks (group_id, due_date)"
+    )
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_posts_timestamp ON posts (timestamp)"
+    )
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_comments_timestamp ON comments (timestamp)"
+    )
+
+
+MIGRATIONS = [
+    add_lookup_indexes,
+    convert_timestamps,
+    create_search_index,
+    add_change_tracking,
+    add_counters,
+    create_document_store,
+    add_matching_attributes,
+    add_archive,
+    create_invalidation_log,
+    trim_invalidation_log,
+]
+
+# name -> (query, index it must use, or a tuple of indexes it may use when
+# several lead with the same columns and the planner is free to pick one)
+HOT_QUERIES = {
+    "users by group": (
+        "SELECT * FROM users WHERE group_id = 1",
+        ("ix_users_group_id", "ix_users_group_id_version"),
+    ),
+    "user by netid": ("SELECT * FROM users WHERE netid = 'x'", "ix_users_netid"),
+    "tasks by group": ("SELECT * FROM tasks WHERE group_id = 1", "ix_tasks_group_id"),
+    "comments by post": (
+        "SELECT * FROM comments WHERE post_id = 1",
+        ("ix_comments_post_id", "ix_comments_post_id_version"),
+    ),
+    "tasks due in range": (
+        "SELECT * FROM tasks"
+        " WHERE due_date >= '2024-01-01' AND due_date < '2024-01-08'",
+        "ix_tasks_due_date",
+    ),
+    "group tasks due in range": (
+        "SELECT * FROM tasks WHERE group_id = 1 AND due_date >= '2024-01-01'",
+        "ix_tasks_group_id_due_date",
+    ),
+    "posts since": (
+        "SELECT * FROM posts WHERE timestamp >= '2024-01-01'",
+        "ix_posts_timestamp",
+    ),
+    "comments since": (
+        "SELECT * FROM comments WHERE timestamp >= '2024-01-01'",
+        "ix_comments_timestamp",
+    ),
+    "group members page": (
+        "SELECT * FROM users WHERE group_id = 1 AND id > 10 ORDER BY id LIMIT 101",
+        "ix_users_group_id",
+    ),
+    "group tasks page": (
+        "SELECT * FROM tasks WHERE group_id = 1 AND id > 10 ORDER BY id LIMIT 101",
+        "ix_tasks_group_id",
+    ),
+    "group tasks page by due date": (
+        "SELECT * FROM tasks WHERE group_id = 1 AND due_date >= '2024-01-01'"
+        " ORDER BY due_date, id LIMIT 101",
+        "ix_tasks_group_id_due_date",
+    ),
+    "users by netids": (
+        "SELECT * FROM users WHERE netid IN ('x', 'y')",
+        "ix_users_netid",
+    ),
+    "group member changes": (
+        "SELECT * FROM users WHERE group_id = 1 AND version > 10 ORDER BY version",
+        "ix_users_group_id_version",
+    ),
+    "group task changes": (
+        "SELECT * FROM tasks WHERE group_id = 1 AND version > 10 ORDER BY version",
+        "ix_tasks_group_id_version",
+    ),
+    "post comment changes": (
+        "SELECT * FROM comments WHERE post_id = 1 AND version > 10 ORDER BY version",
+        "ix_comments_post_id_version",
+    ),
+    "archive candidates": (
+        "SELECT id FROM posts WHERE timestamp < '2024-01-01'"
+        " ORDER BY timestamp, id LIMIT 500",
+        "ix_posts_timestamp",
+    ),
+    "archived comments by post": (
+        "SELECT * FROM comments_archive WHERE post_id = 1",
+        "ix_comments_archive_post_id",
+    ),
+    "tombstones": (
+        "SELECT * FROM tombstones WHERE parent_kind = 'group' AND parent_id = 1"
+        " AND version > 10 ORDER BY version",
+        "ix_tombstones_parent",
+    ),
+}
+
+
+def schema_version(conn):
+    """
+    Returns the number of migrations applied to the database
+    """
+
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def migrate(engine):
+    """
+    Applies every pending migration, each in its own transaction together
+    with its user_version bump, and returns the versions applied
+    """
+
+    applied = []
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        with engine.begin() as conn:
+            # pysqlite only begins a transaction before DML, so without this
+            # every CREATE and PRAGMA ahead of the first INSERT or UPDATE
+            # would commit on its own and a failed migration would be left
+            # half applied
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            if schema_version(conn) >= version:
+                continue
+            migration(conn)
+            conn.exec_driver_sql("PRAGMA user_version = %d" % version)
+        applied.append(version)
+    return applied
+
+
+def check_query_plans(engine):
+    """
+    Runs EXPLAIN QUERY PLAN over HOT_QUERIES and returns (name, plan, ok)
+    for each, where ok means an expected index is used
+    """
+
+    results = []
+    with engine.connect() as conn:
+        for name, (query, index) in HOT_QUERIES.items():
+            rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + query).fetchall()
+            plan = "; ".join(row[-1] for row in rows)
+            indexes = (index,) if isinstance(index, str) else index
+            used = any("INDEX %s " % name in plan + " " for name in indexes)
+            results.append((name, plan, used))
+    return results
+
+
+def init_migrations(app, db):
+    """
+    Registers the flask migrate and flask explain commands
+    """
+
+    @app.cli.command("migrate")
+    def migrate_command():
+        """
+        Creates missing tables and applies pending schema migrations
+        """
+
+        db.create_all()
+        applied = migrate(db.engine)
+        click.echo("Applied migrations: %s" % (applied or "none"))
+        click.echo("Schema version: %d" % len(MIGRATIONS))
+
+    @app.cli.command("explain")
+    def explain_command():
+        """
+        Checks that the hot lookup queries use their indexes
+        """
+
+        failed = False
+        for name, plan, ok in check_query_plans(db.engine):
+            click.echo("%s %s: %s" % ("ok  " if ok else "FAIL", name, plan))
+            failed = failed or not ok
+        if failed:
+            raise click.ClickException("Some hot queries do not use an index")
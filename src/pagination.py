@@ -0,0 +1,230 @@
+from datetime import datetime
+
+from encoders import iter_list_document, iter_ndjson
+from flask import Response, stream_with_context
+from sqlalchemy import and_, or_
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 500
+STREAM_FORMATS = ("json", "ndjson")
+
+
+class Ordering:
+    """
+    A keyset ordering over an optional sort column with the id column as
+    tiebreak. Cursors are the last id, or "<sort value>~<id>" when there is
+    a sort column; sort columns hold datetimes.
+    """
+
+    def __init__(self, id_column, sort_column=None, descending=False):
+        """
+        Initializes an ordering
+        """
+
+        self.id_column = id_column
+        self.sort_column = sort_column
+        self.descending = descending
+
+    def parse_cursor(self, text):
+        """
+        Parses an after parameter into the value filter() expects. Raises
+        ValueError on a malformed cursor.
+        """
+
+        if self.sort_column is None:
+            if not text.isdigit():
+                raise ValueError("after must be a non-negative integer")
+            return int(text)
+        value, _, last_id = text.rpartition("~")
+        if not last_id.isdigit():
+            raise ValueError("after must be a cursor returned as next_cursor")
+        try:
+            return datetime.fromisoformat(value), int(last_id)
+        except ValueError:
+            raise ValueError("after must be a cursor returned as next_cursor")
+
+    def position(self, row):
+        """
+        Returns the value filter() expects to resume just past row
+        """
+
+        if self.sort_column is None:
+            return row.id
+        return getattr(row, self.sort_column.key), row.id
+
+    def cursor(self, row):
+        """
+        Returns the next_cursor pointing just past row
+        """
+
+        if self.sort_column is None:
+            return row.id
+        value, last_id = self.position(row)
+        return "%s~%d" % (value.isoformat(), last_id)
+
+    def filter(self, query, after):
+        """
+        Keeps the rows that come after the cursor value after
+        """
+
+        if self.sort_column is None:
+            if self.descending:
+                return query.filter(self.id_column < after)
+            return query.filter(self.id_column > after)
+        value, last_id = after
+        if self.descending:
+            beyond = self.sort_column < value
+        else:
+            beyond = self.sort_column > value
+        tie = and_(self.sort_column == value, self.id_column > last_id)
+        return query.filter(or_(beyond, tie))
+
+    def order(self, query):
+        """
+        Orders a query by the sort column, then id
+        """
+
+        if self.sort_column is None:
+            if self.descending:
+                return query.order_by(self.id_column.desc())
+            return query.order_by(self.id_column)
+        if self.descending:
+            return query.order_by(self.sort_column.desc(), self.id_column)
+        return query.order_by(self.sort_column, self.id_column)
+
+
+def parse_list_args(args, model, sort_columns=()):
+    """
+    Parses the limit, after, order and stream query parameters of a list
+    endpoint over model
+
+    order names "id" or one of sort_columns, prefixed with "-" for
+    descending order. Returns a (limit, after, stream, ordering) tuple.
+    limit is None when the client did not ask for a page, so existing
+    clients keep getting the full list. Raises ValueError with a client
+    facing message on bad input.
+    """
+
+    limit = args.get("limit")
+    after = args.get("after")
+    stream = args.get("stream")
+    order = args.get("order", "id")
+    name = order[1:] if order.startswith("-") else order
+    if name == "id":
+        ordering = Ordering(model.id, None, order.startswith("-"))
+    elif name in sort_columns:
+        ordering = Ordering(model.id, getattr(model, name), order.startswith("-"))
+    else:
+        names = ", ".join(("id",) + tuple(sort_columns))
+        raise ValueError("order must be one of: %s" % names)
+    if limit is not None:
+        if not limit.isdigit() or int(limit) < 1:
+            raise ValueError("limit must be a positive integer")
+        limit = min(int(limit), MAX_PAGE_SIZE)
+    if after is not None:
+        after = ordering.parse_cursor(after)
+        if limit is None:
+            limit = DEFAULT_PAGE_SIZE
+    if stream is not None and stream not in STREAM_FORMATS:
+        raise ValueError("stream must be one of: %s" % ", ".join(STREAM_FORMATS))
+    return limit, after, stream, ordering
+
+
+def apply_filters(query, args, filters):
+    """
+    Applies the filters named in args to a query
+
+    filters maps a query parameter to (column, operator, parse): the
+    parameter's value is converted with parse and compared to column with
+    operator. Raises ValueError when parse rejects a value.
+    """
+
+    for name, (column, operator, parse) in filters.items():
+        if name not in args:
+            continue
+        try:
+            value = parse(args[name])
+        except ValueError:
+            raise ValueError("Invalid %s: %s" % (name, args[name]))
+        query = query.filter(operator(column, value))
+    return query
+
+
+def rebind_filters(filters, model):
+    """
+    Returns filters with every column swapped for the column of the same
+    name on model, so one set of filters serves several views of a table
+    """
+
+    return {
+        name: (getattr(model, column.key), operator, parse)
+        for name, (column, operator, parse) in filters.items()
+    }
+
+
+def keyset(query, ordering, after, limit):
+    """
+    Applies a cursor to a query: rows past after, in ordering, at most
+    limit rows
+    """
+
+    if after is not None:
+        query = ordering.filter(query, after)
+    query = ordering.order(query)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def paginate(query, ordering, limit, after):
+    """
+    Fetches one page of a query and returns (rows, next_cursor)
+
+    One extra row is read to know whether another page exists, so the last
+    page returns a next_cursor of None.
+    """
+
+    if limit is None:
+        return keyset(query, ordering, after, None).all(), None
+    rows = keyset(query, ordering, after, limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, ordering.cursor(rows[-1])
+
+
+def iter_chunks(query, ordering, after=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yields lists of rows from a query in keyset ordered chunks
+
+    Each chunk is its own bounded SELECT, so no more than chunk_size rows
+    are held at once regardless of how big the table is.
+    """
+
+    while True:
+        rows = keyset(query, ordering, after, chunk_size).all()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        after = ordering.position(rows[-1])
+
+
+def stream_response(query, ordering, key, serialize, fmt, after=None):
+    """
+    Streams every row of a query as a chunked JSON or NDJSON response
+
+    JSON output has the same shape as the paged response, {key: [...],
+    "next_cursor": null}, so clients can switch between the two freely.
+    """
+
+    chunks = iter_chunks(query, ordering, after)
+    if fmt == "ndjson":
+        return Response(
+            stream_with_context(iter_ndjson(chunks, serialize)),
+            mimetype="application/x-ndjson",
+        )
+    document = iter_list_document(key, chunks, serialize, {"next_cursor": None})
+    return Response(stream_with_context(document), mimetype="application/json")
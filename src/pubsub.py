@@ -0,0 +1,247 @@
+import itertools
+import queue
+import threading
+
+from encoders import STDLIB
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+KEEPALIVE_SECONDS = 15
+RETRY_MILLISECONDS = 3000
+MAX_QUEUE = 100
+MAX_SUBSCRIBERS = 1000
+
+
+class Subscription:
+    """
+    One subscriber's bounded queue of (id, event, data) messages
+
+    A subscriber that falls max_queue messages behind is dropped rather
+    than slowing down publishers or growing without bound. Its stream then
+    tells the client to resync from the change feed.
+    """
+
+    def __init__(self, broker, channel, max_queue):
+        """
+        Initializes a subscription to channel of broker
+        """
+
+        self.broker = broker
+        self.channel = channel
+        self.queue = queue.Queue(max_queue)
+        self.overflowed = False
+        self.closed = False
+
+    def offer(self, message):
+        """
+        Queues a message without blocking. Returns False when the queue is
+        full and the subscriber has been marked as overflowed.
+        """
+
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except queue.Full:
+            self.overflowed = True
+            return False
+
+
+class LocalBackend:
+    """
+    Fan-out backend for a single process: publishing delivers straight to
+    this process's subscribers. A backend for several worker processes
+    (Redis pub/sub, Postgres LISTEN/NOTIFY, ...) provides the same publish
+    method and calls deliver for every message it receives.
+    """
+
+    def __init__(self, deliver):
+        """
+        Initializes a backend that hands messages to deliver
+        """
+
+        self.deliver = deliver
+
+    def publish(self, channel, event, data):
+        """
+        Sends a message to every process, including this one
+        """
+
+        self.deliver(channel, event, data)
+
+
+BACKENDS = {"local": LocalBackend}
+
+
+class Broker:
+    """
+    In-process pub/sub of events to server-sent event streams, keyed by
+    channel names such as "post:1" or "group:2"
+    """
+
+    def __init__(
+        self, max_queue=MAX_QUEUE, max_subscribers=MAX_SUBSCRIBERS, encoder=STDLIB
+    ):
+        """
+        Initializes a broker with the local backend, which encodes event data
+        with encoder
+        """
+
+        self.max_queue = max_queue
+        self.max_subscribers = max_subscribers
+        self.encoder = encoder
+        self.channels = {}
+        self.subscribers = 0
+        self.published = 0
+        self.dropped = 0
+        self.ids = itertools.count(1)
+        self.backend = LocalBackend(self.deliver)
+        self.lock = threading.Lock()
+
+    def subscribe(self, channel):
+        """
+        Returns a new subscription to channel, or None when the broker is
+        at max_subscribers
+        """
+
+        with self.lock:
+            if self.subscribers >= self.max_subscribers:
+                return None
+            subscription = Subscription(self, channel, self.max_queue)
+            self.channels.setdefault(channel, set()).add(subscription)
+            self.subscribers += 1
+            return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Removes a subscription; removing it twice is harmless
+        """
+
+        with self.lock:
+            subscriptions = self.channels.get(subscription.channel, set())
+            if subscription not in subscriptions:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.channels[subscription.channel]
+            self.subscribers -= 1
+
+    def publish(self, channel, event, data):
+        """
+        Publishes an event with JSON serializable data to channel. Call it
+        after the change has been committed.
+        """
+
+        self.backend.publish(channel, event, data)
+
+    def deliver(self, channel, event, data):
+        """
+        Queues a message for every subscriber of channel in this process
+        and drops the subscribers whose queues are full
+        """
+
+        with self.lock:
+            subscriptions = list(self.channels.get(channel, ()))
+            self.published += 1
+        if not subscriptions:
+            return
+        message = (next(self.ids), event, self.encoder.dumps(data))
+        for subscription in subscriptions:
+            if not subscription.offer(message):
+                self.unsubscribe(subscription)
+                with self.lock:
+                    self.dropped += 1
+
+    def close_all(self):
+        """
+        Ends every subscriber's stream, for a worker that is shutting down
+        """
+
+        with self.lock:
+            subscriptions = [s for group in self.channels.values() for s in group]
+        for subscription in subscriptions:
+            subscription.closed = True
+            try:
+                # wakes a stream waiting for its next message; a stream
+                # whose queue is full is not waiting
+                subscription.queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def stats(self):
+        """
+        Returns the broker's counters
+        """
+
+        with self.lock:
+            return {
+                "channels": len(self.channels),
+                "subscribers": self.subscribers,
+                "published": self.published,
+                "dropped": self.dropped,
+            }
+
+
+# the current app's broker; every app built by create_app has its own
+broker = LocalProxy(lambda: current_app.extensions["broker"])
+
+
+def init_pubsub(app):
+    """
+    Gives app a broker configured from its PUBSUB_BACKEND, PUBSUB_MAX_QUEUE
+    and PUBSUB_MAX_SUBSCRIBERS config, which encodes event data with app's
+    JSON backend. PUBSUB_STREAMS_ENABLED turns the event stream routes off,
+    for servers whose backend cannot reach every stream.
+    """
+
+    app.config.setdefault("PUBSUB_STREAMS_ENABLED", True)
+    app.config.setdefault("PUBSUB_BACKEND", "local")
+    app.config.setdefault("PUBSUB_MAX_QUEUE", MAX_QUEUE)
+    app.config.setdefault("PUBSUB_MAX_SUBSCRIBERS", MAX_SUBSCRIBERS)
+    if app.config["PUBSUB_BACKEND"] not in BACKENDS:
+        raise ValueError("Unknown pub/sub backend %r" % app.config["PUBSUB_BACKEND"])
+    app_broker = Broker(
+        app.config["PUBSUB_MAX_QUEUE"],
+        app.config["PUBSUB_MAX_SUBSCRIBERS"],
+        app.extensions["json_encoder"],
+    )
+    app_broker.backend = BACKENDS[app.config["PUBSUB_BACKEND"]](app_broker.deliver)
+    app.extensions["broker"] = app_broker
+
+
+def iter_events(subscription):
+    """
+    Yields a subscription's messages as server-sent events, with a comment
+    line every KEEPALIVE_SECONDS so proxies keep the connection open
+
+    An overflowed subscription gets a final "resync" event once its queue
+    is drained, and a closed one ends without one. Unsubscribes when the
+    client goes away.
+    """
+
+    try:
+        yield b"retry: %d\n\n" % RETRY_MILLISECONDS
+        while True:
+            try:
+                message = subscription.queue.get(timeout=KEEPALIVE_SECONDS)
+            except queue.Empty:
+                message = None
+            if subscription.closed:
+                return
+            if message is None:
+                if subscription.overflowed:
+                    yield b"event: resync\ndata: {}\n\n"
+                    return
+                yield b": keepalive\n\n"
+                continue
+            message_id, event, data = message
+            yield b"id: %d\nevent: %s\ndata: %s\n\n" % (
+                message_id,
+                event.encode("utf-8"),
+                data,
+            )
+            if subscription.overflowed and subscription.queue.empty():
+                yield b"event: resync\ndata: {}\n\n"
+                return
+    finally:
+        # runs after the request has ended, so through the subscription
+        subscription.broker.unsubscribe(subscription)
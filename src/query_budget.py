@@ -0,0 +1,58 @@
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    Raised when a route issues more SQL statements than its budget allows
+    """
+
+
+def query_budget(limit):
+    """
+    Decorator that sets the maximum number of SQL statements a route may
+    issue per request. Put it below @api.route.
+    """
+
+    def decorator(view):
+        view.query_budget = limit
+        return view
+
+    return decorator
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    """
+    Engine listener that counts statements issued during the current request
+    """
+
+    if has_request_context():
+        g.query_count = g.get("query_count", 0) + 1
+
+
+def init_query_budget(app):
+    """
+    Installs the query budget guard on app
+
+    The guard is on when the app is testing, or when QUERY_BUDGET_ENABLED is
+    set. Routes without @query_budget fall back to QUERY_BUDGET_DEFAULT, and
+    are unchecked when that is None.
+    """
+
+    app.config.setdefault("QUERY_BUDGET_DEFAULT", None)
+    if not event.contains(Engine, "before_cursor_execute", count_query):
+        event.listen(Engine, "before_cursor_execute", count_query)
+
+    @app.after_request
+    def check_query_budget(response):
+        if not app.config.get("QUERY_BUDGET_ENABLED", app.testing):
+            return response
+        view = app.view_functions.get(request.endpoint)
+        limit = getattr(view, "query_budget", app.config["QUERY_BUDGET_DEFAULT"])
+        count = g.get("query_count", 0)
+        if limit is not None and count > limit:
+            raise QueryBudgetExceeded(
+                "%s issued %d queries, budget is %d" % (request.endpoint, count, limit)
+            )
+        return response
@@ -0,0 +1,344 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from db import db
+from flask import current_app, has_app_context, request
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from werkzeug.http import http_date, quote_etag
+from werkzeug.local import LocalProxy
+
+# Every invalidation is logged in the database in the same transaction as
+# the change, by write routes and by commands such as flask archive alike,
+# so it reaches every worker process. Before serving a hit, a process
+# applies the tags logged since it last looked, at most every
+# RESPONSE_CACHE_SYNC_SECONDS. A trigger keeps the log's last 10000
+# tags; a process that fell further behind, or that reads EVERY_TAG, drops
+# everything.
+CREATE_INVALIDATION_LOG = (
+    "CREATE TABLE IF NOT EXISTS cache_invalidations (id INTEGER PRIMARY KEY"
+    " AUTOINCREMENT, tag TEXT NOT NULL)"
+)
+TRIM_INVALIDATION_LOG = (
+    "CREATE TRIGGER IF NOT EXISTS cache_invalidations_trim AFTER INSERT ON"
+    " cache_invalidations BEGIN DELETE FROM cache_invalidations WHERE id <="
+    " NEW.id - 10000; END"
+)
+MAX_ENTRIES = 1024
+MAX_BYTES = 64 * 1024 * 1024
+SYNC_SECONDS = 1.0
+EVERY_TAG = "*"
+# session.info key of the tags to drop from this process's cache on commit
+PENDING_TAGS = "response_cache_tags"
+
+
+class CacheEntry:
+    """
+    A cached response body with its validators and invalidation tags
+    """
+
+    def __init__(self, body, code, tags):
+        """
+        Initializes a cache entry
+        """
+
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.body = body
+        self.code = code
+        self.tags = tags
+        self.size = len(body)
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.last_modified = http_date(time.time())
+
+
+class ResponseCache:
+    """
+    In-process LRU cache of GET response bodies, capped by entry count and
+    total body bytes, and invalidated by tag
+    """
+
+    def __init__(
+        self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, sync_seconds=SYNC_SECONDS
+    ):
+        """
+        Initializes an empty cache
+        """
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.tag_index = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0
+        self.sync_seconds = sync_seconds
+        self.synced_id = None
+        self.synced_at = None
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the entry for key, or None, and counts the hit or miss
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, code, tags, generation):
+        """
+        Stores a response body under key, evicting least recently used
+        entries until the cache fits its caps again
+
+        generation is the value of self.generation from before the body was
+        read. If anything was invalidated since, the body may be stale and
+        is not stored.
+        """
+
+        entry = CacheEntry(body, code, tags)
+        if entry.size > self.max_bytes:
+            return entry
+        with self.lock:
+            if generation != self.generation:
+                return entry
+            self.discard(key)
+            self.entries[key] = entry
+            self.size += entry.size
+            for tag in tags:
+                self.tag_index.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self.discard(next(iter(self.entries)))
+                self.evictions += 1
+        return entry
+
+    def discard(self, key):
+        """
+        Removes key from the cache. The caller must hold the lock.
+        """
+
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry.size
+        for tag in entry.tags:
+            keys = self.tag_index.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tag_index[tag]
+
+    def invalidate(self, *tags):
+        """
+        Drops every entry carrying any of tags
+        """
+
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                for key in list(self.tag_index.get(tag, ())):
+                    self.discard(key)
+                    self.invalidations += 1
+
+    def sync(self, session):
+        """
+        Applies the tags logged since the last sync through session, unless
+        that was less than sync_seconds ago, and returns whether it dropped
+        anything. The first sync drops every entry, since what was logged
+        before it is unknown.
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            if self.synced_at is not None and now - self.synced_at < self.sync_seconds:
+                return False
+            self.synced_at = now
+            after = self.synced_id
+        if after is None:
+            top = session.execute(text("SELECT MAX(id) FROM cache_invalidations"))
+            self.synced_id = top.scalar() or 0
+            self.clear()
+            return True
+        rows = session.execute(
+            text(
+                "SELECT id, tag FROM cache_invalidations WHERE id > :after"
+                " ORDER BY id"
+            ),
+            {"after": after},
+        ).fetchall()
+        if not rows:
+            return False
+        self.synced_id = rows[-1].id
+        tags = set(row.tag for row in rows)
+        # a gap means the log was trimmed past what this process applied
+        if rows[0].id > after + 1 or EVERY_TAG in tags:
+            self.clear()
+        else:
+            self.invalidate(*tags)
+        return True
+
+    def clear(self):
+        """
+        Drops every entry
+        """
+
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.tag_index.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Serializes the cache counters
+        """
+
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+# the current app's cache; every app built by create_app has its own
+response_cache = LocalProxy(lambda: current_app.extensions["response_cache"])
+
+
+def create_invalidation_log(conn):
+    """
+    Creates the table other processes log cache invalidations in
+    """
+
+    conn.exec_driver_sql(CREATE_INVALIDATION_LOG)
+
+
+def trim_invalidation_log(conn):
+    """
+    Creates the trigger that keeps the last 10000 entries of the
+    invalidation log, so logging a write is a single statement
+    """
+
+    conn.exec_driver_sql(TRIM_INVALIDATION_LOG)
+
+
+def log_invalidation(conn, tags):
+    """
+    Logs tags for every process's response cache to invalidate, in conn's
+    transaction. EVERY_TAG drops whole caches.
+    """
+
+    conn.exec_driver_sql(
+        "INSERT INTO cache_invalidations (tag) VALUES (?)", [(tag,) for tag in tags]
+    )
+
+
+def invalidate_on_commit(*tags):
+    """
+    Logs tags in db.session's transaction, and drops them from this
+    process's cache as soon as that transaction commits. Call it before the
+    commit of the write the tags cover.
+    """
+
+    log_invalidation(db.session.connection(), tags)
+    db.session.info.setdefault(PENDING_TAGS, set()).update(tags)
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_committed(session):
+    """
+    Drops the tags a committed transaction logged from this process's cache
+    """
+
+    tags = session.info.pop(PENDING_TAGS, None)
+    if tags and has_app_context():
+        response_cache.invalidate(*tags)
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_rolled_back(session):
+    """
+    Forgets the tags of a transaction that rolled back, along with its log
+    entries
+    """
+
+    session.info.pop(PENDING_TAGS, None)
+
+
+def init_response_cache(app):
+    """
+    Gives app a response cache sized from its config, which reads the
+    invalidation log at most every RESPONSE_CACHE_SYNC_SECONDS
+    """
+
+    app.config.setdefault("RESPONSE_CACHE_ENABLED", True)
+    app.config.setdefault("RESPONSE_CACHE_MAX_ENTRIES", MAX_ENTRIES)
+    app.config.setdefault("RESPONSE_CACHE_MAX_BYTES", MAX_BYTES)
+    app.config.setdefault("RESPONSE_CACHE_SYNC_SECONDS", SYNC_SECONDS)
+    app.extensions["response_cache"] = ResponseCache(
+        app.config["RESPONSE_CACHE_MAX_ENTRIES"],
+        app.config["RESPONSE_CACHE_MAX_BYTES"],
+        float(app.config["RESPONSE_CACHE_SYNC_SECONDS"]),
+    )
+
+
+def cached_response(entry):
+    """
+    Turns a cache entry into a response, or a 304 when the client already
+    holds the same representation
+    """
+
+    headers = {"ETag": quote_etag(entry.etag), "Last-Modified": entry.last_modified}
+    if entry.etag in request.if_none_match:
+        return "", 304, headers
+    return entry.body, entry.code, headers
+
+
+def cached(*tags):
+    """
+    Decorator that caches a GET route's successful responses. tags are
+    format strings filled in with the route's arguments, for example
+    "group:{group_id}"; write routes invalidate the same tags. Put it below
+    @api.route and @query_budget, whose budget must allow one statement more
+    than the route needs, for reading the invalidation log.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            if not current_app.config["RESPONSE_CACHE_ENABLED"]:
+                return view(**kwargs)
+            key = request.full_path
+            entry = response_cache.get(key)
+            if entry is not None and response_cache.sync(db.session):
+                entry = response_cache.get(key)
+            if entry is not None:
+                return cached_response(entry)
+            generation = response_cache.generation
+            response = view(**kwargs)
+            if not isinstance(response, tuple) or response[1] != 200:
+                return response
+            body, code = response
+            entry_tags = [tag.format(**kwargs) for tag in tags]
+            entry = response_cache.put(key, body, code, entry_tags, generation)
+            return cached_response(entry)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,174 @@
+import re
+
+import click
+from db import db
+from sqlalchemy import text
+
+# Posts and comments share one FTS5 table. A post is stored at rowid 2 * id
+# and a comment at 2 * id + 1, so every sync is a rowid point write.
+CREATE_SEARCH_INDEX = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+    "kind UNINDEXED, ref_id UNINDEXED, post_id UNINDEXED, title, body, "
+    "tokenize='porter unicode61')"
+)
+INDEX_POSTS = (
+    "INSERT OR REPLACE INTO search_index (rowid, kind, ref_id, post_id, title, body)"
+    " SELECT 2 * id, 'post', id, id, post_name, description FROM posts"
+)
+INDEX_COMMENTS = (
+    "INSERT OR REPLACE INTO search_index (rowid, kind, ref_id, post_id, title, body)"
+    " SELECT 2 * id + 1, 'comment', id, post_id, '', description FROM comments"
+)
+# archived posts and comments keep their entries, under their own ids
+INDEX_ARCHIVED_POSTS = (
+    "INSERT OR REPLACE INTO search_index (rowid, kind, ref_id, post_id, title, body)"
+    " SELECT 2 * id, 'post', id, id, post_name, description FROM posts_archive"
+)
+INDEX_ARCHIVED_COMMENTS = (
+    "INSERT OR REPLACE INTO search_index (rowid, kind, ref_id, post_id, title, body)"
+    " SELECT 2 * id + 1, 'comment', id, post_id, '', description"
+    " FROM comments_archive"
+)
+SEARCH = (
+    "SELECT kind, ref_id, post_id,"
+    " snippet(search_index, -1, '<mark>', '</mark>', '...', 12) AS snippet,"
+    " bm25(search_index, 0, 0, 0, 2.0, 1.0) AS rank"
+    " FROM search_index WHERE search_index MATCH :query %s"
+    " ORDER BY rank LIMIT :limit OFFSET :offset"
+)
+# hits whose post is still in posts, leaving out archived ones
+HOT_ONLY = "AND post_id IN (SELECT id FROM posts)"
+SEARCH_KINDS = ("post", "comment")
+SEARCH_PAGE_SIZE = 20
+TERM = re.compile(r"\w+", re.UNICODE)
+
+
+def create_search_index(conn):
+    """
+    Creates the search table and indexes every existing post and comment
+    """
+
+    conn.exec_driver_sql(CREATE_SEARCH_INDEX)
+    conn.exec_driver_sql(INDEX_POSTS)
+    conn.exec_driver_sql(INDEX_COMMENTS)
+
+
+def index_archive(conn):
+    """
+    Adds every archived post and comment to the search index
+    """
+
+    conn.exec_driver_sql(INDEX_ARCHIVED_POSTS)
+    conn.exec_driver_sql(INDEX_ARCHIVED_COMMENTS)
+
+
+def index_post(post):
+    """
+    Adds or refreshes post in the search index, in the current transaction
+    """
+
+    db.session.execute(text(INDEX_POSTS + " WHERE id = :id"), {"id": post.id})
+
+
+def index_comments(comment_ids):
+    """
+    Adds or refreshes comments in the search index, in the current
+    transaction
+    """
+
+    db.session.execute(
+        text(INDEX_COMMENTS + " WHERE id = :id"),
+        [{"id": comment_id} for comment_id in comment_ids],
+    )
+
+
+def unindex_comment(comment_id):
+    """
+    Removes a comment from the search index
+    """
+
+    db.session.execute(
+        text("DELETE FROM search_index WHERE rowid = 2 * :id + 1"),
+        {"id": comment_id},
+    )
+
+
+def unindex_post(post_id):
+    """
+    Removes a post and all of its comments from the search index. Call it
+    before the comments themselves are deleted.
+    """
+
+    db.session.execute(
+        text(
+            "DELETE FROM search_index WHERE rowid IN"
+            " (SELECT 2 * id + 1 FROM comments WHERE post_id = :id)"
+        ),
+        {"id": post_id},
+    )
+    db.session.execute(
+        text("DELETE FROM search_index WHERE rowid = 2 * :id"),
+        {"id": post_id},
+    )
+
+
+def match_query(q):
+    """
+    Turns free text into an FTS5 query: every word must match, the last one
+    as a prefix so results show up while typing. Returns None when q has no
+    words.
+    """
+
+    terms = TERM.findall(q)
+    if not terms:
+        return None
+    quoted = ['"%s"' % term for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def search(q, kind, limit, offset, archived=False):
+    """
+    Returns one page of ranked search hits for q, including archived posts
+    and comments when archived is true
+    """
+
+    query = match_query(q)
+    if query is None:
+        return []
+    params = {"query": query, "limit": limit, "offset": offset}
+    where = "" if archived else HOT_ONLY
+    if kind is not None:
+        where += " AND kind = :kind"
+        params["kind"] = kind
+    rows = db.session.execute(text(SEARCH % where), params)
+    return [
+        {
+            "type": row.kind,
+            "id": row.ref_id,
+            "post_id": row.post_id,
+            "snippet": row.snippet,
+            "rank": row.rank,
+        }
+        for row in rows
+    ]
+
+
+def init_search(app):
+    """
+    Registers the flask search-rebuild command
+    """
+
+    @app.cli.command("search-rebuild")
+    def search_rebuild_command():
+        """
+        Rebuilds the search index from the posts and comments tables and
+        their archives
+        """
+
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("DROP TABLE IF EXISTS search_index")
+            create_search_index(conn)
+            index_archive(conn)
+            count = conn.exec_driver_sql("SELECT COUNT(*) FROM search_index").scalar()
+        click.echo("Indexed %d posts and comments" % count)
@@ -0,0 +1,424 @@
+"""
+Production server for the StudyMatch API
+
+Builds the app once, binds one listening socket, then forks worker
+processes that each serve requests from that socket with a bounded pool of
+threads. The parent only supervises: it restarts workers that die and, on
+SIGTERM or SIGINT, lets every worker finish its in-flight requests before
+exiting.
+
+    python serve.py --migrate --workers 4 --threads 8 --port 8000
+
+Workers and threads can also be set with STUDYMATCH_WORKERS and
+STUDYMATCH_THREADS, and the app itself reads its usual STUDYMATCH_
+environment variables.
+
+Every worker keeps its own response cache. Writes log what they change in
+the database, and with several workers each one checks that log before
+every hit it serves, so a worker stops serving a cached response as soon
+as another worker's write to the same data commits. Setting
+STUDYMATCH_RESPONSE_CACHE_SYNC_SECONDS checks less often, at the cost of
+serving such responses for up to that long.
+
+Server-sent event streams do not count against --threads: each one runs on
+a thread of its own, at most --streams of them per worker, and they are
+ended when the worker shuts down. The local pub/sub backend only reaches
+streams on the worker that made a change, so with several workers the
+stream routes answer 503 unless the app is configured with a backend every
+worker shares.
+
+Admission control is off unless STUDYMATCH_ADMISSION_ENABLED is true.
+Behind a reverse proxy, also set STUDYMATCH_ADMISSION_CLIENT_HEADER to a
+header the proxy overwrites with the client's address, such as
+X-Real-IP; otherwise every client shares the proxy's rate limit buckets.
+"""
+
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger("studymatch.serve")
+
+LISTEN_BACKLOG = 1024
+STREAMS_PER_WORKER = 64
+GRACEFUL_TIMEOUT_SECONDS = 30
+# a worker dying sooner than this after being forked is restarted only after
+# the same delay, so a worker that cannot start does not fork in a loop
+RESTART_DELAY_SECONDS = 1
+
+
+class Shutdown(Exception):
+    """
+    Raised in the supervisor when it is asked to stop
+    """
+
+
+class PooledRequestHandler(WSGIRequestHandler):
+    """
+    Request handler that closes every connection after its response, so an
+    idle keep-alive client never holds one of a worker's threads
+    """
+
+    protocol_version = "HTTP/1.0"
+
+    def log_request(self, *args, **kwargs):
+        """
+        Logs the request only when the server has access logging on
+        """
+
+        if self.server.access_log:
+            super().log_request(*args, **kwargs)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    WSGI server that serves at most threads requests at once from an
+    inherited listening socket
+
+    A worker with every thread busy stops accepting, leaving new
+    connections in the shared backlog for the other workers. A connection
+    that turns into a server-sent event stream gives its slot back, since
+    it stays open for as long as its client is connected.
+    """
+
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, host, port, app, threads, fd, access_log=False):
+        """
+        Initializes a server on the listening socket fd
+        """
+
+        super().__init__(host, port, app, handler=PooledRequestHandler, fd=fd)
+        # every worker selects on the shared socket, and the ones that lose
+        # the race to accept get EAGAIN instead of blocking
+        self.socket.setblocking(False)
+        self.threads = threads
+        self.slots = threading.BoundedSemaphore(threads)
+        self.access_log = access_log
+        self.app = self.serve_streams(app)
+        self.connection = threading.local()
+        self.streams = 0
+        self.streams_done = threading.Condition()
+
+    def serve_streams(self, app):
+        """
+        Wraps app so that a connection answering with an event stream
+        leaves the thread slot budget as soon as its headers are ready
+        """
+
+        def application(environ, start_response):
+            def start_stream_response(status, headers, exc_info=None):
+                for name, value in headers:
+                    if name.lower() == "content-type" and value.startswith(
+                        "text/event-stream"
+                    ):
+                        self.start_stream()
+                return start_response(status, headers, exc_info)
+
+            return app(environ, start_stream_response)
+
+        return application
+
+    def start_stream(self):
+        """
+        Moves the current connection from the thread slots to the streams
+        """
+
+        if self.connection.streaming:
+            return
+        self.connection.streaming = True
+        with self.streams_done:
+            self.streams += 1
+        self.slots.release()
+
+    def get_request(self):
+        """
+        Waits for a free thread, then accepts a connection
+        """
+
+        self.slots.acquire()
+        try:
+            request, client_address = super().get_request()
+        except BaseException:
+            self.slots.release()
+            raise
+        request.setblocking(True)
+        return request, client_address
+
+    def process_request(self, request, client_address):
+        """
+        Serves an accepted connection on its own thread
+        """
+
+        thread = threading.Thread(
+            target=self.process_request_thread,
+            args=(request, client_address),
+            daemon=True,
+        )
+        thread.start()
+
+    def process_request_thread(self, request, client_address):
+        """
+        Serves one connection and frees its thread slot, or its place among
+        the streams
+        """
+
+        self.connection.streaming = False
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            if self.connection.streaming:
+                with self.streams_done:
+                    self.streams -= 1
+                    self.streams_done.notify_all()
+            else:
+                self.slots.release()
+
+    def drain(self, timeout):
+        """
+        Waits up to timeout seconds for in-flight requests and streams to
+        finish and returns whether they all did
+        """
+
+        deadline = time.monotonic() + timeout
+        for _ in range(self.threads):
+            if not self.slots.acquire(timeout=max(0, deadline - time.monotonic())):
+                return False
+        with self.streams_done:
+            while self.streams:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.streams_done.wait(remaining)
+        return True
+
+
+def listen(host, port, backlog=LISTEN_BACKLOG):
+    """
+    Binds the listening socket every worker accepts from
+    """
+
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def interrupt(signum, frame):
+    """
+    Signal handler that stops a worker's accept loop
+    """
+
+    raise KeyboardInterrupt
+
+
+def run_worker(app, sock, args):
+    """
+    Serves requests until SIGTERM or SIGINT, then ends the event streams
+    and waits for the in-flight requests. Runs in a forked child.
+    """
+
+    signal.signal(signal.SIGTERM, interrupt)
+    signal.signal(signal.SIGINT, interrupt)
+    server = PooledWSGIServer(
+        args.host, args.port, app, args.threads, sock.fileno(), args.access_log
+    )
+    logger.info("worker %d serving with %d threads", os.getpid(), args.threads)
+    # returns on KeyboardInterrupt and closes this worker's copy of the socket
+    server.serve_forever()
+    app.extensions["broker"].close_all()
+    if not server.drain(args.graceful_timeout):
+        logger.warning("worker %d exiting with requests in flight", os.getpid())
+
+
+def spawn(app, sock, args):
+    """
+    Forks a worker and returns its pid
+    """
+
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 0
+    try:
+        run_worker(app, sock, args)
+    except BaseException:
+        logger.exception("worker %d failed", os.getpid())
+        code = 1
+    finally:
+        logging.shutdown()
+        os._exit(code)
+
+
+def stop(signum, frame):
+    """
+    Signal handler that stops the supervisor
+    """
+
+    raise Shutdown
+
+
+def supervise(app, sock, args):
+    """
+    Starts the workers and keeps their number up until SIGTERM or SIGINT,
+    then stops them and waits for them to exit
+    """
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    workers = {}
+    try:
+        for _ in range(args.workers):
+            workers[spawn(app, sock, args)] = time.monotonic()
+        while True:
+            pid, status = os.wait()
+            started = workers.pop(pid, None)
+            if started is None:
+                continue
+            logger.warning("worker %d exited with status %d", pid, status)
+            if time.monotonic() - started < RESTART_DELAY_SECONDS:
+                time.sleep(RESTART_DELAY_SECONDS)
+            workers[spawn(app, sock, args)] = time.monotonic()
+    except Shutdown:
+        pass
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in workers:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("STUDYMATCH_WORKERS", os.cpu_count() or 1)),
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=int(os.environ.get("STUDYMATCH_THREADS", 8)),
+        help="concurrent requests per worker",
+    )
+    parser.add_argument(
+        "--streams",
+        type=int,
+        default=int(os.environ.get("STUDYMATCH_STREAMS", STREAMS_PER_WORKER)),
+        help="open event streams per worker, on threads of their own",
+    )
+    parser.add_argument(
+        "--graceful-timeout", type=float, default=GRACEFUL_TIMEOUT_SECONDS
+    )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="create and migrate the schema once before starting workers",
+    )
+    parser.add_argument("--access-log", action="store_true")
+    args = parser.parse_args(argv)
+    if args.workers < 1 or args.threads < 1:
+        parser.error("--workers and --threads must be at least 1")
+    if args.streams < 0:
+        parser.error("--streams must not be negative")
+    return args
+
+
+def main(argv=None):
+    """
+    Builds the app, then serves it from pre-forked workers
+    """
+
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(process)d %(message)s"
+    )
+    from app import create_app
+    from db import db
+    from migrations import migrate
+
+    # every worker holds its own response cache and reads the other
+    # workers' invalidations from the database before serving a hit, on
+    # every hit with several workers unless
+    # STUDYMATCH_RESPONSE_CACHE_SYNC_SECONDS says otherwise. Event streams
+    # are off with several workers, since the local pub/sub backend only
+    # reaches its own worker's streams, unless
+    # STUDYMATCH_PUBSUB_STREAMS_ENABLED turns them on for a shared backend.
+    config = {
+        "PUBSUB_STREAMS_ENABLED": args.workers == 1 and args.streams > 0,
+        "PUBSUB_MAX_SUBSCRIBERS": args.streams,
+    }
+    if args.workers > 1:
+        config["RESPONSE_CACHE_SYNC_SECONDS"] = 0
+    app = create_app(config)
+    if args.migrate:
+        with app.app_context():
+            db.create_all()
+            applied = migrate(db.engine)
+            for engine in db.engines.values():
+                engine.dispose()
+        logger.info("applied migrations: %s", applied or "none")
+    if (
+        args.workers > 1
+        and app.config["PUBSUB_STREAMS_ENABLED"]
+        and app.config["PUBSUB_BACKEND"] == "local"
+    ):
+        logger.error(
+            "the local pub/sub backend only delivers events to streams on the"
+            " worker that made the change; serve event streams with one worker"
+            " or a shared backend"
+        )
+        return 2
+    if (
+        args.workers > 1
+        and app.config["ADMISSION_ENABLED"]
+        and app.config["ADMISSION_BACKEND"] == "local"
+    ):
+        logger.warning(
+            "the local admission backend keeps separate rate limit buckets in"
+            " every worker, so clients get up to %d times their rate",
+            args.workers,
+        )
+    sock = listen(args.host, args.port)
+    logger.info(
+        "listening on %s:%d with %d workers",
+        args.host,
+        sock.getsockname()[1],
+        args.workers,
+    )
+    # keep the preloaded app out of the collector's reach so workers share
+    # its memory pages instead of copying them
+    gc.freeze()
+    supervise(app, sock, args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
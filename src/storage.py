@@ -0,0 +1,170 @@
+import logging
+import os
+import random
+import weakref
+
+from flask import has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger("studymatch.sql")
+
+READ_BIND = "read"
+READ_METHODS = ("GET", "HEAD")
+
+# connection pragmas and pool sizes per storage profile
+STORAGE_PROFILES = {
+    "development": {
+        "pragmas": {"busy_timeout": 5000},
+        "write_pool_size": 1,
+        "read_pool_size": 0,
+    },
+    "production": {
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": 5000,
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -64 * 1024,
+            "temp_store": "MEMORY",
+        },
+        "write_pool_size": 2,
+        "read_pool_size": 8,
+    },
+}
+
+
+# engines whose pools are reset in forked children
+fork_engines = weakref.WeakSet()
+
+
+def reset_pools_after_fork():
+    """
+    Drops the pooled connections a forked child inherited, without closing
+    them under its parent, so every process opens its own SQLite
+    connections
+    """
+
+    for engine in list(fork_engines):
+        engine.dispose(close=False)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_pools_after_fork)
+
+
+class RoutingSession(Session):
+    """
+    Session that sends reads made while serving GET and HEAD requests to the
+    read-only pool, so readers never queue behind the writer
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        """
+        Selects the read engine for GET requests when one is configured
+        """
+
+        engines = self._db.engines
+        if (
+            bind is None
+            and READ_BIND in engines
+            and not self._flushing
+            and has_request_context()
+            and request.method in READ_METHODS
+        ):
+            return engines[READ_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def engine_options(pool_size, busy_timeout):
+    """
+    Explicit pool settings for one SQLite engine. Pooled connections move
+    between threads, so pysqlite's same thread check is turned off.
+    """
+
+    return {
+        "poolclass": QueuePool,
+        "pool_size": pool_size,
+        "max_overflow": pool_size,
+        "pool_timeout": busy_timeout / 1000,
+        "connect_args": {"check_same_thread": False, "timeout": busy_timeout / 1000},
+    }
+
+
+def set_pragmas(engine, pragmas):
+    """
+    Runs pragmas on every new connection of engine
+    """
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s=%s" % (name, value))
+        cursor.close()
+
+
+def log_sampled(rate):
+    """
+    Returns an engine listener that logs about rate of all statements
+    """
+
+    def log_statement(conn, cursor, statement, parameters, context, executemany):
+        if random.random() < rate:
+            logger.info("%s %r", statement, parameters)
+
+    return log_statement
+
+
+def init_storage(app, db):
+    """
+    Configures the database from app's config and binds db to app
+
+    DB_PATH is the SQLite file, relative to the instance folder.
+    STORAGE_PROFILE picks an entry of STORAGE_PROFILES, and STORAGE_PRAGMAS
+    overrides single pragmas of it. SQL_LOG_SAMPLE_RATE, between 0 and 1,
+    turns on sampled statement logging in place of SQLALCHEMY_ECHO. All of
+    these can be set through STUDYMATCH_ prefixed environment variables.
+    Engines connect lazily, and forked children never reuse their parent's
+    pooled connections.
+    """
+
+    app.config.setdefault("DB_PATH", "StudentMatch.db")
+    app.config.setdefault("STORAGE_PROFILE", "development")
+    app.config.setdefault("STORAGE_PRAGMAS", {})
+    app.config.setdefault("SQL_LOG_SAMPLE_RATE", 0)
+    app.config.from_prefixed_env("STUDYMATCH")
+    if app.config["STORAGE_PROFILE"] not in STORAGE_PROFILES:
+        raise ValueError("Unknown storage profile %r" % app.config["STORAGE_PROFILE"])
+    profile = STORAGE_PROFILES[app.config["STORAGE_PROFILE"]]
+    pragmas = dict(profile["pragmas"], **app.config["STORAGE_PRAGMAS"])
+    busy_timeout = pragmas.get("busy_timeout", 5000)
+
+    uri = "sqlite:///%s" % app.config["DB_PATH"]
+    app.config.setdefault("SQLALCHEMY_DATABASE_URI", uri)
+    if app.config["DB_PATH"] == ":memory:":
+        db.init_app(app)
+        return
+    app.config.setdefault(
+        "SQLALCHEMY_ENGINE_OPTIONS",
+        engine_options(profile["write_pool_size"], busy_timeout),
+    )
+    if profile["read_pool_size"]:
+        read_options = engine_options(profile["read_pool_size"], busy_timeout)
+        read_options["url"] = app.config["SQLALCHEMY_DATABASE_URI"]
+        app.config.setdefault("SQLALCHEMY_BINDS", {READ_BIND: read_options})
+    db.init_app(app)
+
+    rate = app.config["SQL_LOG_SAMPLE_RATE"]
+    with app.app_context():
+        for key, engine in db.engines.items():
+            fork_engines.add(engine)
+            if key == READ_BIND:
+                read_pragmas = dict(pragmas, query_only="ON")
+                read_pragmas.pop("journal_mode", None)
+                set_pragmas(engine, read_pragmas)
+            else:
+                set_pragmas(engine, pragmas)
+            if rate:
+                event.listen(engine, "before_cursor_execute", log_sampled(rate))
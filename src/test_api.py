@@ -0,0 +1,651 @@
+import json
+
+import pytest
+from app import create_app
+from db import db
+from sqlalchemy import text
+
+# What the routes answer, checked through their response bodies rather than
+# just their status codes
+
+
+def make_client(tmp_path, **config):
+    """
+    Returns a test client of an app on a fresh database under tmp_path, with
+    the response cache and admission control off unless config turns them on
+    """
+
+    settings = {
+        "TESTING": True,
+        "AUTO_MIGRATE": True,
+        "DB_PATH": str(tmp_path / "api.db"),
+        "RESPONSE_CACHE_ENABLED": False,
+        "ADMISSION_ENABLED": False,
+    }
+    settings.update(config)
+    return create_app(settings).test_client()
+
+
+def call(client, method, url, body=None, code=200, **kwargs):
+    """
+    Sends body as JSON to url, checks the response has code, and returns the
+    decoded response, or None when it has no body
+    """
+
+    data = None if body is None else json.dumps(body)
+    response = client.open(
+        url, method=method, data=data, content_type="application/json", **kwargs
+    )
+    assert response.status_code == code, response.data
+    return json.loads(response.data) if response.data else None
+
+
+@pytest.fixture
+def client(tmp_path):
+    """
+    A test client of an app with an empty database
+    """
+
+    return make_client(tmp_path)
+
+
+def add_task(client, group_id, day):
+    """
+    Creates a task of group_id due on day of January 2024 and returns its id
+    """
+
+    task = {
+        "task_name": "task",
+        "description": "d",
+        "due_date": "2024-01-%02dT00:00:00Z" % day,
+    }
+    url = "/groups/%d/tasks/?return=entity" % group_id
+    return call(client, "POST", url, task, 201)["id"]
+
+
+def walk(client, url, key, limit=2, after=None):
+    """
+    Follows next_cursor from url, or from after when given, to the last page
+    and returns the ids of every row, in the order they came
+    """
+
+    ids = []
+    while True:
+        page_url = "%s&limit=%d" % (url, limit)
+        if after is not None:
+            page_url += "&after=%s" % after
+        page = call(client, "GET", page_url)
+        ids += [row["id"] for row in page[key]]
+        after = page["next_cursor"]
+        if after is None:
+            return ids
+
+
+# Pagination
+
+# due days of the tasks the pagination tests create, with ties
+DUE_DAYS = [4, 2, 3, 2, 4, 2, 3]
+
+
+@pytest.fixture
+def tasks(client):
+    """
+    Creates DUE_DAYS' tasks in a group and returns their (due day, id)
+    """
+
+    group = call(client, "POST", "/groups/", {"name": "g"}, 201)
+    return [(day, add_task(client, group["id"], day)) for day in DUE_DAYS]
+
+
+@pytest.mark.parametrize("url", ["/tasks/?", "/groups/1/tasks/?"])
+@pytest.mark.parametrize(
+    "order, key",
+    [
+        ("id", lambda task: task[1]),
+        ("-id", lambda task: -task[1]),
+        ("due_date", lambda task: task),
+        ("-due_date", lambda task: (-task[0], task[1])),
+    ],
+)
+def test_pages_return_every_row_once(client, tasks, url, order, key):
+    expected = [task_id for _, task_id in sorted(tasks, key=key)]
+    for limit in (1, 2, 3):
+        assert walk(client, url + "order=" + order, "tasks", limit) == expected
+
+
+def test_pages_skip_nothing_when_rows_change_between_pages(client, tasks):
+    first = call(client, "GET", "/tasks/?order=due_date&limit=3")
+    seen = [task["id"] for task in first["tasks"]]
+    # a row before the cursor and a row after it
+    add_task(client, 1, 1)
+    late = add_task(client, 1, 9)
+    call(client, "DELETE", "/tasks/%d/" % seen[0])
+    rest = walk(client, "/tasks/?order=due_date", "tasks", 3, first["next_cursor"])
+    remaining = [task_id for _, task_id in sorted(tasks)][3:]
+    assert rest == remaining + [late]
+
+
+@pytest.mark.parametrize("order", ["id", "-due_date"])
+def test_streams_return_the_same_rows_as_pages(client, tasks, order):
+    paged = walk(client, "/tasks/?order=" + order, "tasks")
+    document = call(client, "GET", "/tasks/?stream=json&order=" + order)
+    assert [task["id"] for task in document["tasks"]] == paged
+    assert document["next_cursor"] is None
+    response = client.get("/tasks/?stream=ndjson&order=" + order)
+    lines = response.data.decode("utf-8").splitlines()
+    assert [json.loads(line)["id"] for line in lines] == paged
+
+
+def test_bad_cursor_is_rejected(client, tasks):
+    body = call(client, "GET", "/tasks/?order=due_date&after=7", code=400)
+    assert body == {"error": "after must be a cursor returned as next_cursor"}
+
+
+# Batch endpoints
+
+
+def test_user_batch_reports_each_bad_item_and_inserts_the_rest(client):
+    call(client, "POST", "/users/", {"name": "old", "netid": "old"}, 201)
+    batch = [
+        {"name": "a", "netid": "a"},
+        {"name": "b"},
+        {"name": "c", "netid": "old"},
+        {"name": "d", "netid": "a"},
+        "e",
+        {"name": "f", "netid": 6},
+        {"name": "g", "netid": "g"},
+    ]
+    result = call(client, "POST", "/users/batch/", batch, 201)
+    assert result == {
+        "ids": [2, None, None, None, None, None, 3],
+        "errors": [
+            {"index": 1, "error": "User netid is required"},
+            {"index": 2, "error": "User netid already exists"},
+            {"index": 3, "error": "User netid already exists"},
+            {"index": 4, "error": "Item must be an object"},
+            {"index": 5, "error": "User netid must be a string"},
+        ],
+    }
+    users = call(client, "GET", "/users/")["users"]
+    assert [user["netid"] for user in users] == ["old", "a", "g"]
+
+
+@pytest.mark.parametrize(
+    "body, error",
+    [
+        ({"name": "a", "netid": "a"}, "A list of items is required"),
+        (
+            [{"name": "a", "netid": "a"}] * 5001,
+            "At most 5000 items are allowed per batch",
+        ),
+    ],
+)
+def test_unusable_user_batch_inserts_nothing(client, body, error):
+    assert call(client, "POST", "/users/batch/", body, 400) == {"error": error}
+    assert call(client, "GET", "/users/")["users"] == []
+
+
+def test_task_batch_reports_each_bad_item_and_inserts_the_rest(client):
+    call(client, "POST", "/groups/", {"name": "g"}, 201)
+    batch = [
+        {"task_name": "a", "description": "d", "due_date": "2024-01-01T00:00:00Z"},
+        {"task_name": "b", "description": "d", "due_date": "someday"},
+        {"task_name": "c", "due_date": "2024-01-01T00:00:00Z"},
+    ]
+    result = call(client, "POST", "/groups/1/tasks/batch/", batch, 201)
+    assert result == {
+        "ids": [1, None, None],
+        "errors": [
+            {"index": 1, "error": "Task due date must be a timestamp"},
+            {"index": 2, "error": "Task description is required"},
+        ],
+    }
+    tasks = call(client, "GET", "/groups/1/tasks/")["tasks"]
+    assert [task["task_name"] for task in tasks] == ["a"]
+    missing = call(client, "POST", "/groups/2/tasks/batch/", batch[:1], 404)
+    assert missing == {"error": "Group not found"}
+    assert len(call(client, "GET", "/tasks/")["tasks"]) == 1
+
+
+def test_comment_batch_reports_each_bad_item_and_inserts_the_rest(client):
+    body = {"post_name": "p", "description": "d", "timestamp": "2024-01-01"}
+    call(client, "POST", "/posts/", body, 201)
+    batch = [
+        {"description": "a", "timestamp": "2024-01-02T00:00:00Z"},
+        {"description": 2, "timestamp": "2024-01-02T00:00:00Z"},
+        {"description": "c", "timestamp": "2024-01-03T00:00:00Z"},
+    ]
+    result = call(client, "POST", "/posts/1/comments/batch/", batch, 201)
+    assert result == {
+        "ids": [1, None, 2],
+        "errors": [{"index": 1, "error": "Comment description must be a string"}],
+    }
+    comments = call(client, "GET", "/posts/1/")["comments"]
+    assert [comment["comment_description"] for comment in comments] == ["a", "c"]
+
+
+# Response cache
+
+
+def test_write_invalidates_cached_read(tmp_path):
+    client = make_client(tmp_path, RESPONSE_CACHE_ENABLED=True)
+    call(client, "POST", "/groups/", {"name": "g"}, 201)
+    add_task(client, 1, 1)
+    first = client.get("/groups/1/")
+    etag = first.headers["ETag"]
+    cached = client.get("/groups/1/", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.data == b""
+    assert call(client, "GET", "/cache/stats/")["entries"] == 1
+    call(client, "PATCH", "/tasks/1/", {"description": "new"})
+    fresh = client.get("/groups/1/", headers={"If-None-Match": etag})
+    assert fresh.status_code == 200
+    assert fresh.headers["ETag"] != etag
+    assert json.loads(fresh.data)["tasks"][0]["task_description"] == "new"
+
+
+def test_write_through_another_app_invalidates_cached_read(tmp_path):
+    # two apps on one database, as two serve.py workers are
+    reader = make_client(
+        tmp_path, RESPONSE_CACHE_ENABLED=True, RESPONSE_CACHE_SYNC_SECONDS=0
+    )
+    writer = make_client(tmp_path)
+    call(writer, "POST", "/groups/", {"name": "g"}, 201)
+    add_task(writer, 1, 1)
+    for _ in range(3):
+        assert call(reader, "GET", "/groups/1/")["tasks"][0]["task_name"] == "task"
+    assert call(reader, "GET", "/cache/stats/")["hits"] >= 1
+    call(writer, "PATCH", "/tasks/1/", {"task_name": "renamed"})
+    assert call(reader, "GET", "/groups/1/")["tasks"][0]["task_name"] == "renamed"
+    call(writer, "DELETE", "/tasks/1/")
+    assert call(reader, "GET", "/groups/1/")["tasks"] == []
+
+
+# Change feeds
+
+
+def summarize(feed):
+    """
+    Returns the (type, id, deleted) of every change in a change feed page
+    """
+
+    return [(change["type"], change["id"], change["deleted"]) for change in feed]
+
+
+def test_group_changes_report_updates_and_tombstones(client):
+    for name in ("g", "h"):
+        call(client, "POST", "/groups/", {"name": name}, 201)
+    call(client, "POST", "/users/", {"name": "a", "netid": "a"}, 201)
+    call(client, "PUT", "/users/1/", {"group_id": 1})
+    add_task(client, 1, 1)
+    add_task(client, 1, 2)
+    page = call(client, "GET", "/groups/1/changes/")
+    assert summarize(page["changes"]) == [
+        ("user", 1, False),
+        ("task", 1, False),
+        ("task", 2, False),
+    ]
+    assert page["has_more"] is False
+    since = page["cursor"]
+    unchanged = call(client, "GET", "/groups/1/changes/?since=%d" % since)
+    assert unchanged == {"changes": [], "cursor": since, "has_more": False}
+
+    call(client, "PATCH", "/tasks/1/", {"description": "new"})
+    call(client, "DELETE", "/tasks/2/")
+    call(client, "PATCH", "/users/1/", {"group_id": 2})
+    page = call(client, "GET", "/groups/1/changes/?since=%d" % since)
+    assert summarize(page["changes"]) == [
+        ("task", 1, False),
+        ("task", 2, True),
+        ("user", 1, True),
+    ]
+    assert page["changes"][0]["data"]["task_description"] == "new"
+    assert page["changes"][1]["data"] is None
+    assert page["cursor"] > since
+    moved = call(client, "GET", "/groups/2/changes/?since=%d" % since)
+    assert summarize(moved["changes"]) == [("user", 1, False)]
+    assert moved["changes"][0]["data"]["group_id"] == 2
+
+
+def test_post_changes_come_in_pages(client):
+    body = {"post_name": "p", "description": "d", "timestamp": "2024-01-01"}
+    call(client, "POST", "/posts/", body, 201)
+    for day in (2, 3, 4):
+        comment = {"description": "c", "timestamp": "2024-01-0%d" % day}
+        call(client, "POST", "/posts/1/comments/", comment, 201)
+    call(client, "DELETE", "/comments/2/")
+    call(client, "PATCH", "/comments/1/", {"description": "edited"})
+    changes, since = [], 0
+    while True:
+        page = call(client, "GET", "/posts/1/changes/?limit=1&since=%d" % since)
+        changes += summarize(page["changes"])
+        since = page["cursor"]
+        if not page["has_more"]:
+            break
+    assert changes == [
+        ("comment", 3, False),
+        ("comment", 2, True),
+        ("comment", 1, False),
+    ]
+
+
+def test_bad_change_cursor_is_rejected(client):
+    call(client, "POST", "/groups/", {"name": "g"}, 201)
+    body = call(client, "GET", "/groups/1/changes/?since=abc", code=400)
+    assert body == {"error": "since must be a cursor returned as cursor"}
+    missing = call(client, "GET", "/groups/2/changes/", code=404)
+    assert missing == {"error": "Group not found"}
+
+
+# Counters
+
+
+def counts(client):
+    """
+    Returns the counters of every group and post from their summary views,
+    and the same counts taken from their full representations
+    """
+
+    summaries = [
+        [group["id"], group["member_count"], group["task_count"]]
+        for group in call(client, "GET", "/groups/?view=summary")["groups"]
+    ]
+    summaries += [
+        [post["id"], post["comment_count"]]
+        for post in call(client, "GET", "/posts/?view=summary")["posts"]
+    ]
+    counted = [
+        [group["id"], len(group["users"]), len(group["tasks"])]
+        for group in call(client, "GET", "/groups/")["groups"]
+    ]
+    counted += [
+        [post["id"], len(post["comments"])]
+        for post in call(client, "GET", "/posts/")["posts"]
+    ]
+    return summaries, counted
+
+
+def test_counters_follow_inserts_moves_and_deletes(client):
+    for name in ("g", "h", "i"):
+        call(client, "POST", "/groups/", {"name": name}, 201)
+    users = [{"name": netid, "netid": netid} for netid in "abcde"]
+    call(client, "POST", "/users/batch/", users, 201)
+    for user_id, group_id in [(1, 1), (2, 1), (3, 2), (4, 2), (5, 3)]:
+        call(client, "PUT", "/users/%d/" % user_id, {"group_id": group_id})
+    task = {"task_name": "t", "description": "d", "due_date": "2024-01-01"}
+    call(client, "POST", "/groups/1/tasks/batch/", [task] * 3, 201)
+    add_task(client, 2, 1)
+    post = {"post_name": "p", "description": "d", "timestamp": "2024-01-01"}
+    call(client, "POST", "/posts/", post, 201)
+    comment = {"description": "c", "timestamp": "2024-01-02"}
+    call(client, "POST", "/posts/1/comments/batch/", [comment] * 2, 201)
+    call(client, "POST", "/posts/1/comments/", comment, 201)
+    summaries, counted = counts(client)
+    assert summaries == [[1, 2, 3], [2, 2, 1], [3, 1, 0], [1, 3]]
+    assert summaries == counted
+
+    call(client, "PATCH", "/users/1/", {"group_id": 2})
+    call(client, "PATCH", "/users/3/", {"group_id": None})
+    call(client, "DELETE", "/users/4/")
+    call(client, "DELETE", "/tasks/1/")
+    call(client, "DELETE", "/groups/3/")
+    call(client, "DELETE", "/comments/1/")
+    summaries, counted = counts(client)
+    assert summaries == [[1, 1, 2], [2, 1, 1], [1, 2]]
+    assert summaries == counted
+
+
+def test_full_group_refuses_members(client):
+    call(client, "POST", "/groups/", {"name": "g", "capacity": 1}, 201)
+    for netid in ("a", "b"):
+        call(client, "POST", "/users/", {"name": netid, "netid": netid}, 201)
+    call(client, "PUT", "/users/1/", {"group_id": 1})
+    full = call(client, "PUT", "/users/2/", {"group_id": 1}, 409)
+    assert full == {"error": "Group is full"}
+    call(client, "PATCH", "/users/1/", {"group_id": None})
+    call(client, "PUT", "/users/2/", {"group_id": 1})
+    assert counts(client)[0] == [[1, 1, 0]]
+
+
+def test_repair_counters_fixes_drifted_counts(client):
+    call(client, "POST", "/groups/", {"name": "g"}, 201)
+    add_task(client, 1, 1)
+    app = client.application
+    with app.app_context():
+        db.session.execute(text("UPDATE groups SET task_count = 5"))
+        db.session.commit()
+    assert counts(client)[0] == [[1, 0, 5]]
+    result = app.test_cli_runner().invoke(args=["repair-counters"])
+    assert result.exit_code == 0, result.output
+    assert "task_count: 1 rows repaired" in result.output
+    assert "member_count: 0 rows repaired" in result.output
+    assert counts(client)[0] == [[1, 0, 1]]
+
+
+# Matching
+
+
+def test_auto_assign_respects_capacity_and_existing_members(client):
+    groups = [
+        {"name": "g", "capacity": 2, "courses": ["cs1"]},
+        {"name": "h", "capacity": 1, "courses": ["cs1", "cs2"]},
+        {"name": "i", "courses": ["art"]},
+    ]
+    for group in groups:
+        call(client, "POST", "/groups/", group, 201)
+    call(client, "POST", "/users/", {"name": "a", "netid": "a"}, 201)
+    call(client, "PUT", "/users/1/", {"group_id": 1})
+    for netid in "bcdef":
+        user = {"name": netid, "netid": netid, "courses": ["cs1", "cs2"]}
+        call(client, "POST", "/users/", user, 201)
+    result = call(client, "POST", "/groups/auto-assign/", {})
+    assigned = {row["user_id"]: row["group_id"] for row in result["assignments"]}
+    assert sorted(assigned.values()) == [1, 2]
+    assert sorted(list(assigned) + result["unmatched"]) == [2, 3, 4, 5, 6]
+    for user_id, group_id in assigned.items():
+        assert call(client, "GET", "/users/%d/" % user_id)["group_id"] == group_id
+    summaries = call(client, "GET", "/groups/?view=summary")["groups"]
+    assert [group["member_count"] for group in summaries] == [2, 1, 0]
+    # only the unlimited group is left open for users without a shared course
+    again = call(client, "POST", "/groups/auto-assign/", {"fallback": True})
+    assert [row["group_id"] for row in again["assignments"]] == [3, 3, 3]
+    assert again["unmatched"] == []
+
+
+# Write responses
+
+
+@pytest.fixture
+def group(client):
+    """
+    Creates a group with a member and a task, and returns the group's id
+    """
+
+    call(client, "POST", "/groups/", {"name": "g"}, 201)
+    call(client, "POST", "/users/", {"name": "a", "netid": "a"}, 201)
+    call(client, "PUT", "/users/1/", {"group_id": 1})
+    add_task(client, 1, 1)
+    return 1
+
+
+def test_patch_task_changes_only_the_fields_sent(client, group):
+    task = call(client, "PATCH", "/tasks/1/", {"description": "new"})
+    assert task == {
+        "id": 1,
+        "task_name": "task",
+        "task_description": "new",
+        "due_date": "2024-01-01T00:00:00Z",
+        "group_id": 1,
+    }
+    assert call(client, "GET", "/tasks/1/") == task
+    task = call(client, "PATCH", "/tasks/1/", {"due_date": "2024-02-01T00:00:00Z"})
+    assert (task["task_name"], task["task_description"]) == ("task", "new")
+    assert task["due_date"] == "2024-02-01T00:00:00Z"
+    empty = call(client, "PATCH", "/tasks/1/", {}, 400)
+    assert empty == {
+        "error": "Atleast one amongst task name, description, or due date is required"
+    }
+
+
+NEW_TASK = {"task_name": "renamed", "description": "d", "due_date": "2024-01-01"}
+
+
+@pytest.mark.parametrize(
+    "method, url, body, read, code",
+    [
+        ("PATCH", "/tasks/1/", {"task_name": "renamed"}, "/tasks/%d/", 200),
+        ("PUT", "/tasks/1/", {"task_name": "renamed"}, "/tasks/%d/", 200),
+        ("PATCH", "/users/1/", {"group_id": 1}, "/users/%d/", 200),
+        ("POST", "/groups/1/tasks/", NEW_TASK, "/tasks/%d/", 201),
+    ],
+)
+def test_write_returns_what_was_asked_for(client, group, method, url, body, read, code):
+    entity = call(client, method, url + "?return=entity", body, code)
+    assert entity == call(client, "GET", read % entity["id"])
+    minimal = client.open(
+        url + "?return=minimal",
+        method=method,
+        data=json.dumps(body),
+        content_type="application/json",
+    )
+    assert minimal.status_code == (204 if code == 200 else code)
+    assert minimal.data == b""
+    parent = call(client, method, url + "?return=parent", body, code)
+    assert parent == call(client, "GET", "/groups/1/")
+    narrowed = call(client, method, url + "?return=parent&fields=id,name", body, code)
+    assert narrowed == {"id": 1, "name": "g"}
+
+
+def test_default_return_modes(client, group):
+    body = {"task_name": "t", "description": "d", "due_date": "2024-01-01"}
+    assert "tasks" in call(client, "POST", "/groups/1/tasks/", body, 201)
+    assert "tasks" in call(client, "PUT", "/tasks/1/", {"task_name": "t"})
+    assert "tasks" not in call(client, "PATCH", "/tasks/1/", {"task_name": "t"})
+    assert call(client, "PATCH", "/users/1/", {"group_id": None}) == {
+        "id": 1,
+        "name": "a",
+        "netid": "a",
+        "group_id": None,
+    }
+    assert call(client, "GET", "/groups/1/")["users"] == []
+    bad = call(client, "PATCH", "/tasks/1/?return=all", {"task_name": "t"}, 400)
+    assert bad == {"error": "return must be one of: entity, minimal, parent"}
+
+
+def test_patch_comment_returns_the_comment_or_its_post(client):
+    body = {"post_name": "p", "description": "d", "timestamp": "2024-01-01"}
+    call(client, "POST", "/posts/", body, 201)
+    comment = {"description": "c", "timestamp": "2024-01-02T00:00:00Z"}
+    call(client, "POST", "/posts/1/comments/", comment, 201)
+    patched = call(client, "PATCH", "/comments/1/", {"description": "edited"})
+    assert patched == {
+        "id": 1,
+        "comment_description": "edited",
+        "timestamp": "2024-01-02T00:00:00Z",
+        "post_id": 1,
+    }
+    post = call(client, "PATCH", "/comments/1/?return=parent", {"description": "x"})
+    assert post == call(client, "GET", "/posts/1/")
+    assert post["comments"][0]["comment_description"] == "x"
+    missing = call(client, "PATCH", "/comments/2/", {"description": "x"}, 404)
+    assert missing == {"error": "Comment not found"}
+
+
+# Archive
+
+
+def test_archived_posts_are_hidden_unless_asked_for(tmp_path):
+    client = make_client(
+        tmp_path, RESPONSE_CACHE_ENABLED=True, RESPONSE_CACHE_SYNC_SECONDS=0
+    )
+    for day in ("2024-01-01", "2019-01-02", "2019-01-03"):
+        post = {"post_name": day, "description": "algorithms", "timestamp": day}
+        call(client, "POST", "/posts/", post, 201)
+    # post 2 has a recent comment, so only post 3 and its comment are old
+    for post_id, day in [(3, "2019-01-05"), (1, "2024-01-05"), (2, "2024-01-05")]:
+        comment = {"description": "algorithms", "timestamp": day}
+        call(client, "POST", "/posts/%d/comments/" % post_id, comment, 201)
+    # cached before the archive, and not served from the cache after it
+    before = call(client, "GET", "/posts/3/")
+    assert [post["id"] for post in call(client, "GET", "/posts/")["posts"]] == [1, 2, 3]
+
+    app = client.application
+    result = app.test_cli_runner().invoke(args=["archive", "--before", "2023-01-01"])
+    assert result.exit_code == 0, result.output
+    assert "Archived 1 posts and 1 comments" in result.output
+
+    assert [post["id"] for post in call(client, "GET", "/posts/")["posts"]] == [1, 2]
+    assert call(client, "GET", "/posts/3/", code=404) == {"error": "Post not found"}
+    assert [c["id"] for c in call(client, "GET", "/comments/")["comments"]] == [2, 3]
+    hits = call(client, "GET", "/search?q=algorithms")["results"]
+    assert {(hit["type"], hit["id"]) for hit in hits} == {
+        ("post", 1),
+        ("post", 2),
+        ("comment", 2),
+        ("comment", 3),
+    }
+
+    everything = call(client, "GET", "/posts/?include_archived=true")["posts"]
+    assert [post["id"] for post in everything] == [1, 2, 3]
+    assert call(client, "GET", "/posts/3/?include_archived=true") == before
+    comments = call(client, "GET", "/comments/?include_archived=true")["comments"]
+    assert [comment["id"] for comment in comments] == [1, 2, 3]
+    hits = call(client, "GET", "/search?q=algorithms&include_archived=true")["results"]
+    assert ("post", 3) in {(hit["type"], hit["id"]) for hit in hits}
+    bad = call(client, "GET", "/posts/?include_archived=yes", code=400)
+    assert bad == {"error": "include_archived must be one of: true, false"}
+
+    # the archived post held the highest id, which is not handed out again
+    post = {"post_name": "new", "description": "d", "timestamp": "2024-02-01"}
+    assert call(client, "POST", "/posts/", post, 201)["id"] == 4
+
+
+# Admission control
+
+LIMITED = {"api.get_groups": {"rate": 1, "burst": 2}}
+
+
+def test_exhausted_bucket_answers_429_with_retry_after(tmp_path):
+    client = make_client(tmp_path, ADMISSION_ENABLED=True, ADMISSION_LIMITS=LIMITED)
+    for _ in range(2):
+        assert call(client, "GET", "/groups/") == {"groups": [], "next_cursor": None}
+    response = client.get("/groups/")
+    assert response.status_code == 429
+    assert json.loads(response.data) == {"error": "Too many requests"}
+    assert response.headers["Retry-After"] == "1"
+    # other clients and other routes keep their own buckets
+    other = client.get("/groups/", environ_base={"REMOTE_ADDR": "10.0.0.2"})
+    assert other.status_code == 200
+    assert client.get("/users/").status_code == 200
+    stats = call(client, "GET", "/admission/stats/")["routes"]["GET /groups/"]
+    assert (stats["admitted"], stats["rate_limited"]) == (3, 1)
+
+
+def test_client_header_is_trusted_only_when_configured(tmp_path):
+    client = make_client(tmp_path, ADMISSION_ENABLED=True, ADMISSION_LIMITS=LIMITED)
+    for n in range(3):
+        response = client.get("/groups/", headers={"X-Real-IP": "10.0.0.%d" % n})
+    assert response.status_code == 429
+    proxied = make_client(
+        tmp_path,
+        ADMISSION_ENABLED=True,
+        ADMISSION_LIMITS=LIMITED,
+        ADMISSION_CLIENT_HEADER="X-Real-IP",
+    )
+    for n in range(3):
+        response = proxied.get("/groups/", headers={"X-Real-IP": "10.0.0.%d" % n})
+        assert response.status_code == 200
+
+
+def test_admission_is_off_by_default(tmp_path):
+    app = create_app(
+        {
+            "TESTING": True,
+            "AUTO_MIGRATE": True,
+            "DB_PATH": str(tmp_path / "api.db"),
+            "ADMISSION_LIMITS": LIMITED,
+        }
+    )
+    client = app.test_client()
+    for _ in range(5):
+        assert client.get("/groups/").status_code == 200
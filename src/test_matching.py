@@ -0,0 +1,87 @@
+import random
+
+import pytest
+from matching import match
+
+# random cases draw users and groups from these, so most users share a
+# course with several groups and compete for the same places
+COURSES = ["cs%d" % n for n in range(6)]
+SLOTS = ["slot%d" % n for n in range(4)]
+
+
+def sample(rng, names):
+    """
+    Returns a random, possibly empty, frozenset of names
+    """
+
+    return frozenset(rng.sample(names, rng.randint(0, 3)))
+
+
+def random_case(seed):
+    """
+    Returns (users, groups) for match(), with small and missing capacities
+    """
+
+    rng = random.Random(seed)
+    users = [
+        (user_id, sample(rng, COURSES), sample(rng, SLOTS)) for user_id in range(60)
+    ]
+    groups = [
+        (
+            group_id,
+            rng.choice([None, 0, 1, 2, 3, 5]),
+            sample(rng, COURSES),
+            sample(rng, SLOTS),
+        )
+        for group_id in range(1, 13)
+    ]
+    return users, groups
+
+
+@pytest.mark.parametrize("fallback", [False, True])
+@pytest.mark.parametrize("seed", range(20))
+def test_match_never_overfills_a_group(seed, fallback):
+    users, groups = random_case(seed)
+    assignments, unmatched = match(users, groups, fallback)
+    assert sorted(list(assignments) + unmatched) == [user[0] for user in users]
+    members = {}
+    for group_id in assignments.values():
+        members[group_id] = members.get(group_id, 0) + 1
+    for group_id, places, _, _ in groups:
+        if places is not None:
+            assert members.get(group_id, 0) <= places
+    if not fallback:
+        by_id = {group[0]: group for group in groups}
+        for user_id, courses, _ in users:
+            if user_id in assignments:
+                assert courses & by_id[assignments[user_id]][2]
+
+
+def test_match_fills_places_before_leaving_users_out():
+    users = [(user_id, frozenset(["cs1"]), frozenset()) for user_id in range(5)]
+    groups = [
+        (1, 2, frozenset(["cs1"]), frozenset()),
+        (2, 1, frozenset(["cs1"]), frozenset()),
+    ]
+    assignments, unmatched = match(users, groups)
+    assert sorted(assignments.values()) == [1, 1, 2]
+    assert len(unmatched) == 2
+
+
+def test_match_prefers_shared_courses_then_slots():
+    users = [(1, frozenset(["cs1", "cs2"]), frozenset(["mon"]))]
+    groups = [
+        (1, None, frozenset(["cs1"]), frozenset(["mon"])),
+        (2, None, frozenset(["cs1", "cs2"]), frozenset()),
+        (3, None, frozenset(["cs1", "cs2"]), frozenset(["mon"])),
+    ]
+    assert match(users, groups) == ({1: 3}, [])
+
+
+def test_fallback_only_uses_open_groups():
+    users = [(user_id, frozenset(["art"]), frozenset()) for user_id in range(4)]
+    groups = [(1, 0, frozenset(), frozenset()), (2, 2, frozenset(), frozenset())]
+    assert match(users, groups) == ({}, [0, 1, 2, 3])
+    assignments, unmatched = match(users, groups, fallback=True)
+    assert assignments == {0: 2, 1: 2}
+    assert unmatched == [2, 3]
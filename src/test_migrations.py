@@ -0,0 +1,94 @@
+import archive
+import pytest
+from migrations import MIGRATIONS, migrate, schema_version
+from sqlalchemy import create_engine
+
+# The schema db.create_all() made before the first migration, with posts
+# and comments still missing their AUTOINCREMENT ids
+BASELINE_SCHEMA = [
+    "CREATE TABLE groups (id INTEGER NOT NULL, name VARCHAR NOT NULL,"
+    " PRIMARY KEY (id))",
+    "CREATE TABLE posts (id INTEGER NOT NULL, post_name VARCHAR NOT NULL,"
+    " description VARCHAR NOT NULL, timestamp VARCHAR NOT NULL,"
+    " PRIMARY KEY (id))",
+    "CREATE TABLE users (id INTEGER NOT NULL, name VARCHAR NOT NULL, netid"
+    " VARCHAR NOT NULL, group_id INTEGER, PRIMARY KEY (id), FOREIGN"
+    " KEY(group_id) REFERENCES groups (id))",
+    "CREATE TABLE tasks (id INTEGER NOT NULL, task_name VARCHAR NOT NULL,"
+    " description VARCHAR NOT NULL, due_date VARCHAR NOT NULL, group_id"
+    " INTEGER NOT NULL, PRIMARY KEY (id), FOREIGN KEY(group_id) REFERENCES"
+    " groups (id))",
+    "CREATE TABLE comments (id INTEGER NOT NULL, description VARCHAR NOT"
+    " NULL, timestamp VARCHAR NOT NULL, post_id INTEGER NOT NULL, PRIMARY KEY"
+    " (id), FOREIGN KEY(post_id) REFERENCES posts (id))",
+    "INSERT INTO posts VALUES (1, 'first', 'about', '01/01/2020')",
+    "INSERT INTO posts VALUES (2, 'second', 'about', '01/02/2020')",
+    "INSERT INTO comments VALUES (1, 'reply', '01/03/2020', 1)",
+]
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """
+    An engine on a database with the baseline schema and a few rows
+    """
+
+    engine = create_engine("sqlite:///%s" % (tmp_path / "migrate.db"))
+    with engine.begin() as conn:
+        for statement in BASELINE_SCHEMA:
+            conn.exec_driver_sql(statement)
+    return engine
+
+
+def table_sql(conn, name):
+    """
+    Returns the CREATE statement of name, or None when it does not exist
+    """
+
+    return conn.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE name = ?", (name,)
+    ).scalar()
+
+
+def test_migrate_applies_every_migration(engine):
+    assert migrate(engine) == list(range(1, len(MIGRATIONS) + 1))
+    assert migrate(engine) == []
+    with engine.connect() as conn:
+        assert schema_version(conn) == len(MIGRATIONS)
+        assert "AUTOINCREMENT" in table_sql(conn, "posts")
+        posts = conn.exec_driver_sql(
+            "SELECT id, comment_count FROM posts ORDER BY id"
+        ).fetchall()
+        assert [tuple(row) for row in posts] == [(1, 1), (2, 0)]
+
+
+def test_interrupted_rebuild_rolls_back_and_reruns(engine, monkeypatch):
+    version = MIGRATIONS.index(archive.add_archive) + 1
+    columns, create = archive.AUTOINCREMENT_TABLES["posts"]
+    # fails in the copy, after posts_rebuild has been created
+    monkeypatch.setitem(
+        archive.AUTOINCREMENT_TABLES, "posts", (columns + ", missing", create)
+    )
+    with pytest.raises(Exception):
+        migrate(engine)
+    with engine.connect() as conn:
+        assert schema_version(conn) == version - 1
+        assert table_sql(conn, "posts_rebuild") is None
+        assert table_sql(conn, "posts_archive") is None
+        assert "AUTOINCREMENT" not in table_sql(conn, "posts")
+    monkeypatch.undo()
+    assert migrate(engine) == list(range(version, len(MIGRATIONS) + 1))
+    with engine.connect() as conn:
+        assert "AUTOINCREMENT" in table_sql(conn, "posts")
+        assert conn.exec_driver_sql("SELECT COUNT(*) FROM posts").scalar() == 2
+
+
+def test_leftover_rebuild_table_is_replaced(engine):
+    # left by a rebuild interrupted before migrations had transactions of
+    # their own
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE posts_rebuild (id INTEGER)")
+    assert migrate(engine) == list(range(1, len(MIGRATIONS) + 1))
+    with engine.connect() as conn:
+        assert table_sql(conn, "posts_rebuild") is None
+        assert "AUTOINCREMENT" in table_sql(conn, "posts")
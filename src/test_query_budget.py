@@ -0,0 +1,180 @@
+import json
+
+import pytest
+from app import create_app
+from query_budget import QueryBudgetExceeded
+
+# Every route with a @query_budget, called with TESTING on, so a route that
+# goes back to loading collections row by row fails its budget here
+GROUPS = 3
+MEMBERS = 3
+TASKS = 3
+POSTS = 3
+COMMENTS = 3
+
+
+def post(client, url, body):
+    """
+    Posts body as JSON to url and returns the decoded response
+    """
+
+    response = client.post(url, data=json.dumps(body), content_type="application/json")
+    assert response.status_code in (200, 201), response.data
+    return json.loads(response.data)
+
+
+@pytest.fixture
+def client(tmp_path):
+    """
+    A test client of an app with a few groups and posts, each with several
+    members, tasks or comments
+    """
+
+    app = create_app(
+        {
+            "TESTING": True,
+            "AUTO_MIGRATE": True,
+            "DB_PATH": str(tmp_path / "budget.db"),
+            "RESPONSE_CACHE_ENABLED": False,
+            "ADMISSION_ENABLED": False,
+        }
+    )
+    client = app.test_client()
+    for g in range(GROUPS):
+        group = post(client, "/groups/", {"name": "group %d" % g})
+        for m in range(MEMBERS):
+            netid = "u%d%d" % (g, m)
+            user = post(client, "/users/", {"name": netid, "netid": netid})
+            response = client.put(
+                "/users/%d/" % user["id"],
+                data=json.dumps({"group_id": group["id"]}),
+                content_type="application/json",
+            )
+            assert response.status_code == 200, response.data
+        for t in range(TASKS):
+            task = {
+                "task_name": "task %d" % t,
+                "description": "d",
+                "due_date": "2024-01-0%dT00:00:00Z" % (t + 1),
+            }
+            post(client, "/groups/%d/tasks/" % group["id"], task)
+    for p in range(POSTS):
+        body = {
+            "post_name": "post %d" % p,
+            "description": "about algorithms",
+            "timestamp": "2024-02-01T00:00:00Z",
+        }
+        created = post(client, "/posts/", body)
+        for c in range(COMMENTS):
+            comment = {
+                "description": "algorithms %d" % c,
+                "timestamp": body["timestamp"],
+            }
+            post(client, "/posts/%d/comments/" % created["id"], comment)
+    return client
+
+
+READS = [
+    "/users/",
+    "/users/?fields=id,name",
+    "/users/1/",
+    "/users/by-netid/u00/",
+    "/groups/",
+    "/groups/?limit=2",
+    "/groups/?fields=id,name",
+    "/groups/?fields=id,users&expand=users",
+    "/groups/?view=summary",
+    "/groups/1/",
+    "/groups/1/?fields=id,tasks&expand=tasks",
+    "/groups/1/users/",
+    "/groups/1/tasks/",
+    "/groups/1/changes/",
+    "/groups/1/changes/?since=1",
+    "/tasks/",
+    "/tasks/?due_after=2024-01-02T00:00:00Z",
+    "/tasks/1/",
+    "/posts/",
+    "/posts/?view=summary",
+    "/posts/?include_archived=true",
+    "/posts/1/",
+    "/posts/1/?include_archived=true",
+    "/posts/1/?fields=id,comments&expand=comments",
+    "/posts/1/changes/",
+    "/comments/",
+    "/comments/?include_archived=true",
+    "/comments/1/",
+    "/search?q=algorithms",
+    "/search?q=algorithms&include_archived=true",
+]
+
+
+@pytest.mark.parametrize("url", READS)
+def test_read_within_budget(client, url):
+    response = client.get(url)
+    assert response.status_code == 200, response.data
+
+
+@pytest.mark.parametrize("url", ["/groups/", "/groups/?fields=id,users,tasks"])
+def test_group_list_loads_every_member_and_task(client, url):
+    groups = json.loads(client.get(url).data)["groups"]
+    assert len(groups) == GROUPS
+    for group in groups:
+        members = ["u%d%d" % (group["id"] - 1, m) for m in range(MEMBERS)]
+        tasks = ["task %d" % t for t in range(TASKS)]
+        assert [user["netid"] for user in group["users"]] == members
+        assert [task["task_name"] for task in group["tasks"]] == tasks
+
+
+def test_post_list_loads_every_comment(client):
+    posts = json.loads(client.get("/posts/").data)["posts"]
+    assert len(posts) == POSTS
+    expected = ["algorithms %d" % c for c in range(COMMENTS)]
+    for body in posts:
+        comments = [comment["comment_description"] for comment in body["comments"]]
+        assert comments == expected
+
+
+def test_route_over_budget_fails(tmp_path):
+    app = create_app(
+        {
+            "TESTING": True,
+            "AUTO_MIGRATE": True,
+            "DB_PATH": str(tmp_path / "over.db"),
+            "QUERY_BUDGET_DEFAULT": 0,
+        }
+    )
+    with pytest.raises(QueryBudgetExceeded):
+        app.test_client().post(
+            "/groups/", data=json.dumps({"name": "g"}), content_type="application/json"
+        )
+
+
+@pytest.mark.parametrize("url", ["/groups/1/stream/", "/posts/1/stream/"])
+def test_stream_within_budget(client, url):
+    # the budget is checked before the body, so the stream can be closed
+    # without reading it
+    response = client.get(url, buffered=False)
+    assert response.status_code == 200
+    response.close()
+
+
+def test_lookup_within_budget(client):
+    netids = ["u%d%d" % (g, m) for g in range(GROUPS) for m in range(MEMBERS)]
+    response = client.post(
+        "/users/lookup",
+        data=json.dumps({"netids": netids + ["missing"]}),
+        content_type="application/json",
+    )
+    assert response.status_code == 200, response.data
+    assert len(json.loads(response.data)["users"]) == len(netids)
+
+
+@pytest.mark.parametrize(
+    "url",
+    ["/users/1/", "/groups/1/", "/tasks/1/", "/posts/1/", "/comments/1/"],
+)
+def test_delete_within_budget(client, url):
+    response = client.delete(url)
+    assert response.status_code == 200, response.data
+    assert json.loads(response.data)["id"] == 1
+    assert client.get(url).status_code == 404
@@ -0,0 +1,56 @@
+from datetime import datetime, timezone
+
+# formats accepted besides ISO 8601, mostly seen in rows written before
+# timestamps were stored as datetimes
+FALLBACK_FORMATS = ("%m/%d/%Y %H:%M", "%m/%d/%Y %I:%M %p", "%m/%d/%Y", "%B %d, %Y")
+
+
+def parse_timestamp(value):
+    """
+    Parses an ISO 8601 string, one of FALLBACK_FORMATS or a number of epoch
+    seconds into a naive UTC datetime. Raises ValueError otherwise.
+    """
+
+    if isinstance(value, bool):
+        raise ValueError("Invalid timestamp %r" % value)
+    if isinstance(value, (int, float)):
+        try:
+            return datetime.utcfromtimestamp(value)
+        except (OverflowError, OSError):
+            # outside the range of datetime or of the platform's time_t
+            raise ValueError("Invalid timestamp %r" % value)
+    if not isinstance(value, str):
+        raise ValueError("Invalid timestamp %r" % value)
+    text = value.strip()
+    if text.endswith("Z"):
+        text = text[:-1] + "+00:00"
+    try:
+        parsed = datetime.fromisoformat(text)
+    except ValueError:
+        parsed = None
+    for fmt in FALLBACK_FORMATS:
+        if parsed is not None:
+            break
+        try:
+            parsed = datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    if parsed is None:
+        raise ValueError("Invalid timestamp %r" % value)
+    if parsed.tzinfo is not None:
+        try:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        except OverflowError:
+            raise ValueError("Invalid timestamp %r" % value)
+    return parsed
+
+
+def format_timestamp(value):
+    """
+    Formats a stored UTC datetime as ISO 8601 with a Z suffix. Any other
+    value is returned unchanged.
+    """
+
+    if isinstance(value, datetime):
+        return value.isoformat() + "Z"
+    return value
@@ -0,0 +1,226 @@
+import csv
+import json
+import os
+import time
+
+import click
+from archive import reserve_archived_ids
+from db import ArchivedComment, ArchivedPost, Comment, Group, Post, Task, User, db
+from response_cache import EVERY_TAG, log_invalidation
+from search import INDEX_COMMENTS, INDEX_POSTS, index_archive
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from timestamps import format_timestamp, parse_timestamp
+
+# tables in foreign key order, so importing them in this order never
+# references a missing row
+TRANSFER_MODELS = [Group, User, Task, Post, Comment, ArchivedPost, ArchivedComment]
+# maintained by triggers on import, so never exported, except from the
+# archive tables, which have no triggers and whose rows never change
+DERIVED_COLUMNS = {"member_count", "task_count", "comment_count", "version"}
+ARCHIVE_MODELS = (ArchivedPost, ArchivedComment)
+FORMATS = ("ndjson", "csv")
+TRANSFER_CHUNK_SIZE = 5000
+PROGRESS_ROWS = 100000
+
+
+def transfer_columns(model):
+    """
+    The columns of model's table that are exported and imported
+    """
+
+    if model in ARCHIVE_MODELS:
+        return list(model.__table__.columns)
+    return [c for c in model.__table__.columns if c.name not in DERIVED_COLUMNS]
+
+
+def table_path(directory, model, fmt):
+    """
+    Path of the file holding model's table
+    """
+
+    return os.path.join(directory, "%s.%s" % (model.__tablename__, fmt))
+
+
+def encode_value(column, value):
+    """
+    Converts a column value to its exported form: datetimes become ISO 8601
+    strings
+    """
+
+    if isinstance(column.type, db.DateTime):
+        return format_timestamp(value)
+    return value
+
+
+def decode_value(column, value, fmt):
+    """
+    Converts an exported value back to the column's type. CSV has no
+    types, so empty strings in nullable or non-string columns are NULLs
+    and integers are parsed.
+    """
+
+    if fmt == "csv":
+        if value == "" and (column.nullable or not isinstance(column.type, db.String)):
+            return None
+        if value != "" and isinstance(column.type, db.Integer):
+            return int(value)
+    if value is not None and isinstance(column.type, db.DateTime):
+        return parse_timestamp(value)
+    return value
+
+
+def export_table(conn, model, path, fmt, chunk_size):
+    """
+    Writes every row of model's table to path, reading it through one
+    streaming cursor chunk_size rows at a time, and returns the row count
+    """
+
+    columns = transfer_columns(model)
+    result = conn.execution_options(stream_results=True).execute(
+        select(*columns).order_by(model.id)
+    )
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            writer = csv.writer(f)
+            writer.writerow([column.name for column in columns])
+        for rows in result.partitions(chunk_size):
+            for row in rows:
+                values = [encode_value(c, value) for c, value in zip(columns, row)]
+                if fmt == "csv":
+                    writer.writerow(["" if v is None else v for v in values])
+                else:
+                    record = dict(zip([column.name for column in columns], values))
+                    f.write(json.dumps(record) + "\n")
+            count += len(rows)
+    return count
+
+
+def read_rows(model, path, fmt):
+    """
+    Yields the rows of an exported file as column dicts, one at a time
+    """
+
+    columns = {column.name: column for column in transfer_columns(model)}
+    with open(path, newline="", encoding="utf-8") as f:
+        records = csv.DictReader(f) if fmt == "csv" else map(json.loads, f)
+        for line, record in enumerate(records, start=1):
+            unknown = set(record) - set(columns)
+            if unknown:
+                raise click.ClickException(
+                    "%s line %d: unknown columns %s"
+                    % (path, line, ", ".join(sorted(unknown)))
+                )
+            yield {
+                name: decode_value(columns[name], value, fmt)
+                for name, value in record.items()
+            }
+
+
+def table_indexes(conn, table):
+    """
+    Returns the CREATE INDEX statements of table's explicit indexes
+    """
+
+    rows = conn.exec_driver_sql(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index'"
+        " AND tbl_name = ? AND sql IS NOT NULL",
+        (table,),
+    )
+    return rows.fetchall()
+
+
+def import_table(conn, model, path, fmt, chunk_size, defer_indexes):
+    """
+    Inserts the rows of an exported file with one executemany INSERT per
+    chunk, optionally dropping model's indexes first and rebuilding them
+    once at the end, and returns the row count
+    """
+
+    table = model.__table__
+    indexes = table_indexes(conn, table.name) if defer_indexes else []
+    for name, _ in indexes:
+        conn.exec_driver_sql("DROP INDEX %s" % name)
+    count, chunk = 0, []
+    started = time.perf_counter()
+    for row in read_rows(model, path, fmt):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            conn.execute(table.insert(), chunk)
+            count += len(chunk)
+            chunk = []
+            if count % PROGRESS_ROWS < chunk_size:
+                click.echo(
+                    "  %s: %d rows, %.0f rows/s"
+                    % (table.name, count, count / (time.perf_counter() - started)),
+                    err=True,
+                )
+    if chunk:
+        conn.execute(table.insert(), chunk)
+        count += len(chunk)
+    for _, sql in indexes:
+        conn.exec_driver_sql(sql)
+    return count
+
+
+def init_transfer(app):
+    """
+    Registers the flask export and flask import commands
+    """
+
+    @app.cli.command("export")
+    @click.argument("directory", type=click.Path(file_okay=False))
+    @click.option("--format", "fmt", type=click.Choice(FORMATS), default="ndjson")
+    @click.option("--chunk-size", type=int, default=TRANSFER_CHUNK_SIZE)
+    def export_command(directory, fmt, chunk_size):
+        """
+        Exports every table to one NDJSON or CSV file per table
+        """
+
+        os.makedirs(directory, exist_ok=True)
+        with db.engine.connect() as conn:
+            # one read transaction, so every table comes from one snapshot
+            conn.exec_driver_sql("BEGIN")
+            for model in TRANSFER_MODELS:
+                path = table_path(directory, model, fmt)
+                count = export_table(conn, model, path, fmt, chunk_size)
+                click.echo("%s: %d rows -> %s" % (model.__tablename__, count, path))
+            conn.exec_driver_sql("COMMIT")
+
+    @app.cli.command("import")
+    @click.argument("directory", type=click.Path(exists=True, file_okay=False))
+    @click.option("--format", "fmt", type=click.Choice(FORMATS), default="ndjson")
+    @click.option("--chunk-size", type=int, default=TRANSFER_CHUNK_SIZE)
+    @click.option(
+        "--defer-indexes",
+        is_flag=True,
+        help="Drop each table's indexes while loading it and rebuild them after.",
+    )
+    def import_command(directory, fmt, chunk_size, defer_indexes):
+        """
+        Imports the files written by flask export, keeping their ids. Tables
+        without a file are skipped. Each table is loaded in one transaction,
+        which also has every server drop its cached responses.
+        """
+
+        for model in TRANSFER_MODELS:
+            path = table_path(directory, model, fmt)
+            if not os.path.exists(path):
+                click.echo("%s: no %s, skipped" % (model.__tablename__, path))
+                continue
+            try:
+                with db.engine.begin() as conn:
+                    count = import_table(
+                        conn, model, path, fmt, chunk_size, defer_indexes
+                    )
+                    log_invalidation(conn, [EVERY_TAG])
+            except IntegrityError as e:
+                raise click.ClickException("%s: %s" % (model.__tablename__, e.orig))
+            click.echo("%s: %d rows imported" % (model.__tablename__, count))
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(INDEX_POSTS)
+            conn.exec_driver_sql(INDEX_COMMENTS)
+            index_archive(conn)
+            reserve_archived_ids(conn)
+        click.echo("Search index refreshed")